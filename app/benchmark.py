@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+"""
+Benchmark the expensive parts of the transcoder on synthetic media, so regressions show up when presets or I/O code
+change:
+
+    - encoding a synthetic master (ffmpeg lavfi testsrc2 and sine) with each ffmpeg profile in settings.py, through
+      convert_and_get_metadata
+    - generate_file_md5 and fixity_copy, per GB
+    - find_video_file on a generated tree of files, from a cold and a warm scan index
+
+Results are saved as JSON, and can be compared with a saved baseline. Run from the 'app' folder, e.g.
+
+    python benchmark.py --output benchmarks/baseline.json
+    python benchmark.py --compare benchmarks/baseline.json --duration 60 --resolution 3840x2160
+
+or use `make benchmark-baseline` and `make benchmark`. Compare runs on the same machine, with the same parameters.
+Comparing with a baseline that doesn't exist is an error, rather than a pass.
+"""
+
+import os
+import tempfile
+
+# keep the benchmarks' checksums, probes, scan indexes and catalogue entries out of the transcoder's state, and off
+# Slack. Scratch and the output cache are turned off, as they are by default, so that the encodes are measured on the
+# default path (and each profile alike), and nothing is written to a live scratch volume or output cache. This has to
+# happen before settings is imported.
+BENCHMARK_STATE_FOLDER = tempfile.mkdtemp(prefix='transcoder-benchmark-')
+os.environ['STATE_FOLDER'] = BENCHMARK_STATE_FOLDER
+os.environ['SCRATCH_FOLDER'] = ''
+os.environ['OUTPUT_CACHE_FOLDER'] = ''
+os.environ['SLACK_BACKEND'] = 'null'
+
+import argparse  # noqa: E402
+import json  # noqa: E402
+import logging  # noqa: E402
+import platform  # noqa: E402
+import shutil  # noqa: E402
+import socket  # noqa: E402
+import subprocess  # noqa: E402
+import sys  # noqa: E402
+import time  # noqa: E402
+from datetime import datetime  # noqa: E402
+
+import settings  # noqa: E402
+from easyaccess import convert_and_get_metadata  # noqa: E402
+from lib.ffmpeg import find_video_file  # noqa: E402
+from lib.fixity import fixity_copy, generate_file_md5  # noqa: E402
+from lib.lease import LeaseManager  # noqa: E402
+
+PROFILES = {
+    'access': settings.ACCESS_FFMPEG_ARGS,
+    'web': settings.WEB_FFMPEG_ARGS,
+    'exhibitions_access': settings.EXHIBITIONS_ACCESS_FFMPEG_ARGS,
+    'exhibitions_web': settings.EXHIBITIONS_WEB_FFMPEG_ARGS,
+}
+
+# the audio codec to use in synthetic masters of each video codec
+MASTER_AUDIO_CODECS = {
+    'prores_ks': 'pcm_s16le',
+    'prores': 'pcm_s16le',
+    'dnxhd': 'pcm_s16le',
+    'ffv1': 'pcm_s16le',
+    'libx264': 'aac',
+    'mpeg2video': 'mp2',
+}
+
+# sidecar files in generated trees, as left by processed masters
+SIDECAR_EXTENSIONS = ['.md5', '.json']
+
+
+def generate_master(path, duration, resolution, codec, frame_rate):
+    """
+    Write a synthetic master of `duration` seconds: a moving test pattern with a stereo tone.
+    """
+    width, height = resolution.split('x')
+    subprocess.run([
+        'ffmpeg', '-loglevel', 'error', '-y',
+        '-f', 'lavfi', '-i', 'testsrc2=size=%sx%s:rate=%s:duration=%s' % (width, height, frame_rate, duration),
+        '-f', 'lavfi', '-i', 'sine=frequency=1000:sample_rate=48000:duration=%s' % duration,
+        '-c:v', codec,
+        '-c:a', MASTER_AUDIO_CODECS.get(codec, 'aac'), '-ac', '2',
+        path,
+    ], check=True)
+
+
+def generate_data_file(path, size):
+    """
+    Write `size` bytes of random data, and drop them from the page cache (where the OS supports it), so they are read
+    from the disk rather than memory.
+    """
+    block = os.urandom(min(size, 16 * 1024 * 1024))
+    with open(path, 'wb') as f:
+        written = 0
+        while written < size:
+            written += f.write(block[:size - written])
+        f.flush()
+        os.fsync(f.fileno())
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def generate_tree(folder, file_count, files_per_folder=100, locked_fraction=0.1):
+    """
+    Create a watch folder tree with `file_count` entries: empty masters, their sidecar files, and leases (held by
+    another node) on some of them.
+    """
+    other_node = LeaseManager(owner='benchmark-other-node')
+    created = 0
+    folder_number = 0
+    while created < file_count:
+        subfolder = os.path.join(folder, 'folder%04d' % folder_number)
+        os.makedirs(subfolder)
+        for file_number in range(files_per_folder // (len(SIDECAR_EXTENSIONS) + 1)):
+            master_number = folder_number * files_per_folder + file_number
+            master_path = os.path.join(subfolder, 'B%07d_mo01_Title.mov' % master_number)
+            for path in [master_path] + [master_path + extension for extension in SIDECAR_EXTENSIONS]:
+                open(path, 'w').close()
+                created += 1
+            if file_number % int(1 / locked_fraction) == 0:
+                other_node.acquire(master_path + '.lock')
+                created += 1
+        folder_number += 1
+    other_node.stop()
+    return created
+
+
+def timed_call(function, *args, **kwargs):
+    started = time.monotonic()
+    result = function(*args, **kwargs)
+    return time.monotonic() - started, result
+
+
+def benchmark_encodes(folder, args):
+    master_path = os.path.join(folder, 'B0000001_mo01_Synthetic.mov')
+    logging.info('Generating a %ss %s %s master...' % (args.duration, args.resolution, args.codec))
+    generate_master(master_path, args.duration, args.resolution, args.codec, args.frame_rate)
+    master_size = os.path.getsize(master_path)
+
+    results = {}
+    for profile in args.profiles:
+        logging.info('Encoding with the %s profile...' % profile)
+        dest_path = os.path.join(folder, profile, 'B0000001_ao01_Synthetic' + settings.ACCESS_FFMPEG_DESTINATION_EXT)
+        os.makedirs(os.path.dirname(dest_path))
+        wall_secs, metadata = timed_call(
+            convert_and_get_metadata, master_path, dest_path, PROFILES[profile], '1', 'ao01', 'Synthetic',
+        )
+        results['encode:%s' % profile] = {
+            'measure': 'secs_per_media_minute',
+            'wall_secs': round(wall_secs, 3),
+            'secs_per_media_minute': round(wall_secs / args.duration * 60, 3),
+            'speed': round(args.duration / wall_secs, 3),
+            'master_bytes': master_size,
+            'output_bytes': os.path.getsize(dest_path),
+            'output_bit_rate': metadata.get('video_bit_rate'),
+        }
+    return results
+
+
+def io_result(wall_secs, size):
+    return {
+        'measure': 'secs_per_gb',
+        'wall_secs': round(wall_secs, 3),
+        'bytes': size,
+        'secs_per_gb': round(wall_secs / (size / 1e9), 3),
+        'mb_per_sec': round(size / 1e6 / wall_secs, 2),
+    }
+
+
+def benchmark_io(folder, args):
+    size = args.io_size * 1024 * 1024
+    source_folder = os.path.join(folder, 'source')
+    destination_folder = os.path.join(folder, 'destination')
+    os.makedirs(source_folder)
+    os.makedirs(destination_folder)
+    results = {}
+
+    logging.info('Hashing %d MiB...' % args.io_size)
+    hashed_path = os.path.join(source_folder, 'hashed.bin')
+    generate_data_file(hashed_path, size)
+    wall_secs, _ = timed_call(generate_file_md5, hashed_path, use_cache=False)
+    results['generate_file_md5'] = io_result(wall_secs, size)
+
+    # a copy hashes the source as it reads it, unless its checksums are already known
+    logging.info('Fixity copying %d MiB...' % args.io_size)
+    copied_path = os.path.join(source_folder, 'copied.bin')
+    generate_data_file(copied_path, size)
+    wall_secs, _ = timed_call(fixity_copy, copied_path, destination_folder)
+    results['fixity_copy'] = io_result(wall_secs, size)
+
+    # as when moving a master that was hashed earlier in the job
+    logging.info('Fixity copying %d MiB with known checksums...' % args.io_size)
+    wall_secs, _ = timed_call(fixity_copy, hashed_path, destination_folder)
+    results['fixity_copy:hashed'] = io_result(wall_secs, size)
+    return results
+
+
+def benchmark_scan(folder, args):
+    tree_folder = os.path.join(folder, 'watch')
+    logging.info('Generating a tree of %d files...' % args.tree_files)
+    entries = generate_tree(tree_folder, args.tree_files)
+
+    results = {}
+    # the first scan builds the scan index; the next only checks that nothing has changed
+    for name in ['find_video_file:cold', 'find_video_file:warm']:
+        wall_secs, found = timed_call(find_video_file, tree_folder, lock_files=False)
+        assert found, 'No video file found in %s' % tree_folder
+        results[name] = {'measure': 'wall_secs', 'wall_secs': round(wall_secs, 3), 'entries': entries}
+    return results
+
+
+def ffmpeg_version():
+    try:
+        output = subprocess.run(['ffmpeg', '-version'], stdout=subprocess.PIPE, universal_newlines=True).stdout
+        return output.splitlines()[0]
+    except (OSError, IndexError):
+        return None
+
+
+def run_benchmarks(folder, args):
+    results = {}
+    if 'encode' in args.benchmarks:
+        results.update(benchmark_encodes(folder, args))
+    if 'io' in args.benchmarks:
+        results.update(benchmark_io(folder, args))
+    if 'scan' in args.benchmarks:
+        results.update(benchmark_scan(folder, args))
+    return {
+        'recorded_at': datetime.now().isoformat(),
+        'environment': {
+            'node': socket.gethostname(),
+            'cpu_count': os.cpu_count(),
+            'python': platform.python_version(),
+            'ffmpeg': ffmpeg_version(),
+        },
+        'parameters': {
+            'duration': args.duration,
+            'resolution': args.resolution,
+            'codec': args.codec,
+            'frame_rate': args.frame_rate,
+            'io_size': args.io_size,
+            'tree_files': args.tree_files,
+        },
+        'results': results,
+    }
+
+
+def compare(run, baseline, tolerance):
+    """
+    Compare each result's measure (lower is better) with the baseline's. Returns a list of (name, baseline value,
+    value, change) for results that are more than `tolerance` (e.g. 0.2 for 20%) slower.
+    """
+    if run['parameters'] != baseline['parameters']:
+        logging.warning('The baseline was recorded with different parameters: %s' % baseline['parameters'])
+    regressions = []
+    for name, result in sorted(run['results'].items()):
+        baseline_result = baseline['results'].get(name)
+        if not baseline_result:
+            continue
+        measure = result['measure']
+        before, after = baseline_result[measure], result[measure]
+        change = (after - before) / before if before else 0
+        logging.info('%-32s %-24s %10.3f -> %10.3f (%+.1f%%)' % (name, measure, before, after, change * 100))
+        if change > tolerance:
+            regressions.append((name, before, after, change))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark encoding, hashing, copying and scanning.')
+    parser.add_argument('--benchmarks', default='encode,io,scan', type=lambda value: value.split(','),
+                        help='comma-separated benchmarks to run: encode, io and/or scan')
+    parser.add_argument('--profiles', default=','.join(PROFILES), type=lambda value: value.split(','),
+                        help='comma-separated ffmpeg profiles to encode with: %s' % ', '.join(PROFILES))
+    parser.add_argument('--duration', type=int, default=30, help='seconds of synthetic master')
+    parser.add_argument('--resolution', default='1920x1080', help='of the synthetic master, e.g. 1920x1080')
+    parser.add_argument('--codec', default='prores_ks', help='video codec of the synthetic master')
+    parser.add_argument('--frame-rate', default='25', help='of the synthetic master')
+    parser.add_argument('--io-size', type=int, default=1024, help='MiB to hash and copy')
+    parser.add_argument('--tree-files', type=int, default=10000, help='number of files in the generated watch tree')
+    parser.add_argument('--folder', help='where to generate media (default: a temporary folder)')
+    parser.add_argument('--output', help='JSON file to save the results to, e.g. as a new baseline')
+    parser.add_argument('--compare', help='JSON baseline to compare the results with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='fraction slower than the baseline that counts as a regression')
+    args = parser.parse_args(argv)
+
+    def error(message):
+        shutil.rmtree(BENCHMARK_STATE_FOLDER, ignore_errors=True)
+        parser.error(message)
+
+    for profile in args.profiles:
+        if profile not in PROFILES:
+            error('Unknown profile %s' % profile)
+    if args.compare and not os.path.exists(args.compare):
+        error('No baseline at %s to compare with. Record one with `make benchmark-baseline`.' % args.compare)
+
+    folder = tempfile.mkdtemp(prefix='benchmark-', dir=args.folder)
+    try:
+        run = run_benchmarks(folder, args)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+        shutil.rmtree(BENCHMARK_STATE_FOLDER, ignore_errors=True)
+
+    print(json.dumps(run, indent=2))
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(run, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(run, baseline, args.tolerance)
+        for name, before, after, change in regressions:
+            logging.error('Regression: %s is %.0f%% slower (%.3f -> %.3f)' % (name, change * 100, before, after))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -15,54 +15,228 @@ import json
 import logging
 from os import access
 import tempfile
-import subprocess
 import os
 import posixpath
 import re
-import time
 import shutil
 from datetime import date
+from functools import partial
 
 import settings
-from lib.ffmpeg import (FFMPEGError, find_video_file,
-                        get_video_metadata,
-                        write_metadata_summary_entry,
+from lib.ffmpeg import (FFMPEGError, build_ffmpeg_command, find_video_file, find_video_files,
+                        flush_metadata_summary, get_video_metadata, get_video_probe, lease_lost_event, lock,
+                        run_ffmpeg, try_lock_video_file, with_progress_args, write_metadata_summary_entry,
                         unlock)
-from lib.fixity import fixity_move, generate_file_md5, post_move_filename
+from lib.fixity import fixity_copy, fixity_move, generate_file_md5, post_move_filename
 from lib.formatting import seconds_to_hms
-from lib.s3 import upload_to_s3
+from lib.jobs import check_aborted, configure_logging, run_worker_pool, set_abort_event
+from lib.journal import JobJournal, unfinished_jobs
+from lib.metrics import start_metrics_server
+from lib.output_cache import output_cache
+from lib.perf import job_record, span
+from lib.pipeline import Pipeline
+from lib.remux import master_conforms, remux_command
+from lib.s3 import uploader
+from lib.scheduler import scheduler
+from lib.scratch import ScratchSpaceError, scratch
+from lib.segmented import encode_segmented, should_segment
 from lib.slack import post_slack_message, new_file_slack_message, post_slack_exception
-from lib.xos import update_xos_with_final_video, get_or_create_xos_stub_video
+from lib.watcher import Watcher
+from lib.xos import update_xos_with_final_video, get_or_create_xos_stub_video, xos
 
-logging.basicConfig(format='%(asctime)s: %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S', level=logging.INFO)
+configure_logging()
 
 
 
 
 def convert_and_get_metadata(source_file_path, dest_file_path, ffmpeg_base_args, vernon_id, file_type, title):
-    if os.path.exists(dest_file_path):
-        message = "Cancelling video conversion: " + dest_file_path + " already exists."
-        logging.warning(message)
-        post_slack_message(message)
-        return
+    return convert_to_outputs(source_file_path, [(dest_file_path, ffmpeg_base_args, file_type)], vernon_id, title)[0]
+
+
+def source_duration(source_file_path):
+    """
+    Duration of the source in seconds, for estimating how long an encode has left, or None if it can't be probed.
+    """
+    try:
+        _, metadata = get_video_probe(source_file_path)
+        return metadata.get('duration_secs')
+    except Exception as e:
+        logging.warning("Couldn't probe the duration of %s: %s" % (source_file_path, e))
+        return None
+
+
+def output_profiles():
+    """
+    The ffmpeg profiles each master is converted with.
+    """
+    if settings.EXHIBITIONS_TRANSCODER:
+        profiles = [settings.EXHIBITIONS_ACCESS_FFMPEG_ARGS, settings.EXHIBITIONS_WEB_FFMPEG_ARGS]
+    else:
+        profiles = [settings.ACCESS_FFMPEG_ARGS, settings.WEB_FFMPEG_ARGS]
+    return profiles if settings.TRANSCODE_WEB_COPY else profiles[:1]
+
+
+def queued_masters():
+    """
+    How many masters are waiting to be claimed in the watch folder, for the encode scheduler.
+    """
+    try:
+        return len(find_video_files(settings.WATCH_FOLDER))
+    except Exception as e:
+        logging.warning("Couldn't count the masters waiting in %s: %s" % (settings.WATCH_FOLDER, e))
+        return 0
+
+
+def encode_outputs(source_file_path, encodes, duration_secs, tmp_folder):
+    """
+    Encode the source to every output, decoding it once, or in segments if it is long.
+
+    :param encodes: list of (ffmpeg_base_args, output_path) tuples.
+    :return: (the path taken, 'encode' or 'segmented'; the encode scheduler's decision; the ffmpeg args each output was
+        encoded with, e.g. with the preset the scheduler chose)
+    """
+    profiles = [ffmpeg_base_args for ffmpeg_base_args, _ in encodes]
+    with scheduler.encoding(profiles, duration_secs, queued_masters()) as schedule, \
+            span('ffmpeg', os.path.getsize(source_file_path)):
+        if should_segment(duration_secs):
+            # the job's threads are shared between the segments encoded at once
+            scheduled_args = [scheduler.apply(ffmpeg_base_args, schedule, settings.SEGMENT_THREADS)
+                              for ffmpeg_base_args in profiles]
+            encode_segmented(
+                source_file_path,
+                [(ffmpeg_args, output_path) for ffmpeg_args, (_, output_path) in zip(scheduled_args, encodes)],
+                os.path.join(tmp_folder, 'segments'),
+                workers=max(1, schedule['threads'] // settings.SEGMENT_THREADS),
+            )
+            return 'segmented', schedule, scheduled_args
 
-    with tempfile.TemporaryDirectory() as tmp_folder:
-        tmp_path = os.path.join(tmp_folder, os.path.basename(dest_file_path))
-        ffmpeg_args = ["ffmpeg", '-i', source_file_path] + ffmpeg_base_args + [tmp_path]
+        # and between the outputs of a single ffmpeg run
+        output_threads = max(1, schedule['threads'] // len(encodes))
+        scheduled_args = [scheduler.apply(ffmpeg_base_args, schedule, output_threads) for ffmpeg_base_args in profiles]
+        ffmpeg_args = with_progress_args(build_ffmpeg_command(
+            source_file_path,
+            [(ffmpeg_args, output_path) for ffmpeg_args, (_, output_path) in zip(scheduled_args, encodes)],
+        ))
         cmd_str = " ".join(ffmpeg_args)
         logging.info("Running " + cmd_str)
-        r = subprocess.run(ffmpeg_args, check=True)
-        fixity_move(tmp_path, dest_file_path, failsafe_folder=None)
-        logging.info("Conversion complete: " + dest_file_path)
+        run_ffmpeg(ffmpeg_args, duration_secs=duration_secs)
+    return 'encode', schedule, scheduled_args
+
+
+def convert_to_outputs(source_file_path, outputs, vernon_id, title):
+    """
+    Decode the source once and write every output profile from a single ffmpeg run. Outputs whose profile the source
+    already meets are copied from it instead (see lib/remux.py), as are outputs already in the output cache (see
+    lib/output_cache.py). Each output is then fixity moved, probed and logged on its own, with the path taken to it.
+
+    :param outputs: list of (dest_file_path, ffmpeg_base_args, file_type) tuples.
+    :return: list of metadata dicts in the same order as outputs (None for outputs that already existed).
+    """
+    pending_outputs = []
+    for index, (dest_file_path, ffmpeg_base_args, file_type) in enumerate(outputs):
+        if os.path.exists(dest_file_path):
+            message = "Cancelling video conversion: " + dest_file_path + " already exists."
+            logging.warning(message)
+            post_slack_message(message)
+            continue
+        pending_outputs.append((index, dest_file_path, ffmpeg_base_args, file_type))
+
+    output_metadata = [None] * len(outputs)
+    if not pending_outputs:
+        return output_metadata
+
+    with tempfile.TemporaryDirectory(dir=scratch.job_folder()) as tmp_folder:
+        tmp_paths = []
+        for index, dest_file_path, _, _ in pending_outputs:
+            # a folder per output, in case two outputs share a filename
+            os.mkdir(os.path.join(tmp_folder, str(index)))
+            tmp_paths.append(os.path.join(tmp_folder, str(index), os.path.basename(dest_file_path)))
+        duration_secs = source_duration(source_file_path)
+        # from the checksum cache, once the master has been hashed
+        master_checksum = generate_file_md5(source_file_path) if output_cache.enabled else None
+        # (path taken, encode schedule) for each output
+        encode_paths = [None] * len(pending_outputs)
+        encodes = []
+        for position, ((_, _, ffmpeg_base_args, _), tmp_path) in enumerate(zip(pending_outputs, tmp_paths)):
+            cached_path = output_cache.get(master_checksum, ffmpeg_base_args) if master_checksum else None
+            if cached_path:
+                logging.info("Copying %s from the output cache." % cached_path)
+                with span('output_cache', os.path.getsize(cached_path)):
+                    fixity_copy(cached_path, tmp_path, store_md5s=False)
+                encode_paths[position] = ('cache', None)
+            elif master_conforms(source_file_path, ffmpeg_base_args):
+                with span('remux', os.path.getsize(source_file_path)):
+                    run_ffmpeg(with_progress_args(remux_command(source_file_path, tmp_path)), duration_secs)
+                encode_paths[position] = ('remux', None)
+            else:
+                encodes.append((position, ffmpeg_base_args, tmp_path))
+        if encodes:
+            encode_path, schedule, scheduled_args = encode_outputs(
+                source_file_path, [(ffmpeg_base_args, tmp_path) for _, ffmpeg_base_args, tmp_path in encodes],
+                duration_secs, tmp_folder,
+            )
+            for (position, _, tmp_path), ffmpeg_args in zip(encodes, scheduled_args):
+                encode_paths[position] = (encode_path, schedule)
+                if master_checksum:
+                    # under what was actually encoded, e.g. a faster preset than the profile's, so that it is only
+                    # served for a profile with that preset
+                    try:
+                        output_cache.put(master_checksum, ffmpeg_args, tmp_path, source=source_file_path)
+                    except Exception as e:
+                        logging.warning("Couldn't add %s to the output cache: %s" % (tmp_path, e))
+        # another node may have claimed the master while it was being encoded
+        check_aborted()
+        for (_, dest_file_path, _, _), tmp_path in zip(pending_outputs, tmp_paths):
+            fixity_move(tmp_path, dest_file_path, failsafe_folder=None)
+            logging.info("Conversion complete: " + dest_file_path)
+
+    for (index, dest_file_path, _, file_type), (encode_path, schedule) in zip(pending_outputs, encode_paths):
+        metadata = get_video_metadata(dest_file_path)
+        with open(dest_file_path + ".json", 'w') as f:
+            json.dump(metadata, f, indent=2, default=str)
+        metadata.update({
+            'vernon_id': vernon_id,
+            'filetype': file_type,
+            'title': title,
+            'encode_path': encode_path,
+            'encode_schedule': schedule,
+        })
+        write_metadata_summary_entry(metadata)
+        new_file_slack_message("*New file* :hatching_chick:", dest_file_path, seconds_to_hms(metadata['duration_secs']))
+        output_metadata[index] = metadata
 
-    metadata = get_video_metadata(dest_file_path)
-    with open(dest_file_path + ".json", 'w') as f:
-        json.dump(metadata, f, indent=2, default=str)
-    metadata.update({'vernon_id': vernon_id, 'filetype': file_type, 'title': title})
-    write_metadata_summary_entry(metadata)
-    new_file_slack_message("*New file* :hatching_chick:", dest_file_path, seconds_to_hms(metadata['duration_secs']))
+    return output_metadata
 
-    return metadata
+
+def convert_to_access_and_web_formats(
+        source_file_path,
+        access_file_path,
+        access_file_type,
+        access_ffmpeg_args,
+        web_file_path,
+        web_file_type,
+        web_ffmpeg_args,
+        vernon_id,
+        title,
+        format_name,
+    ):
+    """
+    Convert to the access format, and the web format if settings.TRANSCODE_WEB_COPY, decoding the source only once.
+    Returns (access_metadata, web_metadata).
+    """
+    outputs = [(access_file_path, access_ffmpeg_args, access_file_type)]
+    if settings.TRANSCODE_WEB_COPY:
+        outputs.append((web_file_path, web_ffmpeg_args, web_file_type))
+        format_name += ' access and web'
+    else:
+        format_name += ' access'
+
+    logging.info('Converting to %s formats...' % format_name)
+    output_metadata = convert_to_outputs(source_file_path, outputs, vernon_id, title)
+    access_metadata = output_metadata[0]
+    web_metadata = output_metadata[1] if settings.TRANSCODE_WEB_COPY else None
+    logging.info('Converting to %s formats... DONE\n' % format_name)
+    return access_metadata, web_metadata
 
 
 def convert_to_exhibition_formats(
@@ -74,35 +248,18 @@ def convert_to_exhibition_formats(
         vernon_id,
         title,
     ):
-    access_metadata = None
-    web_metadata = None
-    try:
-        logging.info('Converting to exhibitions access format...')
-        access_metadata = convert_and_get_metadata(
-            source_file_path,
-            access_file_path,
-            settings.EXHIBITIONS_ACCESS_FFMPEG_ARGS,
-            vernon_id,
-            access_file_type,
-            title,
-        )
-        logging.info('Converting to exhibitions access format... DONE\n')
-        if settings.TRANSCODE_WEB_COPY:
-            logging.info('Converting to exhibitions web format...')
-            web_metadata = convert_and_get_metadata(
-                source_file_path,
-                web_file_path,
-                settings.EXHIBITIONS_WEB_FFMPEG_ARGS,
-                vernon_id,
-                web_file_type,
-                title,
-            )
-            logging.info('Converting to exhibitions web format... DONE\n')
-    except Exception as exception:
-        return post_slack_exception(
-            'Could not convert to exhibitions access and web formats: %s' % exception
-        )
-    return access_metadata, web_metadata
+    return convert_to_access_and_web_formats(
+        source_file_path,
+        access_file_path,
+        access_file_type,
+        settings.EXHIBITIONS_ACCESS_FFMPEG_ARGS,
+        web_file_path,
+        web_file_type,
+        settings.EXHIBITIONS_WEB_FFMPEG_ARGS,
+        vernon_id,
+        title,
+        'exhibitions',
+    )
 
 
 def convert_to_collection_formats(
@@ -114,49 +271,70 @@ def convert_to_collection_formats(
         vernon_id,
         title,
     ):
-    access_metadata = None
-    web_metadata = None
-    try:
-        logging.info('Converting to collections access format...')
-        access_metadata = convert_and_get_metadata(
-            source_file_path,
-            access_file_path,
-            settings.ACCESS_FFMPEG_ARGS,
-            vernon_id,
-            access_file_type,
-            title,
-        )
-        logging.info('Converting to collections access format... DONE\n')
-        if settings.TRANSCODE_WEB_COPY:
-            logging.info('Converting to collections web format...')
-            web_metadata = convert_and_get_metadata(
-                source_file_path,
-                web_file_path,
-                settings.WEB_FFMPEG_ARGS,
-                vernon_id,
-                web_file_type,
-                title,
-            )
-            logging.info('Converting to collections web format... DONE\n')
-    except Exception as exception:
-        return post_slack_exception(
-            'Could not convert to collections access and web formats: %s' % exception
-        )
-    return access_metadata, web_metadata
-
+    return convert_to_access_and_web_formats(
+        source_file_path,
+        access_file_path,
+        access_file_type,
+        settings.ACCESS_FFMPEG_ARGS,
+        web_file_path,
+        web_file_type,
+        settings.WEB_FFMPEG_ARGS,
+        vernon_id,
+        title,
+        'collections',
+    )
+
+
+def claim_video_file(watcher=None, interrupted_jobs=None):
+    """
+    Find and lock the next video file to convert, or return None if there aren't any.
+
+    Jobs that were interrupted by a restart come first. Their masters are still locked by our previous process, or may
+    already have been moved into the master folder.
+
+    Files the watcher has seen arrive are claimed directly. The whole watch folder is only searched when the watcher
+    says a rescan is due (at startup, and every settings.IDLE_WAIT as a safety net).
+    """
+    while interrupted_jobs:
+        source_file_path = interrupted_jobs.pop(0)
+        # take over the lease from our previous process
+        if lock(source_file_path, resume=True):
+            logging.info("Resuming interrupted job: %s" % source_file_path)
+            return source_file_path
+        logging.warning("Not resuming %s: it has been claimed by another node." % source_file_path)
+
+    if watcher is not None:
+        source_file_path = watcher.next_file()
+        while source_file_path:
+            if try_lock_video_file(source_file_path):
+                logging.info("source_file_path: %s" % source_file_path)
+                return source_file_path
+            source_file_path = watcher.next_file()
+        if not watcher.rescan_due():
+            return None
 
-def main():
-    # LOOK FOR VIDEO FILES TO CONVERT
     logging.info("Looking for video files to convert...")
     logging.info("settings.WATCH_FOLDER: %s." % settings.WATCH_FOLDER)
     source_file_path = find_video_file(settings.WATCH_FOLDER)
     if not source_file_path:
-        logging.info("No files found. Waiting 1hr.\n")
-        time.sleep(3600)
-        return
+        if watcher is not None:
+            watcher.rescan_done()
+            logging.info("No files found. Waiting for new files.\n")
+        else:
+            logging.info("No files found. Waiting %ss.\n" % settings.IDLE_WAIT)
+        return None
     logging.info("source_file_path: %s" % source_file_path)
     logging.info("Looking for video files to convert... DONE\n")
+    return source_file_path
+
 
+def process_video_file(source_file_path):
+    """
+    Run the whole pipeline for a claimed (locked) master file. Steps that don't depend on each other run at the same
+    time (see lib/pipeline.py), and a job that was interrupted is resumed from the steps it hadn't completed.
+    Returns True if the job finished.
+    """
+    journal = JobJournal(source_file_path)
 
     # MAKE SURE WE HAVE THE DESTINATION FOLDERS
     try:
@@ -187,7 +365,7 @@ def main():
 
         if not os.path.exists(destination_master_folder): os.mkdir(destination_master_folder)
         if not os.path.exists(destination_access_folder): os.mkdir(destination_access_folder)
-        if settings.TRANSCODE_WEB_COPY:
+        if settings.TRANSCODE_WEB_COPY and not journal.completed('web_upload'):
             if not os.path.exists(destination_web_folder): os.mkdir(destination_web_folder)
 
         master_file_path = destination_master_folder + master_filename
@@ -205,46 +383,40 @@ def main():
 
 
     # HASH MASTER AND LOG METADATA
-    try:
+    def hash_master(results):
         logging.info("Hashing master and logging metadata...")
-        generate_file_md5(source_file_path, store=True)
+        # if there's a scratch volume, the master is hashed as it's copied there
+        scratch.stage(source_file_path)
+        checksum = generate_file_md5(source_file_path, store=True)
         master_metadata = get_video_metadata(source_file_path)
         master_metadata.update({'vernon_id': vernon_id, 'filetype': master_file_type, 'title': title})
         write_metadata_summary_entry(master_metadata)
         logging.info("Hashing master and logging metadata... DONE\n")
-    except Exception as e:
-        return post_slack_exception("Couldn't hash master and log metadata: %s" % e)
+        return {'checksum': checksum, 'master_metadata': master_metadata}
 
 
     # UPDATE XOS WITH STUB VIDEO
-    try:
+    def create_xos_stub(results):
         logging.info("Getting or creating XOS stub video...")
         asset_id = get_or_create_xos_stub_video({
             'title': master_filename+" NOT UPLOADED",
-            'master_metadata': master_metadata
+            'master_metadata': results['hash']['master_metadata']
         })
         logging.info("Stub video django ID: %s" % asset_id)
         logging.info("Getting or creating XOS stub video... DONE\n")
-    except Exception as e:
-        return post_slack_exception("Couldn't update XOS: %s" % e)
+        return {'asset_id': asset_id}
 
 
     # CONVERT TO ACCESS AND WEB FORMATS
-    if settings.EXHIBITIONS_TRANSCODER:
-        # Transcoder settings for in-gallery exhibitions videos
-        access_metadata, web_metadata = convert_to_exhibition_formats(
-            source_file_path,
-            access_file_path,
-            access_file_type,
-            web_file_path,
-            web_file_type,
-            vernon_id,
-            title,
-        )
-    else:
-        # Transcoder settings for collections videos
-        access_metadata, web_metadata = convert_to_collection_formats(
-            source_file_path,
+    def transcode(results):
+        if settings.EXHIBITIONS_TRANSCODER:
+            # Transcoder settings for in-gallery exhibitions videos
+            convert = convert_to_exhibition_formats
+        else:
+            # Transcoder settings for collections videos
+            convert = convert_to_collection_formats
+        access_metadata, web_metadata = convert(
+            scratch.stage(source_file_path),
             access_file_path,
             access_file_type,
             web_file_path,
@@ -252,57 +424,141 @@ def main():
             vernon_id,
             title,
         )
+        if journal.resumed:
+            # outputs that were moved into place before an interruption aren't converted again
+            if access_metadata is None and os.path.exists(access_file_path):
+                access_metadata = get_video_metadata(access_file_path)
+            if settings.TRANSCODE_WEB_COPY and web_metadata is None and os.path.exists(web_file_path):
+                web_metadata = get_video_metadata(web_file_path)
+        return {
+            'access_file_path': access_file_path,
+            'access_metadata': access_metadata,
+            'web_file_path': web_file_path if settings.TRANSCODE_WEB_COPY else None,
+            'web_metadata': web_metadata,
+        }
 
 
     # MOVE THE SOURCE FILE INTO THE MASTER FOLDER
-    try:
+    def move_master(results):
+        master_metadata = results['hash']['master_metadata']
         logging.info("Moving the source file into the master folder...")
-        fixity_move(source_file_path, master_file_path, failsafe_folder=settings.OUTPUT_FOLDER)
+        if os.path.exists(source_file_path) or not os.path.exists(master_file_path):
+            fixity_move(source_file_path, master_file_path, failsafe_folder=settings.OUTPUT_FOLDER)
+        else:
+            logging.info("%s was already moved before the job was interrupted." % source_file_path)
         with open(master_file_path + ".json", 'w') as f:
             json.dump(master_metadata, f, indent=2, default=str)
         new_file_slack_message("*New master file* :movie_camera:", master_file_path, seconds_to_hms(master_metadata['duration_secs']))
         logging.info("Moving the source file into the master folder... DONE\n")
-    except Exception as e:
-        return post_slack_exception("Couldn't move the source file into the master folder: %s" % e)
+        return {'master_file_path': master_file_path}
 
 
     # UPLOAD THE ACCESS AND WEB FILES TO S3
-    try:
+    def upload_access_file(results):
         logging.info("Uploading access file to S3...")
-        upload_to_s3(access_file_path)
+        key = uploader.upload(access_file_path)
         logging.info("Uploading access file to S3... DONE\n")
-        if settings.TRANSCODE_WEB_COPY:
-            logging.info("Uploading web file to S3...")
-            upload_to_s3(web_file_path)
-            shutil.rmtree(destination_web_folder)
-            logging.info("Uploading web file to S3... DONE\n")
-    except Exception as e:
-        return post_slack_exception("%s Couldn't upload to S3" % e)
+        return {'key': key}
+
+    def upload_web_file(results):
+        logging.info("Uploading web file to S3...")
+        key = uploader.upload(web_file_path)
+        shutil.rmtree(destination_web_folder)
+        logging.info("Uploading web file to S3... DONE\n")
+        return {'key': key}
 
 
     # UPDATE XOS VIDEO URLS AND METADATA
-    try:
+    def update_xos(results):
         logging.info("Updating XOS video urls and metadata...")
         generate_file_md5(master_file_path, store=True)
         xos_asset_data = {
             'title': master_filename,
             'resource': os.path.basename(access_file_path),
-            'access_metadata': json.dumps(access_metadata, default=str),
+            'access_metadata': json.dumps(results['transcode']['access_metadata'], default=str),
         }
         if settings.TRANSCODE_WEB_COPY:
             xos_asset_data.update({
                 'web_resource': os.path.basename(web_file_path),
-                'web_metadata': json.dumps(web_metadata, default=str)
+                'web_metadata': json.dumps(results['transcode']['web_metadata'], default=str)
             })
+        asset_id = results['xos_stub']['asset_id']
         update_xos_with_final_video(asset_id, xos_asset_data)
         logging.info("Updating XOS video urls and metadata... DONE\n")
-    except Exception as e:
-        return post_slack_exception("%s Couldn't update XOS video urls and metadata" % e)
+        return {'asset_id': asset_id}
+
+
+    pipeline = Pipeline(journal)
+    pipeline.add_stage('hash', hash_master, error_message="Couldn't hash master and log metadata: %s")
+    pipeline.add_stage('xos_stub', create_xos_stub, requires=['hash'], error_message="Couldn't update XOS: %s")
+    # outputs are looked up in the output cache by the master's checksum, and ffmpeg reads the master's staged copy
+    pipeline.add_stage('transcode', transcode, requires=['hash'] if output_cache.enabled or scratch.enabled else [],
+                       error_message="Could not convert to access formats: %s")
+    # the master can only be moved once ffmpeg has finished reading it
+    pipeline.add_stage('master_move', move_master, requires=['hash', 'transcode'],
+                       error_message="Couldn't move the source file into the master folder: %s")
+    pipeline.add_stage('access_upload', upload_access_file, requires=['transcode'],
+                       error_message="%s Couldn't upload to S3")
+    final_requirements = ['xos_stub', 'master_move', 'access_upload']
+    if settings.TRANSCODE_WEB_COPY:
+        pipeline.add_stage('web_upload', upload_web_file, requires=['transcode'],
+                           error_message="%s Couldn't upload to S3")
+        final_requirements.append('web_upload')
+    pipeline.add_stage('xos_update', update_xos, requires=final_requirements,
+                       error_message="%s Couldn't update XOS video urls and metadata")
+
+    # stop if another node takes the master over, e.g. after our lease on it expired while the share was unavailable
+    set_abort_event(lease_lost_event(source_file_path))
+
+    # wait for room on the scratch volume for the master and its outputs (a resumed job's master may have been moved)
+    needed_bytes = 0
+    if scratch.enabled and os.path.exists(source_file_path):
+        needed_bytes = scratch.predicted_size(
+            source_file_path, output_profiles(), segmented=should_segment(source_duration(source_file_path)))
+    try:
+        with scratch.admit(source_file_path, needed_bytes):
+            finished = pipeline.run()
+    except ScratchSpaceError as e:
+        return post_slack_exception("Could not convert %s: %s" % (master_filename, e))
+    if not finished:
+        # the job keeps its lease and journal, and is resumed from the failed stages when the transcoder restarts
+        return
 
     unlock(source_file_path)
+    journal.finish()
     logging.info("=" * 80)
+    return True
+
+
+def run_job(source_file_path):
+    try:
+        with job_record(source_file_path) as record:
+            if process_video_file(source_file_path):
+                record.result = 'finished'
+    finally:
+        # write this job's metadata catalogue entries together
+        flush_metadata_summary()
+
+
+def main():
+    # send any XOS updates that were queued while XOS was unavailable
+    try:
+        xos.flush_updates()
+    except Exception as e:
+        logging.warning("Couldn't send queued XOS updates: %s" % e)
+    start_metrics_server()
+    watcher = Watcher(settings.WATCH_FOLDER).start()
+    try:
+        run_worker_pool(
+            partial(claim_video_file, watcher, unfinished_jobs()),
+            run_job,
+            settings.CONCURRENT_JOBS,
+            settings.IDLE_WAIT,
+            work_event=watcher.files_available,
+        )
+    finally:
+        watcher.stop()
 
 
 if __name__ == "__main__":
-    while True:
-        main()
+    main()
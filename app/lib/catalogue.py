@@ -0,0 +1,214 @@
+"""
+A local SQLite catalogue of the metadata of every video we've processed, indexed by checksum, Vernon ID and date.
+
+It replaces the daily '%Y%m%d_metadata.csv' files, which can still be exported in the same format for the people who
+use them:
+
+    python -m lib.catalogue export --date 20201017 --output /mount/output/20201017_metadata.csv
+    python -m lib.catalogue find --checksum 0123456789abcdef0123456789abcdef
+    python -m lib.catalogue import /mount/output/*_metadata.csv
+"""
+
+import argparse
+import atexit
+import csv
+import json
+import logging
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime
+
+import settings
+
+METADATA_CSV_HEADERS = [
+    'vernon_id',
+    'title',
+    'filetype',
+    'duration_secs',
+    'duration_hms',
+    'checksum',
+    'mime_type',
+    'creation_datetime',
+    'file_size_bytes',
+    'overall_bit_rate',
+    'video_codec',
+    'video_bit_rate',
+    'video_max_bit_rate',
+    'video_frame_rate',
+    'width',
+    'height',
+    'audio_codec',
+    'audio_channels',
+    'audio_sample_rate',
+    'audio_bit_rate',
+    'audio_max_bit_rate',
+]
+
+CATALOGUE_COLUMNS = ['recorded_date', 'recorded_at'] + METADATA_CSV_HEADERS + ['extra']
+
+
+class Catalogue:
+    """
+    Entries are buffered and written in batches: when settings.CATALOGUE_BATCH_SIZE entries are waiting, when the
+    oldest has waited settings.CATALOGUE_FLUSH_INTERVAL seconds, or when flush() is called (e.g. at the end of a job).
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._db = None
+        self._lock = threading.Lock()
+        self._pending = []
+        self._oldest_pending = None
+        atexit.register(self.flush)
+
+    def _connect(self):
+        if self._db is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+            self._db = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+            self._db.row_factory = sqlite3.Row
+            # WAL lets exports and lookups read while a transcoder is writing
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS metadata (id INTEGER PRIMARY KEY AUTOINCREMENT, %s)'
+                % ', '.join(CATALOGUE_COLUMNS)
+            )
+            for column in ['checksum', 'vernon_id', 'recorded_date']:
+                self._db.execute('CREATE INDEX IF NOT EXISTS metadata_%s ON metadata (%s)' % (column, column))
+            self._db.commit()
+        return self._db
+
+    def add(self, file_metadata, recorded_at=None):
+        recorded_at = recorded_at or datetime.now()
+        row = {column: file_metadata.get(column) for column in METADATA_CSV_HEADERS}
+        row['recorded_date'] = recorded_at.strftime('%Y%m%d')
+        row['recorded_at'] = recorded_at.isoformat()
+        extra = {key: value for key, value in file_metadata.items() if key not in METADATA_CSV_HEADERS}
+        row['extra'] = json.dumps(extra, default=str) if extra else None
+
+        with self._lock:
+            self._pending.append(row)
+            if self._oldest_pending is None:
+                self._oldest_pending = time.monotonic()
+            due = len(self._pending) >= settings.CATALOGUE_BATCH_SIZE \
+                or time.monotonic() - self._oldest_pending >= settings.CATALOGUE_FLUSH_INTERVAL
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            if not self._pending:
+                return
+            db = self._connect()
+            with db:
+                db.executemany(
+                    'INSERT INTO metadata (%s) VALUES (%s)' % (
+                        ', '.join(CATALOGUE_COLUMNS), ', '.join(':%s' % column for column in CATALOGUE_COLUMNS)
+                    ),
+                    self._pending,
+                )
+            logging.info('Wrote %d entries to the metadata catalogue.' % len(self._pending))
+            self._pending = []
+            self._oldest_pending = None
+
+    def entries(self, checksum=None, vernon_id=None, date_from=None, date_to=None):
+        """
+        Catalogue entries (as dicts) matching all of the given filters, oldest first. Dates are 'YYYYMMDD' strings.
+        """
+        self.flush()
+        conditions = []
+        parameters = []
+        for condition, value in [
+                ('checksum = ?', checksum),
+                ('vernon_id = ?', vernon_id),
+                ('recorded_date >= ?', date_from),
+                ('recorded_date <= ?', date_to),
+        ]:
+            if value is not None:
+                conditions.append(condition)
+                parameters.append(value)
+        query = 'SELECT * FROM metadata'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        with self._lock:
+            rows = self._connect().execute(query + ' ORDER BY id', parameters).fetchall()
+        return [dict(row) for row in rows]
+
+    def export_csv(self, output_file, **filters):
+        """
+        Write matching entries to output_file in the format of the old daily metadata CSVs.
+        """
+        writer = csv.DictWriter(output_file, fieldnames=METADATA_CSV_HEADERS, extrasaction='ignore')
+        writer.writeheader()
+        entries = self.entries(**filters)
+        for entry in entries:
+            writer.writerow(entry)
+        return len(entries)
+
+    def import_csv(self, csv_path):
+        """
+        Load one of the old '%Y%m%d_metadata.csv' files into the catalogue, dated from its filename.
+        """
+        match = re.match(r'(\d{8})_metadata\.csv$', os.path.basename(csv_path))
+        recorded_at = datetime.strptime(match.group(1), '%Y%m%d') if match else datetime.now()
+        with open(csv_path) as f:
+            count = 0
+            for row in csv.DictReader(f):
+                self.add({key: value or None for key, value in row.items()}, recorded_at=recorded_at)
+                count += 1
+        self.flush()
+        return count
+
+
+catalogue = Catalogue(settings.CATALOGUE_PATH)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Query and export the metadata catalogue.')
+    parser.add_argument('--catalogue', default=settings.CATALOGUE_PATH, help='path to the catalogue database')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    for name, help_text in [('export', 'export entries as CSV'), ('find', 'print entries as JSON')]:
+        subparser = subparsers.add_parser(name, help=help_text)
+        subparser.add_argument('--date', help='YYYYMMDD: only entries recorded on this day')
+        subparser.add_argument('--from', dest='date_from', help='YYYYMMDD: only entries recorded on or after this day')
+        subparser.add_argument('--to', dest='date_to', help='YYYYMMDD: only entries recorded on or before this day')
+        subparser.add_argument('--checksum')
+        subparser.add_argument('--vernon-id')
+        if name == 'export':
+            subparser.add_argument('--output', help='CSV file to write (default: stdout)')
+
+    import_parser = subparsers.add_parser('import', help='load old daily metadata CSV files')
+    import_parser.add_argument('csv_paths', nargs='+')
+
+    args = parser.parse_args(argv)
+    metadata_catalogue = Catalogue(args.catalogue)
+
+    if args.command == 'import':
+        for csv_path in args.csv_paths:
+            print('%s: %d entries' % (csv_path, metadata_catalogue.import_csv(csv_path)))
+        return
+
+    filters = {
+        'checksum': args.checksum,
+        'vernon_id': args.vernon_id,
+        'date_from': args.date or args.date_from,
+        'date_to': args.date or args.date_to,
+    }
+    if args.command == 'export':
+        if args.output:
+            with open(args.output, 'w', newline='') as output_file:
+                metadata_catalogue.export_csv(output_file, **filters)
+        else:
+            metadata_catalogue.export_csv(sys.stdout, **filters)
+    else:
+        for entry in metadata_catalogue.entries(**filters):
+            print(json.dumps(entry))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,21 +1,29 @@
-from pathlib import Path
-
 from urllib.parse import urlparse
 
 import settings
 import tempfile
 import logging
-from lib.fixity import fixity_move
+from lib.fixity import checksum_cache, file_identity, fixity_move
+import collections
 import json
 import subprocess
 import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pytz import timezone
 import requests
 from dateutil.parser import parse as parse_date
 from shutil import which
-import csv
+from lib.catalogue import METADATA_CSV_HEADERS, catalogue
 from lib.formatting import seconds_to_hms
+from lib.jobs import check_aborted, current_job_name
+from lib.lease import leases
+from lib.metrics import metrics
+from lib.perf import timed
+from lib.scanner import ScanIndex
 
 timezone = timezone(settings.TIMEZONE)
 
@@ -31,34 +39,222 @@ VIDEO_MIME_TYPES = {
     '.mpeg': 'video/mpeg',
 }
 
-METADATA_CSV_HEADERS = [
-    'vernon_id',
-    'title',
-    'filetype',
-    'duration_secs',
-    'duration_hms',
-    'checksum',
-    'mime_type',
-    'creation_datetime',
-    'file_size_bytes',
-    'overall_bit_rate',
-    'video_codec',
-    'video_bit_rate',
-    'video_max_bit_rate',
-    'video_frame_rate',
-    'width',
-    'height',
-    'audio_codec',
-    'audio_channels',
-    'audio_sample_rate',
-    'audio_bit_rate',
-    'audio_max_bit_rate',
-]
+
+# ffmpeg options that apply to the whole command rather than to one output, and whether they take a value
+FFMPEG_GLOBAL_OPTIONS = {
+    '-loglevel': True,
+    '-v': True,
+    '-stats': False,
+    '-nostats': False,
+    '-hide_banner': False,
+    '-progress': True,
+    '-n': False,
+    '-y': False,
+}
 
 
 class FFMPEGError(subprocess.CalledProcessError):
     def __str__(self):
-        return "Command '%s' didn't complete successfully (exit status %d). Perhaps not a valid video file?" % (" ".join(self.cmd), self.returncode)
+        message = "Command '%s' didn't complete successfully (exit status %d). Perhaps not a valid video file?" % (" ".join(self.cmd), self.returncode)
+        if self.stderr:
+            message += " ffmpeg said: %s" % self.stderr.strip().splitlines()[-1]
+        return message
+
+
+def split_global_args(ffmpeg_args):
+    """
+    Separate the global options in an ffmpeg argument list (e.g. settings.ACCESS_FFMPEG_ARGS) from the per-output
+    options, so that several output profiles can share a single ffmpeg command.
+
+    :return: (global_args, output_args)
+    """
+    global_args = []
+    output_args = []
+    args = iter(ffmpeg_args)
+    for arg in args:
+        if arg in FFMPEG_GLOBAL_OPTIONS:
+            global_args.append(arg)
+            if FFMPEG_GLOBAL_OPTIONS[arg]:
+                global_args.append(next(args))
+        else:
+            output_args.append(arg)
+    return global_args, output_args
+
+
+def build_ffmpeg_command(source_file_path, outputs):
+    """
+    Build one ffmpeg command that decodes source_file_path once and writes every output.
+
+    :param outputs: list of (ffmpeg_base_args, output_path) tuples, one per output profile.
+    :return: the argument list, ready for subprocess.
+    """
+    global_args = []
+    seen_options = set()
+    output_args = []
+    for ffmpeg_base_args, output_path in outputs:
+        output_global_args, output_only_args = split_global_args(ffmpeg_base_args)
+        # the first output profile wins for global options that more than one profile sets
+        i = 0
+        while i < len(output_global_args):
+            option = output_global_args[i]
+            width = 2 if FFMPEG_GLOBAL_OPTIONS[option] else 1
+            if option not in seen_options:
+                seen_options.add(option)
+                global_args += output_global_args[i:i + width]
+            i += width
+        output_args += output_only_args + [output_path]
+    return ["ffmpeg"] + global_args + ['-i', source_file_path] + output_args
+
+
+def with_progress_args(ffmpeg_args):
+    """
+    Have ffmpeg write machine-readable progress to stdout instead of its stats line, and log errors to stderr (rather
+    than nothing, with '-loglevel panic'), so we can see how an encode is going and why it failed.
+    """
+    args = []
+    i = 0
+    while i < len(ffmpeg_args):
+        arg = ffmpeg_args[i]
+        if arg in ('-loglevel', '-v', '-progress'):
+            if arg != '-progress' and ffmpeg_args[i + 1] not in ('panic', 'quiet', 'fatal'):
+                args += ffmpeg_args[i:i + 2]
+            i += 2
+            continue
+        if arg not in ('-stats', '-nostats'):
+            args.append(arg)
+        i += 1
+    if '-loglevel' not in args and '-v' not in args:
+        args[1:1] = ['-loglevel', 'error']
+    args[1:1] = ['-progress', 'pipe:1', '-nostats']
+    return args
+
+
+def _parse_time(value):
+    try:
+        hours, minutes, seconds = value.split(':')
+        return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    except ValueError:
+        return None
+
+
+class FFMPEGProgress:
+    """
+    Parses the key=value lines ffmpeg writes with '-progress'. Each block of lines ends with 'progress=continue' (or
+    'progress=end'), when feed() returns a summary of that block.
+
+    :param duration_secs: duration of the source, to estimate the time remaining.
+    """
+
+    def __init__(self, duration_secs=None):
+        self.duration_secs = duration_secs
+        self.block = {}
+        self.latest = None
+
+    def feed(self, line):
+        key, _, value = line.strip().partition('=')
+        if not key:
+            return None
+        self.block[key] = value.strip()
+        if key != 'progress':
+            return None
+        block, self.block = self.block, {}
+
+        out_time = None
+        if block.get('out_time_us', 'N/A').isdigit():
+            out_time = int(block['out_time_us']) / 1e6
+        elif 'out_time' in block:
+            out_time = _parse_time(block['out_time'])
+        try:
+            speed = float(block.get('speed', '').rstrip('x'))
+        except ValueError:
+            speed = None
+        try:
+            fps = float(block.get('fps', ''))
+        except ValueError:
+            fps = None
+
+        progress = {
+            'frame': int(block['frame']) if block.get('frame', '').isdigit() else None,
+            'fps': fps,
+            'out_time_secs': out_time,
+            'speed': speed,
+            'eta_secs': None,
+            'percent': None,
+            'finished': block['progress'] == 'end',
+        }
+        if self.duration_secs and out_time is not None:
+            progress['percent'] = min(100.0, 100.0 * out_time / self.duration_secs)
+            if speed:
+                progress['eta_secs'] = max(0.0, (self.duration_secs - out_time) / speed)
+        self.latest = progress
+        return progress
+
+
+PROGRESS_GAUGES = {
+    'frame': ('transcoder_ffmpeg_frame', 'Frames encoded so far'),
+    'fps': ('transcoder_ffmpeg_fps', 'Frames encoded per second'),
+    'out_time_secs': ('transcoder_ffmpeg_out_time_seconds', 'Duration of the output encoded so far'),
+    'speed': ('transcoder_ffmpeg_speed', 'Encoding speed, as a multiple of real time'),
+    'eta_secs': ('transcoder_ffmpeg_eta_seconds', 'Estimated time until the encode finishes'),
+    'percent': ('transcoder_ffmpeg_progress_percent', 'Percentage of the source encoded so far'),
+}
+
+
+def _record_progress(progress, job_name):
+    for key, (name, help_text) in PROGRESS_GAUGES.items():
+        if progress[key] is not None:
+            metrics.set_gauge(name, progress[key], {'job': job_name}, help_text)
+    metrics.set_gauge('transcoder_ffmpeg_last_progress_timestamp_seconds', time.time(), {'job': job_name},
+                      'When ffmpeg last reported progress (to spot stalled encodes)')
+
+
+def run_ffmpeg(ffmpeg_args, duration_secs=None):
+    """
+    Run an ffmpeg command built with with_progress_args, logging its progress every
+    settings.FFMPEG_PROGRESS_LOG_INTERVAL seconds and publishing it as metrics (see lib/metrics.py).
+
+    :param duration_secs: duration of the source, to estimate the time remaining.
+    :raises FFMPEGError: including the end of ffmpeg's error output, if it fails.
+    :raises JobAborted: if the job is aborted (see lib/jobs.py), after killing ffmpeg.
+    """
+    job_name = current_job_name()
+    parser = FFMPEGProgress(duration_secs)
+    stderr_tail = collections.deque(maxlen=settings.FFMPEG_STDERR_LINES)
+    process = subprocess.Popen(
+        ffmpeg_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.DEVNULL,
+        universal_newlines=True, errors='replace',
+    )
+    stderr_reader = threading.Thread(
+        target=stderr_tail.extend, args=(process.stderr,), name='ffmpeg-stderr', daemon=True,
+    )
+    stderr_reader.start()
+
+    last_logged = time.monotonic()
+    try:
+        for line in process.stdout:
+            check_aborted()
+            progress = parser.feed(line)
+            if progress is None:
+                continue
+            _record_progress(progress, job_name)
+            if time.monotonic() - last_logged >= settings.FFMPEG_PROGRESS_LOG_INTERVAL or progress['finished']:
+                last_logged = time.monotonic()
+                logging.info('ffmpeg progress %s' % json.dumps(progress))
+        returncode = process.wait()
+        stderr_reader.join()
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        metrics.remove({'job': job_name})
+
+    result = 'success' if returncode == 0 else 'failure'
+    metrics.inc_counter('transcoder_ffmpeg_runs_total', {'result': result}, 'ffmpeg runs, by result')
+    if returncode != 0:
+        stderr = ''.join(stderr_tail)
+        logging.error('ffmpeg failed (exit status %d):\n%s' % (returncode, stderr))
+        raise FFMPEGError(returncode, ffmpeg_args, stderr=stderr)
+    return parser.latest
 
 
 def get_file_metadata(file_location):
@@ -69,25 +265,89 @@ def get_file_metadata(file_location):
     }
 
 
-def get_video_metadata(video_location):
+class ProbeCache:
     """
-    Use ffprobe to discern information about the video.
-
-    :param video_location: URL or Path to video file. URLs that 30x redirect to a file are OK.
-    :return: Dictionary of attributes.
+    Remembers ffprobe's output, and the metadata derived from it, for files by their identity (see
+    lib.fixity.file_identity), in memory and in a small SQLite database. A file that hasn't changed doesn't need to be
+    probed again, e.g. when a failed job is re-run.
     """
 
+    def __init__(self, db_path=None):
+        self.db_path = db_path
+        self._memory = {}
+        self._lock = threading.Lock()
+        self._db = None
+        self._db_failed = False
+
+    def _connect(self):
+        if self._db is None and self.db_path and not self._db_failed:
+            try:
+                os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+                self._db = sqlite3.connect(self.db_path, check_same_thread=False)
+                self._db.execute(
+                    'CREATE TABLE IF NOT EXISTS probes ('
+                    'device INTEGER, inode INTEGER, size INTEGER, mtime_ns INTEGER, probe TEXT, metadata TEXT, '
+                    'path TEXT, updated REAL, PRIMARY KEY (device, inode, size, mtime_ns))'
+                )
+                self._db.commit()
+            except sqlite3.Error as e:
+                logging.warning('Probe cache %s unavailable, only caching in memory: %s' % (self.db_path, e))
+                self._db = None
+                self._db_failed = True
+        return self._db
+
+    def get(self, identity):
+        """
+        :return: (raw ffprobe output, metadata) or None
+        """
+        with self._lock:
+            cached = self._memory.get(identity)
+            if cached is None and self._connect():
+                row = self._db.execute(
+                    'SELECT probe, metadata FROM probes WHERE device = ? AND inode = ? AND size = ? AND mtime_ns = ?',
+                    identity,
+                ).fetchone()
+                if row:
+                    cached = self._memory[identity] = (json.loads(row[0]), json.loads(row[1]))
+            return cached
+
+    def put(self, identity, probe, metadata, path=None):
+        with self._lock:
+            self._memory[identity] = (probe, metadata)
+            if self._connect():
+                self._db.execute(
+                    'INSERT OR REPLACE INTO probes VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    identity + (json.dumps(probe), json.dumps(metadata, default=str), path, time.time()),
+                )
+                self._db.commit()
+
+
+probe_cache = ProbeCache(settings.PROBE_CACHE_PATH)
+
+
+def probe_video(video_location):
+    """
+    Run ffprobe on a video.
 
+    :return: ffprobe's JSON output, parsed.
+    """
     ffprobe_args = ["ffprobe", "-v", "quiet", "-print_format", "json", "-show_format", "-show_streams", video_location]
     try:
         command = " ".join(ffprobe_args)
         logging.info("Running %s" % command)
         cmd = subprocess.run(ffprobe_args, stdout=subprocess.PIPE, check=True)
         out = cmd.stdout
-        m = json.loads(out.decode('utf-8'))
+        return json.loads(out.decode('utf-8'))
     except subprocess.CalledProcessError as e:
         raise FFMPEGError(e.returncode, ffprobe_args) from e
 
+
+def metadata_from_probe(video_location, probe):
+    """
+    Discern information about the video from ffprobe's output. Doesn't include the checksum.
+    """
+    m = dict(probe)
+
     # put the first stream of each type in the top-level, for straightforward property access via e.g. j['video']['width']
     for stream in m['streams']:
         if stream['codec_type'] not in m:
@@ -111,9 +371,6 @@ def get_video_metadata(video_location):
 
     _, ext = os.path.splitext(video_location)
 
-    with open('%s.md5' % video_location) as checksum_file:
-        checksum = checksum_file.read()
-
     duration_hms = seconds_to_hms(
         float(m['format'].get('duration', 0.0)),
         always_include_hours=True,
@@ -143,23 +400,89 @@ def get_video_metadata(video_location):
         'audio_sample_rate': int(m_audio.get('sample_rate', 0)) or None,
         'audio_bit_rate': int(m_audio.get('bit_rate', 0)) or None,
         'audio_max_bit_rate': int(m_audio.get('max_bit_rate', 0)) or None,
-        'checksum': checksum,
     }
 
 
-# Mini lib for network-concurrency-friendly locking/unlocking a file by writing adjacent '.lock' files.
+def get_video_probe(video_location):
+    """
+    ffprobe's output for a video, and the metadata derived from it, from the probe cache if the file hasn't changed.
+
+    :return: (probe, metadata)
+    """
+    identity = file_identity(video_location)
+    cached = probe_cache.get(identity)
+    if cached is not None:
+        return cached
+    probe = probe_video(video_location)
+    metadata = metadata_from_probe(video_location, probe)
+    probe_cache.put(identity, probe, metadata, path=video_location)
+    return probe, metadata
+
+
+def get_checksum(video_location):
+    """
+    The md5 of a file from the checksum cache, or else from its '.md5' file. Never hashes the file.
+    """
+    checksum = checksum_cache.get(file_identity(video_location))
+    if checksum is None:
+        with open('%s.md5' % video_location) as checksum_file:
+            checksum = checksum_file.read()
+    return checksum
+
+
+@timed('get_video_metadata')
+def get_video_metadata(video_location):
+    """
+    Use ffprobe to discern information about the video. Unchanged files aren't probed again.
+
+    :param video_location: Path to video file.
+    :return: Dictionary of attributes.
+    """
+    _, metadata = get_video_probe(video_location)
+    metadata = dict(metadata)
+    metadata['checksum'] = get_checksum(video_location)
+    return metadata
+
+
+def get_videos_metadata(video_locations):
+    """
+    Bulk version of get_video_metadata. Files that aren't in the probe cache are probed concurrently, up to
+    settings.PROBE_CONCURRENCY at a time.
+
+    :return: {video_location: metadata}
+    """
+    with ThreadPoolExecutor(max_workers=settings.PROBE_CONCURRENCY, thread_name_prefix='ffprobe') as executor:
+        return dict(zip(video_locations, executor.map(get_video_metadata, video_locations)))
+
+
+_scan_indexes = {}
+_scan_indexes_lock = threading.Lock()
+
+
+# Mini lib for network-concurrency-friendly locking/unlocking a file with adjacent '.lock' files. The lock files are
+# leases (see lib/lease.py), so nodes sharing the watch folder can't claim the same file, and the files claimed by a
+# node that has stopped are picked up again by the others.
 
 def _lockfile(filepath):
     return "%s.lock" % filepath
 
 def is_locked(filepath):
-    return os.path.exists(_lockfile(filepath))
+    return leases.is_locked(_lockfile(filepath))
 
-def lock(filepath):
-    Path(_lockfile(filepath)).touch()
+def lock(filepath, permanent=False, resume=False):
+    """
+    Try to take the lease on filepath. Returns whether we got it. See LeaseManager.acquire.
+    """
+    return leases.acquire(_lockfile(filepath), permanent=permanent, resume=resume)
 
 def unlock(filepath):
-    os.remove(_lockfile(filepath))
+    leases.release(_lockfile(filepath))
+
+def lease_lost_event(filepath):
+    """
+    A threading.Event that is set if the lease on filepath is lost to another node.
+    """
+    return leases.lost_event(_lockfile(filepath))
 
 def restricted_file(filepath):
     """
@@ -173,38 +496,78 @@ def restricted_file(filepath):
     return restricted
 
 
-def find_video_file(source_folder, lock_files=True):
-    # generate all the video paths in the source folder
+def is_video_file(filepath):
+    return os.path.splitext(filepath)[-1] in VIDEO_MIME_TYPES
+
+
+def try_lock_video_file(filepath, lock_files=True):
+    """
+    Lock a video file for processing. Returns False if it is restricted, already locked, or no longer exists.
+    """
+    # make sure the file still exists, in case another thread is running and deleted it
+    if not os.path.exists(filepath):
+        return False
+    if restricted_file(filepath):
+        lock(filepath, permanent=True)
+        return False
+    if lock_files:
+        return lock(filepath)
+    return True
+
+
+def _is_indexed_file(filename):
+    return is_video_file(filename) or (filename.endswith('.lock') and is_video_file(filename[:-len('.lock')]))
+
+
+def _get_scan_index(source_folder):
     source_folder = os.path.abspath(os.path.expanduser(source_folder))
-    for dirpath, dirnames, filenames in os.walk(source_folder, followlinks=True):
-        for file in filenames:
-            if os.path.splitext(file)[-1] in list(VIDEO_MIME_TYPES.keys()):
-                filepath = os.path.join(dirpath, file)
-                # make sure the file still exists, in case another thread is running and deleted it
-                if not os.path.exists(filepath):
-                    continue
-                if restricted_file(filepath):
-                    lock(filepath)
-                    continue
-                if lock_files:
-                    if not is_locked(filepath):
-                        lock(filepath)
-                        return filepath
-                else:
-                    return filepath
+    with _scan_indexes_lock:
+        if source_folder not in _scan_indexes:
+            _scan_indexes[source_folder] = ScanIndex(source_folder, _is_indexed_file, settings.SCAN_INDEX_PATH)
+        return _scan_indexes[source_folder]
+
+
+def find_video_files(source_folder):
+    """
+    Return every unlocked video file in source_folder, in the order os.walk would find them.
+
+    Uses a persistent ScanIndex, so only folders that have changed since the last scan are listed again, and files are
+    known to be unlocked from the folder listing rather than by checking for each '.lock' file. Files whose lease has
+    expired are included, so they can be reclaimed. Restricted files are locked (once, permanently) so they are left
+    alone from then on.
+    """
+    candidates = []
+    for dirpath, filenames in _get_scan_index(source_folder).scan().items():
+        indexed_filenames = set(filenames)
+        for filename in filenames:
+            if not is_video_file(filename):
+                continue
+            filepath = os.path.join(dirpath, filename)
+            # the lease of a locked file is only read if it is there, and may have expired
+            if _lockfile(filename) in indexed_filenames and is_locked(filepath):
+                continue
+            if restricted_file(filepath):
+                lock(filepath, permanent=True)
+                continue
+            candidates.append(filepath)
+    return candidates
+
+
+def find_video_file(source_folder, lock_files=True):
+    for filepath in find_video_files(source_folder):
+        if try_lock_video_file(filepath, lock_files):
+            return filepath
 
 
 def write_metadata_summary_entry(file_metadata):
     """
-    Write an entry in the summary csv file containing metadata from a processed video
+    Record an entry in the metadata catalogue containing metadata from a processed video.
+    Entries are written in batches; see flush_metadata_summary.
     :param file_metadata: the video's metadata
-    :param folder: the folder where the csv file is/will be saved
     :return: None
     """
-    metadata_file_path = os.path.join(settings.OUTPUT_FOLDER, '%s_metadata.csv' % datetime.today().strftime("%Y%m%d"))
-    metadata_file_exists = os.path.isfile(metadata_file_path)
-    with open(metadata_file_path, 'a') as metadata_csv:
-        metadata_csv_writer = csv.DictWriter(metadata_csv, fieldnames=METADATA_CSV_HEADERS)
-        if not metadata_file_exists:
-            metadata_csv_writer.writeheader()
-        metadata_csv_writer.writerow(file_metadata)
+    catalogue.add(file_metadata)
+
+
+def flush_metadata_summary():
+    catalogue.flush()
@@ -1,10 +1,88 @@
+import errno
 import hashlib
+import json
 import logging
+import mmap
 import os
+import queue
+import random
 import shutil
+import sqlite3
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import settings
+from lib.perf import timed
+
+
+def file_identity(path):
+    """
+    (device, inode, size, mtime_ns) of a file. If none of these have changed, neither has the file's contents.
+    """
+    stat = os.stat(path)
+    return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+class ChecksumCache:
+    """
+    Remembers the checksums of files by their identity (see file_identity), in memory and in a small SQLite database,
+    so that a file that provably hasn't changed doesn't have to be read again to get its checksum.
+    """
+
+    def __init__(self, db_path=None):
+        self.db_path = db_path
+        self._memory = {}
+        self._lock = threading.Lock()
+        self._db = None
+        self._db_failed = False
+
+    def _connect(self):
+        if self._db is None and self.db_path and not self._db_failed:
+            try:
+                os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+                self._db = sqlite3.connect(self.db_path, check_same_thread=False)
+                self._db.execute(
+                    'CREATE TABLE IF NOT EXISTS checksums ('
+                    'device INTEGER, inode INTEGER, size INTEGER, mtime_ns INTEGER, algorithm TEXT, digest TEXT, '
+                    'path TEXT, updated REAL, PRIMARY KEY (device, inode, size, mtime_ns, algorithm))'
+                )
+                self._db.execute(
+                    'DELETE FROM checksums WHERE updated < ?',
+                    (time.time() - settings.CHECKSUM_CACHE_MAX_AGE_DAYS * 24 * 3600,),
+                )
+                self._db.commit()
+            except sqlite3.Error as e:
+                logging.warning('Checksum cache %s unavailable, only caching in memory: %s' % (self.db_path, e))
+                self._db = None
+                self._db_failed = True
+        return self._db
+
+    def get(self, identity, algorithm='md5'):
+        with self._lock:
+            digest = self._memory.get((identity, algorithm))
+            if digest is None and self._connect():
+                row = self._db.execute(
+                    'SELECT digest FROM checksums '
+                    'WHERE device = ? AND inode = ? AND size = ? AND mtime_ns = ? AND algorithm = ?',
+                    identity + (algorithm,),
+                ).fetchone()
+                if row:
+                    digest = self._memory[(identity, algorithm)] = row[0]
+            return digest
+
+    def put(self, identity, digest, algorithm='md5', path=None):
+        with self._lock:
+            self._memory[(identity, algorithm)] = digest
+            if self._connect():
+                self._db.execute(
+                    'INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    identity + (algorithm, digest, path, time.time()),
+                )
+                self._db.commit()
+
+
+checksum_cache = ChecksumCache(settings.CHECKSUM_CACHE_PATH)
 
 
 def post_move_filename(source_file, dest):
@@ -28,23 +106,419 @@ def post_move_filename(source_file, dest):
         return os.path.join(dest, source_filename)
 
 
-def generate_file_md5(filename, blocksize=2 ** 20, store=False):
-    m = hashlib.md5()
-    with open(os.path.join(filename), "rb") as f:
+def fixity_algorithms(algorithms=None):
+    """
+    The digests to compute: settings.FIXITY_ALGORITHMS by default. md5 is always included, since it's the checksum the
+    rest of the pipeline (XOS, the metadata summaries) uses.
+    """
+    algorithms = list(algorithms or settings.FIXITY_ALGORITHMS)
+    if 'md5' not in algorithms:
+        algorithms.insert(0, 'md5')
+    return algorithms
+
+
+def store_digest(filename, algorithm, digest):
+    with open("%s.%s" % (filename, algorithm), "w") as f:
+        f.write(digest)
+
+
+def store_md5(filename, digest):
+    store_digest(filename, 'md5', digest)
+
+
+def sidecar_paths(filename):
+    """
+    The checksum files (e.g. '.md5', '.sha256') next to a file.
+    """
+    return ["%s.%s" % (filename, algorithm) for algorithm in fixity_algorithms()
+            if os.path.exists("%s.%s" % (filename, algorithm))]
+
+
+def drop_cached_pages(f, offset=0, length=0):
+    """
+    Ask the kernel to drop (part of) a file from the page cache, so that streaming huge masters doesn't evict
+    everything else, and so that a verification read comes from the disk rather than from memory.
+    """
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(f.fileno(), offset, length, os.POSIX_FADV_DONTNEED)
+        except OSError:
+            pass  # not supported by this filesystem
+
+
+def read_blocks(path, blocksize=None, queue_depth=None, drop_cache=None, start=0):
+    """
+    Read a file in blocks on a separate thread, yielding them in order. Up to queue_depth blocks are read ahead, so
+    reading overlaps with whatever the caller does with each block (e.g. hashing and writing it somewhere else).
+    If drop_cache, pages are dropped from the page cache as soon as they've been read.
+    Reading begins at byte `start`.
+    """
+    blocksize = blocksize or settings.FIXITY_BLOCK_SIZE
+    if drop_cache is None:
+        drop_cache = settings.FIXITY_DROP_CACHE
+    blocks = queue.Queue(maxsize=queue_depth or settings.FIXITY_QUEUE_DEPTH)
+    stop_event = threading.Event()
+
+    def put(item):
+        while not stop_event.is_set():
+            try:
+                blocks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def reader():
+        try:
+            with open(path, 'rb') as f:
+                f.seek(start)
+                offset = start
+                while not stop_event.is_set():
+                    buf = f.read(blocksize)
+                    put(buf)
+                    if not buf:
+                        break
+                    if drop_cache:
+                        drop_cached_pages(f, offset, len(buf))
+                    offset += len(buf)
+        except Exception as e:
+            put(e)
+
+    thread = threading.Thread(target=reader, name='read-ahead', daemon=True)
+    thread.start()
+    try:
         while True:
-            buf = f.read(blocksize)
+            buf = blocks.get()
+            if isinstance(buf, Exception):
+                raise buf
             if not buf:
-                break
-            m.update(buf)
-    digest = m.hexdigest()
+                return
+            yield buf
+    finally:
+        stop_event.set()
+        thread.join()
+
+
+def mmap_blocks(path, blocksize=None, drop_cache=None):
+    """
+    Like read_blocks, but yields memoryviews of a memory-mapped file instead of copying it into buffers. Each block is
+    only valid until the next one is requested.
+    """
+    blocksize = blocksize or settings.FIXITY_BLOCK_SIZE
+    if drop_cache is None:
+        drop_cache = settings.FIXITY_DROP_CACHE
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if hasattr(mapped, 'madvise'):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+            view = memoryview(mapped)
+            try:
+                for offset in range(0, size, blocksize):
+                    block = view[offset:offset + blocksize]
+                    try:
+                        yield block
+                    finally:
+                        block.release()
+                    if drop_cache:
+                        drop_cached_pages(f, offset, blocksize)
+            finally:
+                view.release()
+
+
+def consume_blocks(blocks, consumers):
+    """
+    Pass every block to every consumer (e.g. hash objects' update methods and a file's write method). With more than
+    one consumer, each block is consumed on several threads at once: hashlib and file writes release the GIL, so e.g.
+    md5 and sha256 each get a core of their own.
+    """
+    if len(consumers) == 1:
+        consumer = consumers[0]
+        for block in blocks:
+            consumer(block)
+        return
+
+    with ThreadPoolExecutor(max_workers=len(consumers), thread_name_prefix='fixity') as executor:
+        for block in blocks:
+            for future in [executor.submit(consumer, block) for consumer in consumers]:
+                future.result()
+
+
+def hash_file(filename, algorithms=None, blocksize=None, store=False, use_cache=True, use_mmap=None):
+    """
+    Compute one or more digests of a file in a single pass.
+
+    :param algorithms: hashlib algorithm names, e.g. ['md5', 'sha256', 'blake2b']. Defaults to
+        settings.FIXITY_ALGORITHMS.
+    :param store: write a sidecar checksum file (e.g. 'master.mov.sha256') for each algorithm.
+    :param use_cache: return cached digests if the file hasn't changed since it was last hashed. Pass use_cache=False
+        where fixity needs the file to actually be read again.
+    :param use_mmap: read the file through mmap rather than read-ahead buffers. Defaults to settings.FIXITY_USE_MMAP.
+    :return: {algorithm: hex digest}
+    """
+    algorithms = fixity_algorithms(algorithms)
+    if use_mmap is None:
+        use_mmap = settings.FIXITY_USE_MMAP
+    identity = file_identity(filename)
+
+    digests = {}
+    if use_cache:
+        for algorithm in algorithms:
+            digest = checksum_cache.get(identity, algorithm)
+            if digest is not None:
+                digests[algorithm] = digest
+
+    missing_algorithms = [algorithm for algorithm in algorithms if algorithm not in digests]
+    if missing_algorithms:
+        hashers = {algorithm: hashlib.new(algorithm) for algorithm in missing_algorithms}
+        if use_mmap:
+            blocks = mmap_blocks(filename, blocksize)
+        else:
+            blocks = read_blocks(filename, blocksize)
+        consume_blocks(blocks, [hasher.update for hasher in hashers.values()])
+        for algorithm, hasher in hashers.items():
+            digests[algorithm] = hasher.hexdigest()
+            checksum_cache.put(identity, digests[algorithm], algorithm, path=filename)
 
     if store:
-        f = open("%s.md5" % filename, "w")
-        f.write(digest)
+        for algorithm in algorithms:
+            store_digest(filename, algorithm, digests[algorithm])
 
-    return digest
+    return digests
 
 
+@timed('generate_file_md5', size_of_arg=0)
+def generate_file_md5(filename, blocksize=None, store=False, use_cache=True):
+    """
+    Return the md5 of a file. Any other settings.FIXITY_ALGORITHMS are computed (and stored) in the same pass.
+    """
+    return hash_file(filename, blocksize=blocksize, store=store, use_cache=use_cache)['md5']
+
+
+def cached_digests(identity, algorithms=None):
+    """
+    The cached digests of a file for every algorithm, or None unless all of them are cached.
+    """
+    digests = {}
+    for algorithm in fixity_algorithms(algorithms):
+        digests[algorithm] = checksum_cache.get(identity, algorithm)
+        if digests[algorithm] is None:
+            return None
+    return digests
+
+
+def _copy_file_range(source, destination, offset, count):
+    return os.copy_file_range(source.fileno(), destination.fileno(), count, offset, offset)
+
+
+def _sendfile(source, destination, offset, count):
+    destination.seek(offset)
+    return os.sendfile(destination.fileno(), source.fileno(), offset, count)
+
+
+def _buffered_copy(source, destination, offset, count):
+    source.seek(offset)
+    destination.seek(offset)
+    buf = source.read(min(count, settings.FIXITY_BLOCK_SIZE))
+    destination.write(buf)
+    return len(buf)
+
+
+def retry_delay(retries):
+    """
+    Seconds to wait before retry number `retries`: exponential backoff from settings.RETRY_BASE_WAIT up to
+    settings.RETRY_WAIT, with jitter so that several jobs hitting the same blip don't all retry at once.
+    """
+    delay = min(settings.RETRY_WAIT, settings.RETRY_BASE_WAIT * 2 ** (retries - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def _copy_hashers(hashers):
+    return {algorithm: hasher.copy() for algorithm, hasher in hashers.items()}
+
+
+class ResumableCopy:
+    """
+    Copies a file to destination_path + '.part', checkpointing every settings.FIXITY_CHECKPOINT_SIZE bytes.
+
+    If copy() fails, calling it again carries on from the last checkpoint rather than from byte zero. Checkpoints are
+    also saved next to the '.part' file, so a copy interrupted by a restart is resumed from the last chunk of the
+    '.part' file that can still be verified.
+
+    Digests of the source are computed from the same buffers that are written to the destination. If the source's
+    digests are already known (known_digests), the copy is done by the kernel instead (see kernel_copy_range), without
+    reading the data into this process.
+    """
+
+    def __init__(self, source_path, destination_path, algorithms=None, known_digests=None):
+        self.source_path = source_path
+        self.destination_path = destination_path
+        self.part_path = destination_path + '.part'
+        self.checkpoint_path = self.part_path + '.json'
+        self.algorithms = fixity_algorithms(algorithms)
+        self.known_digests = known_digests
+        self.source_identity = file_identity(source_path)
+        self._reset()
+        self._resume_from_checkpoint_file()
+
+    def _reset(self):
+        self.offset = 0
+        # (size, md5) of each checkpointed chunk, so a '.part' file left by an earlier process can be verified
+        self.chunks = []
+        self.hashers = {algorithm: hashlib.new(algorithm) for algorithm in self.algorithms}
+        self._checkpointed_hashers = _copy_hashers(self.hashers)
+
+    def discard(self):
+        for path in [self.part_path, self.checkpoint_path]:
+            if os.path.exists(path):
+                os.remove(path)
+        self._reset()
+
+    def _resume_from_checkpoint_file(self):
+        try:
+            with open(self.checkpoint_path) as f:
+                checkpoint = json.load(f)
+        except (OSError, ValueError):
+            return
+        if checkpoint.get('source_path') != self.source_path \
+                or tuple(checkpoint.get('source_identity', ())) != self.source_identity \
+                or checkpoint.get('algorithms') != self.algorithms \
+                or checkpoint.get('kernel_copy') != bool(self.known_digests) \
+                or not os.path.exists(self.part_path):
+            logging.info("Discarding out of date partial copy %s." % self.part_path)
+            self.discard()
+            return
+
+        if self.known_digests:
+            # the kernel copied it, so there are no chunk digests to check. The final verification catches any damage.
+            self.offset = checkpoint['offset']
+        else:
+            # rebuild the digests' state from the chunks of the '.part' file that still match what was copied
+            with open(self.part_path, 'rb') as part:
+                for size, chunk_md5 in checkpoint['chunks']:
+                    chunk_hasher = hashlib.md5()
+                    remaining = size
+                    while remaining:
+                        buf = part.read(min(remaining, settings.FIXITY_BLOCK_SIZE))
+                        if not buf:
+                            break
+                        chunk_hasher.update(buf)
+                        for hasher in self.hashers.values():
+                            hasher.update(buf)
+                        remaining -= len(buf)
+                    if remaining or chunk_hasher.hexdigest() != chunk_md5:
+                        self.hashers = _copy_hashers(self._checkpointed_hashers)
+                        break
+                    self.offset += size
+                    self.chunks.append([size, chunk_md5])
+                    self._checkpointed_hashers = _copy_hashers(self.hashers)
+
+    def _checkpoint(self, destination, chunk_size, chunk_md5):
+        destination.flush()
+        os.fsync(destination.fileno())
+        self.offset += chunk_size
+        self.chunks.append([chunk_size, chunk_md5])
+        self._checkpointed_hashers = _copy_hashers(self.hashers)
+        tmp_path = self.checkpoint_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'source_path': self.source_path,
+                'source_identity': self.source_identity,
+                'algorithms': self.algorithms,
+                'kernel_copy': bool(self.known_digests),
+                'offset': self.offset,
+                'chunks': self.chunks,
+            }, f)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def copy(self):
+        """
+        Copy (the rest of) the source into the '.part' file.
+
+        :return: {algorithm: hex digest} of the source.
+        """
+        if self.offset:
+            logging.info("Resuming fixity copy of %s at byte %d." % (self.source_path, self.offset))
+        try:
+            with open(self.part_path, 'r+b' if os.path.exists(self.part_path) else 'wb') as destination:
+                # anything after the last checkpoint may not have been written properly
+                destination.truncate(self.offset)
+                destination.seek(self.offset)
+                if self.known_digests:
+                    self._kernel_copy(destination)
+                else:
+                    self._stream_copy(destination)
+                destination.flush()
+                os.fsync(destination.fileno())
+                drop_cached_pages(destination)
+        except Exception:
+            # carry on from the last checkpoint next time
+            self.hashers = _copy_hashers(self._checkpointed_hashers)
+            raise
+
+        shutil.copymode(self.source_path, self.part_path)
+        if self.known_digests:
+            return dict(self.known_digests)
+        return {algorithm: hasher.hexdigest() for algorithm, hasher in self.hashers.items()}
+
+    def _stream_copy(self, destination):
+        chunk_hasher = hashlib.md5()
+        chunk_size = 0
+        consumers = [hasher.update for hasher in self.hashers.values()] + [chunk_hasher.update, destination.write]
+        blocks = read_blocks(self.source_path, start=self.offset)
+        with ThreadPoolExecutor(max_workers=len(consumers), thread_name_prefix='fixity') as executor:
+            for buf in blocks:
+                for future in [executor.submit(consumer, buf) for consumer in consumers]:
+                    future.result()
+                chunk_size += len(buf)
+                if chunk_size >= settings.FIXITY_CHECKPOINT_SIZE:
+                    self._checkpoint(destination, chunk_size, chunk_hasher.hexdigest())
+                    chunk_hasher = hashlib.md5()
+                    chunk_size = 0
+                    consumers[-2] = chunk_hasher.update
+        if chunk_size:
+            self._checkpoint(destination, chunk_size, chunk_hasher.hexdigest())
+
+    def _kernel_copy(self, destination):
+        copy_methods = []
+        if hasattr(os, 'copy_file_range'):
+            copy_methods.append(_copy_file_range)
+        if hasattr(os, 'sendfile'):
+            copy_methods.append(_sendfile)
+        copy_methods.append(_buffered_copy)
+
+        with open(self.source_path, 'rb') as source:
+            size = os.fstat(source.fileno()).st_size
+            while self.offset < size:
+                chunk_size = min(size - self.offset, settings.FIXITY_CHECKPOINT_SIZE)
+                copied = 0
+                while copied < chunk_size:
+                    try:
+                        n = copy_methods[0](source, destination, self.offset + copied, chunk_size - copied)
+                    except OSError as e:
+                        # only try the next method if this one isn't supported here, not on real I/O errors
+                        if len(copy_methods) == 1 \
+                                or e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL):
+                            raise
+                        logging.info("%s not supported for %s." % (copy_methods[0].__name__, self.part_path))
+                        copy_methods.pop(0)
+                        continue
+                    if not n:
+                        raise IOError("Source %s ended early, at byte %d." % (self.source_path, self.offset + copied))
+                    copied += n
+                self._checkpoint(destination, chunk_size, None)
+
+    def finish(self):
+        """
+        Move the completed '.part' file into place, and forget the checkpoints.
+        """
+        os.rename(self.part_path, self.destination_path)
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+
+@timed('fixity_copy', size_of_arg=0)
 def fixity_copy(source_path, destination_path, store_md5s=True, is_move=False):
 
     if is_move:
@@ -53,19 +527,22 @@ def fixity_copy(source_path, destination_path, store_md5s=True, is_move=False):
         operation = "copy"
 
     logging.info("Fixity %s %s to %s." % (operation, source_path, destination_path))
-    # create md5 for source
-    md5_1 = generate_file_md5(source_path, store=store_md5s)
 
-    # do the copy
     destination_path = post_move_filename(source_path, destination_path)
     if os.path.exists(destination_path):
         raise IOError("Cannot %s: Destination %s already exists." % (operation, destination_path))
 
-    # when there is an error while copying the file, retry it for a set number of times before giving up
+    # do the copy. If we already know the source's checksums, the kernel copies it without us reading it; otherwise we
+    # create the checksums for the source as we go.
+    source_identity = file_identity(source_path)
+    copier = ResumableCopy(source_path, destination_path, known_digests=cached_digests(source_identity))
+
+    # when there is an error while copying the file, carry on from the last checkpoint for a set number of times before
+    # giving up
     retries = 0
     while True:
         try:
-            shutil.copy(source_path, destination_path)
+            source_digests = copier.copy()
             break
         except OSError as oserr:
             retries += 1
@@ -74,29 +551,146 @@ def fixity_copy(source_path, destination_path, store_md5s=True, is_move=False):
                               (settings.MOVE_RETRIES, operation, source_path, destination_path))
                 raise oserr
 
+            delay = retry_delay(retries)
             logging.warning("Error: %s" % oserr)
-            logging.warning("OSError while trying to fixity %s %s to %s. Sleeping to retry later..." %
-                          (operation, source_path, destination_path))
-            time.sleep(settings.RETRY_WAIT)
+            logging.warning("OSError while trying to fixity %s %s to %s. Retrying from byte %d in %ds..." %
+                          (operation, source_path, destination_path, copier.offset, delay))
+            time.sleep(delay)
+
+    if file_identity(source_path) != source_identity:
+        copier.discard()
+        raise IOError("Cannot %s: Source %s changed while it was being copied." % (operation, source_path))
 
-    # create md5 for destination
-    md5_2 = generate_file_md5(destination_path, store=store_md5s)
+    # if the source was hashed earlier (e.g. when the job started), check it hasn't changed since
+    for algorithm, digest in source_digests.items():
+        cached_digest = checksum_cache.get(source_identity, algorithm)
+        if cached_digest is not None and cached_digest != digest:
+            copier.discard()
+            raise IOError("%s of source %s doesn't match the %s it had when it was first hashed." %
+                          (algorithm.upper(), source_path, algorithm.upper()))
+        checksum_cache.put(source_identity, digest, algorithm, path=source_path)
+        if store_md5s:
+            store_digest(source_path, algorithm, digest)
 
-    if md5_1 == md5_2:
-        logging.info("Fixity %s complete." % operation)
-        return destination_path
+    # create checksums for destination. Its pages were dropped from the cache after the copy, so this reads it back
+    # from disk.
+    if settings.FIXITY_VERIFY_DESTINATION:
+        destination_digests = hash_file(copier.part_path, algorithms=list(source_digests), use_cache=False)
     else:
-        raise IOError("MD5 of source and destination files don't match.")
+        destination_digests = source_digests
+    if source_digests != destination_digests:
+        copier.discard()
+        raise IOError("Checksums of source and destination files don't match.")
 
+    copier.finish()
+    destination_identity = file_identity(destination_path)
+    for algorithm, digest in destination_digests.items():
+        checksum_cache.put(destination_identity, digest, algorithm, path=destination_path)
+        if store_md5s:
+            store_digest(destination_path, algorithm, digest)
+    logging.info("Fixity %s complete." % operation)
+    return destination_path
+
+
+
+# errors from os.link when the files aren't on the same filesystem as far as the kernel is concerned (e.g. different
+# bind mounts of it), or it doesn't support hard links (not all SMB servers do)
+LINK_UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.EPERM, errno.ENOTSUP, errno.EOPNOTSUPP}
+
+
+def same_filesystem(source_path, destination_path):
+    destination_folder = os.path.dirname(os.path.abspath(destination_path))
+    try:
+        return os.stat(source_path).st_dev == os.stat(destination_folder).st_dev
+    except OSError:
+        return False
+
+
+def rename_move(source_path, destination_path, store_md5s=True):
+    """
+    Move a file within one filesystem with a hard link and unlink, after checking the source still matches any
+    checksums recorded next to it. This doesn't touch the file's contents, so there is nothing to copy or compare.
+
+    :raises OSError: with an errno in LINK_UNSUPPORTED_ERRNOS if the file can't be hard linked to destination_path.
+    """
+    logging.info("Fixity move %s to %s (rename)." % (source_path, destination_path))
+    digests = hash_file(source_path)
+    for algorithm, digest in digests.items():
+        sidecar_path = "%s.%s" % (source_path, algorithm)
+        if os.path.exists(sidecar_path):
+            with open(sidecar_path) as f:
+                if f.read().strip() != digest:
+                    raise IOError("%s of %s doesn't match %s." % (algorithm.upper(), source_path, sidecar_path))
+
+    # link then unlink, rather than checking the destination doesn't exist and renaming over it, so that a file another
+    # writer creates there in between isn't overwritten: the link fails instead
+    try:
+        os.link(source_path, destination_path)
+    except FileExistsError:
+        raise IOError("Cannot move: Destination %s already exists." % destination_path)
+    os.unlink(source_path)
+
+    for algorithm, digest in digests.items():
+        if store_md5s:
+            store_digest(destination_path, algorithm, digest)
+        if os.path.exists("%s.%s" % (source_path, algorithm)):
+            os.remove("%s.%s" % (source_path, algorithm))
+    logging.info("Fixity move complete.")
+    return destination_path
+
+
+def link_into_failsafe(source_path, failsafe_folder, store_md5s=True):
+    """
+    Hard link a file (and its checksums) into failsafe_folder, so that it is kept there when it is renamed rather than
+    copied into place. Returns whether it could be, i.e. whether failsafe_folder is on the same filesystem and it
+    supports hard links (not all SMB servers do).
+    """
+    failsafe_path = post_move_filename(source_path, failsafe_folder)
+    if not same_filesystem(source_path, failsafe_path):
+        return False
+    try:
+        for path in [source_path] + (sidecar_paths(source_path) if store_md5s else []):
+            link_path = failsafe_path + path[len(source_path):]
+            if os.path.exists(link_path):
+                os.remove(link_path)
+            os.link(path, link_path)
+    except OSError as e:
+        logging.info("Couldn't hard link %s into %s (%s), so it will be copied." % (source_path, failsafe_folder, e))
+        return False
+    return True
+
+
+def unlink_from_failsafe(source_path, failsafe_folder):
+    failsafe_path = post_move_filename(source_path, failsafe_folder)
+    for path in [source_path] + sidecar_paths(source_path):
+        link_path = failsafe_path + path[len(source_path):]
+        if os.path.exists(link_path) and os.path.samefile(path, link_path):
+            os.remove(link_path)
 
 
 def fixity_move(source_path, destination_path, store_md5s=True, failsafe_folder=None):
     """
-    Move a file from source to destination, checking md5s of both match.
+    Move a file from source to destination, checking checksums of both match.
 
-    If failsafe_folder is given, the file (and md5) are (non-fixity) moved to that folder, rather than deleted.
+    If failsafe_folder is given, the file (and checksums) are (non-fixity) moved to that folder, rather than deleted.
     NB that files already in the failsafe will be overwritten by this process.
+
+    A move within one filesystem is done without copying (see rename_move). If there is a failsafe_folder on that
+    filesystem too, the file is hard linked into it first.
     """
+    if same_filesystem(source_path, post_move_filename(source_path, destination_path)) and \
+            (not failsafe_folder or link_into_failsafe(source_path, failsafe_folder, store_md5s)):
+        try:
+            return rename_move(source_path, post_move_filename(source_path, destination_path), store_md5s)
+        except OSError as e:
+            if e.errno not in LINK_UNSUPPORTED_ERRNOS:
+                raise
+            logging.info("Couldn't hard link %s to %s (%s), so it will be copied." % (
+                source_path, destination_path, e))
+            # the failsafe links have to go, or moving the file into the failsafe below would leave it where it is
+            if failsafe_folder:
+                unlink_from_failsafe(source_path, failsafe_folder)
+
     dest_path = fixity_copy(source_path, destination_path, store_md5s, is_move=True)
 
     if dest_path: # move completed successfully
@@ -106,10 +700,13 @@ def fixity_move(source_path, destination_path, store_md5s=True, failsafe_folder=
             # produces an input/output error. Likely a Docker+Python bug)
             shutil.move(source_path, failsafe_path, copy_function=shutil.copy)
             if store_md5s:
-                shutil.move("%s.md5" % source_path, "%s.md5" % failsafe_path, copy_function=shutil.copy)
+                for sidecar_path in sidecar_paths(source_path):
+                    shutil.move(sidecar_path, failsafe_path + sidecar_path[len(source_path):],
+                                copy_function=shutil.copy)
         else: # delete the original(!)
             os.remove(source_path)
             if store_md5s:
-                os.remove("%s.md5" % source_path)
+                for sidecar_path in sidecar_paths(source_path):
+                    os.remove(sidecar_path)
 
     return dest_path
@@ -0,0 +1,216 @@
+"""
+Run the transcoding pipeline for several master files at the same time.
+
+Each worker thread claims its own master (via the '.lock' files in lib/ffmpeg.py), runs the whole pipeline on it, then
+looks for the next one. Log records are tagged with the name of the job that logged them, and can also be written to a
+separate log file per job.
+"""
+
+import logging
+import os
+import re
+import signal
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import settings
+
+LOG_FORMAT = '%(asctime)s: %(levelname)s - [%(job)s] %(message)s'
+LOG_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+_job_context = threading.local()
+_claim_lock = threading.Lock()
+
+
+class JobAborted(Exception):
+    pass
+
+
+def current_job_name():
+    return getattr(_job_context, 'name', 'main')
+
+
+def current_job_id():
+    """
+    The full path of the master the job running in this thread is for. Unlike its name, this is unique among running
+    jobs (two masters in different folders can share a filename).
+    """
+    return getattr(_job_context, 'job_id', None) or current_job_name()
+
+
+def set_abort_event(event):
+    """
+    Abort the job running in this thread (and the threads it runs functions in, via in_current_job) once event is set,
+    e.g. when the lease on its master is lost.
+    """
+    _job_context.abort_event = event
+
+
+def job_aborted():
+    event = getattr(_job_context, 'abort_event', None)
+    return event is not None and event.is_set()
+
+
+def check_aborted():
+    """
+    :raises JobAborted: if the job running in this thread has been aborted.
+    """
+    if job_aborted():
+        raise JobAborted('%s was aborted.' % current_job_name())
+
+
+def in_current_job(function):
+    """
+    Wrap function so that, when it's run in another thread (e.g. by a ThreadPoolExecutor), its log records are tagged
+    with (and written to the log file of) the job that wrapped it, and it sees when that job is aborted.
+    """
+    job_name = current_job_name()
+    job_id = getattr(_job_context, 'job_id', None)
+    abort_event = getattr(_job_context, 'abort_event', None)
+
+    def run_in_job(*args, **kwargs):
+        previous_name = getattr(_job_context, 'name', None)
+        previous_job_id = getattr(_job_context, 'job_id', None)
+        previous_abort_event = getattr(_job_context, 'abort_event', None)
+        _job_context.name = job_name
+        _job_context.job_id = job_id
+        _job_context.abort_event = abort_event
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _job_context.name = previous_name if previous_name is not None else threading.current_thread().name
+            _job_context.job_id = previous_job_id
+            _job_context.abort_event = previous_abort_event
+    return run_in_job
+
+
+class JobLogFilter(logging.Filter):
+    """
+    Tag log records with the name of the job running in the current thread.
+    If job_name is given, only let through records from that job.
+    """
+
+    def __init__(self, job_name=None):
+        super().__init__()
+        self.job_name = job_name
+
+    def filter(self, record):
+        record.job = current_job_name()
+        return self.job_name is None or record.job == self.job_name
+
+
+def configure_logging(level=logging.INFO):
+    logging.basicConfig(format=LOG_FORMAT, datefmt=LOG_DATE_FORMAT, level=level)
+    for handler in logging.getLogger().handlers:
+        if not any(isinstance(f, JobLogFilter) for f in handler.filters):
+            handler.addFilter(JobLogFilter())
+
+
+@contextmanager
+def job_logging(source_file_path):
+    """
+    Name the job running in this thread after its master file, and if settings.JOB_LOG_FOLDER is set, copy its log
+    records into a log file of its own.
+    """
+    job_name = os.path.basename(source_file_path)
+    _job_context.name = job_name
+    _job_context.job_id = os.path.abspath(source_file_path)
+
+    handler = None
+    if settings.JOB_LOG_FOLDER:
+        log_filename = '%s_%s.log' % (datetime.now().strftime('%Y%m%d-%H%M%S'), re.sub(r'[^\w.-]', '_', job_name))
+        handler = logging.FileHandler(os.path.join(settings.JOB_LOG_FOLDER, log_filename))
+        handler.setFormatter(logging.Formatter(LOG_FORMAT, datefmt=LOG_DATE_FORMAT))
+        handler.addFilter(JobLogFilter(job_name))
+        logging.getLogger().addHandler(handler)
+
+    try:
+        yield job_name
+    finally:
+        if handler:
+            logging.getLogger().removeHandler(handler)
+            handler.close()
+        _job_context.name = threading.current_thread().name
+        _job_context.job_id = None
+        _job_context.abort_event = None
+
+
+def install_shutdown_handlers(stop_event):
+    """
+    Stop claiming new jobs on SIGTERM/SIGINT. Jobs that are already running are left to finish.
+    """
+    def handle_signal(signum, frame):
+        logging.warning('Received signal %s. Finishing running jobs before shutting down...' % signum)
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+
+def _wait_for_work(work_event, stop_event, timeout):
+    if work_event is None:
+        stop_event.wait(timeout)
+        return
+    deadline = time.monotonic() + timeout
+    while not stop_event.is_set():
+        remaining = deadline - time.monotonic()
+        # wake up at least every second to check for shutdown
+        if remaining <= 0 or work_event.wait(min(1, remaining)):
+            return
+
+
+def _worker(claim_job, run_job, idle_wait, stop_event, work_event):
+    _job_context.name = threading.current_thread().name
+    while not stop_event.is_set():
+        # claiming is serialised so that two workers in this process can't lock the same file
+        try:
+            with _claim_lock:
+                source_file_path = claim_job()
+        except Exception:
+            # e.g. the watch mount dropping out, which mustn't end this worker
+            logging.exception('Unhandled error while looking for a master to process')
+            _wait_for_work(work_event, stop_event, idle_wait)
+            continue
+        if not source_file_path:
+            _wait_for_work(work_event, stop_event, idle_wait)
+            continue
+        with job_logging(source_file_path):
+            try:
+                run_job(source_file_path)
+            except Exception:
+                logging.exception('Unhandled error while processing %s' % source_file_path)
+
+
+def run_worker_pool(claim_job, run_job, concurrency=1, idle_wait=3600, stop_event=None, work_event=None):
+    """
+    Run `concurrency` workers until stop_event is set (by default on SIGTERM/SIGINT).
+
+    :param claim_job: callable returning the path of a newly claimed (locked) master, or None if there is nothing to
+        do.
+    :param run_job: callable that runs the whole pipeline for a claimed master path.
+    :param idle_wait: seconds an idle worker waits before looking for work again.
+    :param work_event: optional threading.Event that is set when there may be new work, e.g. Watcher.files_available.
+        Idle workers wake up as soon as it is set, rather than waiting the whole idle_wait.
+    """
+    if stop_event is None:
+        stop_event = threading.Event()
+        install_shutdown_handlers(stop_event)
+
+    workers = [
+        threading.Thread(
+            target=_worker,
+            args=(claim_job, run_job, idle_wait, stop_event, work_event),
+            name='worker-%d' % (i + 1),
+        )
+        for i in range(max(1, concurrency))
+    ]
+    logging.info('Starting %d transcoding worker(s).' % len(workers))
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        # join in short steps so the main thread stays responsive to signals
+        while worker.is_alive():
+            worker.join(timeout=1)
+    logging.info('All transcoding workers stopped.')
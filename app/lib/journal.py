@@ -0,0 +1,147 @@
+"""
+A crash-safe journal of how far each job has got, so a restarted transcoder carries on where it left off.
+
+Each master being processed has a small JSON file in settings.JOURNAL_FOLDER. When a step of the pipeline completes,
+it is recorded there along with what it produced (checksums, metadata, output paths, the XOS asset ID), and the file is
+replaced atomically. On startup, jobs with a journal are resumed at their first incomplete step, so e.g. a transcode
+that has already been fixity moved into place is never run again. The journal is removed once the job has finished.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+from datetime import datetime
+
+import settings
+
+# the steps of the pipeline in easyaccess.process_video_file, in order
+STEPS = [
+    'hash',
+    'xos_stub',
+    'transcode',
+    'master_move',
+    'access_upload',
+    'web_upload',
+    'xos_update',
+]
+
+
+def journal_path(source_file_path, journal_folder=None):
+    journal_folder = journal_folder or settings.JOURNAL_FOLDER
+    source_file_path = os.path.abspath(source_file_path)
+    name = re.sub(r'[^\w.-]', '_', os.path.basename(source_file_path))
+    # masters in different folders can have the same name
+    path_hash = hashlib.sha1(source_file_path.encode('utf-8', 'surrogateescape')).hexdigest()[:12]
+    return os.path.join(journal_folder, '%s.%s.json' % (name, path_hash))
+
+
+class JobJournal:
+    """
+    The journal of one job, keyed by the path of its master in the watch folder.
+    """
+
+    def __init__(self, source_file_path, journal_folder=None):
+        self.source_file_path = os.path.abspath(source_file_path)
+        self.path = journal_path(source_file_path, journal_folder)
+        self.data = None
+        try:
+            with open(self.path) as f:
+                self.data = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logging.warning('Could not read job journal %s (%s). Starting the job from the beginning.' % (
+                self.path, e))
+        self.resumed = self.data is not None
+        if self.data is None:
+            self.data = {
+                'source': self.source_file_path,
+                'started_at': datetime.now().isoformat(),
+                'steps': {},
+            }
+        elif self.next_step():
+            logging.info('Resuming %s at step "%s".' % (self.source_file_path, self.next_step()))
+
+    def completed(self, step):
+        return step in self.data['steps']
+
+    def artifacts(self, step):
+        """
+        What the step recorded when it completed, or None if it hasn't.
+        """
+        return self.data['steps'].get(step)
+
+    def next_step(self):
+        for step in STEPS:
+            if not self.completed(step):
+                return step
+        return None
+
+    def complete(self, step, **artifacts):
+        """
+        Record that a step has completed, along with what it produced. Values must be serialisable as JSON (other
+        values, e.g. datetimes, are stored as strings).
+        """
+        artifacts['completed_at'] = datetime.now().isoformat()
+        self.data['steps'][step] = artifacts
+        self.data.pop('failure', None)
+        self._save()
+        return artifacts
+
+    def failed(self, step, exception):
+        self.data['failure'] = {
+            'step': step,
+            'error': str(exception),
+            'failed_at': datetime.now().isoformat(),
+        }
+        try:
+            self._save()
+        except OSError as e:
+            logging.warning('Could not record the failure in job journal %s: %s' % (self.path, e))
+
+    def finish(self):
+        """
+        Remove the journal of a job that has finished.
+        """
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = '%s.%s.tmp' % (self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(self.data, f, indent=2, default=str)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        # make the rename itself durable
+        dir_fd = os.open(os.path.dirname(self.path), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+def unfinished_jobs(journal_folder=None):
+    """
+    The master paths of jobs that have a journal, i.e. that were interrupted, oldest first.
+    """
+    journal_folder = journal_folder or settings.JOURNAL_FOLDER
+    try:
+        filenames = [filename for filename in os.listdir(journal_folder) if filename.endswith('.json')]
+    except FileNotFoundError:
+        return []
+
+    journals = []
+    for filename in filenames:
+        try:
+            with open(os.path.join(journal_folder, filename)) as f:
+                data = json.load(f)
+            journals.append((data['started_at'], data['source']))
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning('Ignoring unreadable job journal %s: %s' % (filename, e))
+    return [source for _, source in sorted(journals)]
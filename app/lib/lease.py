@@ -0,0 +1,233 @@
+"""
+Leases on master files, so several transcoder hosts can share one watch folder.
+
+A lease is a '.lock' file created with O_CREAT|O_EXCL, which only one host can do, holding the owner's ID, host, PID,
+a nonce unique to the process, and expiry time. Owners renew their leases from a heartbeat thread. A lease that has
+expired (because its owner crashed or lost the share) can be reclaimed by any other node. A node resuming the jobs its
+previous process was interrupted in (see lib/journal.py) takes over that process's leases, i.e. ones with its owner ID
+but another nonce, rather than waiting for them to expire. Otherwise, leases are only told apart by their owner ID and
+nonce: the host and PID are for people reading them, and may be the same for different processes (e.g. containers).
+
+A lease found to be held by someone else when it is renewed is lost: its lost_event() is set, so that the job holding
+it can stop (see lib/jobs.py).
+
+Lock files without an expiry, i.e. empty ones from older versions and the permanent ones on restricted files, never
+expire and have to be deleted by hand.
+"""
+
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime
+
+import settings
+
+
+def read_lease(lockfile):
+    """
+    The contents of a lease, {} if it has no (readable) contents, or None if there isn't one.
+    """
+    try:
+        with open(lockfile) as f:
+            contents = f.read()
+    except FileNotFoundError:
+        return None
+    try:
+        lease = json.loads(contents)
+    except ValueError:
+        # an empty lock file, or a lease that is still being written
+        return {}
+    return lease if isinstance(lease, dict) else {}
+
+
+def lease_expired(lease, now=None):
+    if lease is None:
+        return True
+    expires_at = lease.get('expires_at')
+    return expires_at is not None and expires_at < (now or time.time())
+
+
+class LeaseManager:
+    """
+    Acquires, renews and releases the leases held by this process.
+
+    :param owner: ID of this node (settings.NODE_ID). Leases held by a previous process with the same owner ID can be
+        taken over when resuming its jobs, rather than waited out.
+    :param duration: seconds a lease lasts without being renewed. Leases are renewed every third of that.
+    """
+
+    def __init__(self, owner=None, duration=None):
+        self.owner = owner or settings.NODE_ID
+        self.duration = duration or settings.LEASE_DURATION
+        self.host = socket.gethostname()
+        self.pid = os.getpid()
+        self.nonce = uuid.uuid4().hex
+        self._held = set()
+        # {lockfile: threading.Event set if the lease is lost}
+        self._lost_events = {}
+        self._lock = threading.Lock()
+        self._heartbeat = None
+        self._stop_event = threading.Event()
+
+    def _lease(self, permanent=False):
+        return {
+            'owner': self.owner,
+            'host': self.host,
+            'pid': self.pid,
+            'nonce': self.nonce,
+            'acquired_at': datetime.now().isoformat(),
+            'expires_at': None if permanent else time.time() + self.duration,
+        }
+
+    def _create(self, lockfile, permanent=False):
+        try:
+            fd = os.open(lockfile, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return False
+        try:
+            os.write(fd, json.dumps(self._lease(permanent)).encode())
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        return True
+
+    def _takeover_allowed(self, lease, resume=False):
+        if lease_expired(lease):
+            return True
+        # left behind by a previous process on this node
+        return resume and lease.get('owner') == self.owner and lease.get('nonce') != self.nonce \
+            and lease.get('expires_at') is not None
+
+    def _reclaim(self, lockfile, stale_lease):
+        """
+        Replace a stale lease with our own, by compare-and-replace: move the lease to a name no one else uses, and only
+        create ours if what we moved is the stale lease we read. If another node had already replaced it, we put theirs
+        back. If a third node created a lease in the meantime, theirs is kept, and the node we moved the lease from
+        finds it lost when it next renews it.
+        """
+        reclaim_path = '%s.%s.reclaim' % (lockfile, uuid.uuid4().hex)
+        try:
+            os.rename(lockfile, reclaim_path)
+        except FileNotFoundError:
+            return False
+        if read_lease(reclaim_path) != stale_lease:
+            try:
+                os.link(reclaim_path, lockfile)
+            except FileExistsError:
+                pass
+            except OSError:
+                # no hard links (e.g. some SMB servers)
+                if not os.path.exists(lockfile):
+                    os.rename(reclaim_path, lockfile)
+            if os.path.exists(reclaim_path):
+                os.remove(reclaim_path)
+            return False
+        os.remove(reclaim_path)
+        logging.warning('Reclaiming lease %s from %s on %s.' % (
+            lockfile, stale_lease.get('owner'), stale_lease.get('host')))
+        return self._create(lockfile)
+
+    def acquire(self, lockfile, permanent=False, resume=False):
+        """
+        Try to take the lease. Returns whether we now hold it.
+
+        :param permanent: the lease never expires, and isn't renewed (e.g. for restricted files).
+        :param resume: we are resuming a job our previous process was interrupted in, so take over its lease. Another
+            process with the same owner ID (e.g. a container with the same hostname) may hold the lease instead, so
+            this is only for jobs our previous process journalled.
+        """
+        with self._lock:
+            if lockfile in self._held:
+                return False
+        acquired = self._create(lockfile, permanent)
+        if not acquired:
+            lease = read_lease(lockfile)
+            if lease is None:
+                # released between our attempt and reading it
+                acquired = self._create(lockfile, permanent)
+            elif self._takeover_allowed(lease, resume):
+                acquired = self._reclaim(lockfile, lease)
+        if acquired and not permanent:
+            with self._lock:
+                self._held.add(lockfile)
+                self._lost_events[lockfile] = threading.Event()
+            self._start_heartbeat()
+        return acquired
+
+    def lost_event(self, lockfile):
+        """
+        A threading.Event that is set if the lease is lost to another node while we hold it.
+        """
+        with self._lock:
+            return self._lost_events.setdefault(lockfile, threading.Event())
+
+    def is_locked(self, lockfile):
+        lease = read_lease(lockfile)
+        return lease is not None and not lease_expired(lease)
+
+    def release(self, lockfile):
+        with self._lock:
+            self._held.discard(lockfile)
+            self._lost_events.pop(lockfile, None)
+        lease = read_lease(lockfile)
+        if lease is None:
+            return
+        if lease.get('owner') not in (None, self.owner):
+            logging.warning('Not releasing lease %s: it is now held by %s on %s.' % (
+                lockfile, lease.get('owner'), lease.get('host')))
+            return
+        os.remove(lockfile)
+
+    def renew(self, lockfile):
+        """
+        Extend a lease we hold. Returns False (stops renewing it, and sets its lost_event) if it has been lost to
+        another node.
+        """
+        lease = read_lease(lockfile)
+        if lease is None or lease.get('owner') != self.owner or lease.get('nonce') != self.nonce:
+            logging.error('Lost lease %s. It is now held by %s.' % (lockfile, lease and lease.get('owner')))
+            with self._lock:
+                self._held.discard(lockfile)
+                self._lost_events.setdefault(lockfile, threading.Event()).set()
+            return False
+        lease['expires_at'] = time.time() + self.duration
+        tmp_path = '%s.%s.tmp' % (lockfile, self.nonce)
+        with open(tmp_path, 'w') as f:
+            json.dump(lease, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, lockfile)
+        return True
+
+    def renew_all(self):
+        with self._lock:
+            held = list(self._held)
+        for lockfile in held:
+            try:
+                self.renew(lockfile)
+            except OSError as e:
+                # keep trying until the lease expires; the share may be back by the next heartbeat
+                logging.warning('Could not renew lease %s: %s' % (lockfile, e))
+
+    def _start_heartbeat(self):
+        with self._lock:
+            if self._heartbeat is not None:
+                return
+            self._heartbeat = threading.Thread(target=self._run_heartbeat, name='lease-heartbeat', daemon=True)
+            self._heartbeat.start()
+
+    def _run_heartbeat(self):
+        while not self._stop_event.wait(self.duration / 3):
+            self.renew_all()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+
+
+leases = LeaseManager()
@@ -0,0 +1,101 @@
+"""
+A small in-process metrics registry, served in the Prometheus text format on settings.METRICS_PORT (if set), e.g.
+
+    curl http://localhost:9100/metrics
+"""
+
+import http.server
+import logging
+import threading
+
+import settings
+
+
+class Metrics:
+    """
+    Gauges and counters, keyed by name and a dict of labels.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # {name: (type, help)}
+        self._descriptions = {}
+        # {name: {labels tuple: value}}
+        self._values = {}
+
+    def _key(self, name, metric_type, help_text, labels):
+        self._descriptions.setdefault(name, (metric_type, help_text))
+        return tuple(sorted((labels or {}).items()))
+
+    def set_gauge(self, name, value, labels=None, help_text=''):
+        with self._lock:
+            key = self._key(name, 'gauge', help_text, labels)
+            self._values.setdefault(name, {})[key] = value
+
+    def inc_counter(self, name, labels=None, help_text='', amount=1):
+        with self._lock:
+            key = self._key(name, 'counter', help_text, labels)
+            values = self._values.setdefault(name, {})
+            values[key] = values.get(key, 0) + amount
+
+    def remove(self, labels):
+        """
+        Remove every gauge with these labels, e.g. those of a job that has finished.
+        """
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            for name, values in self._values.items():
+                if self._descriptions[name][0] == 'gauge':
+                    values.pop(key, None)
+
+    def get(self, name, labels=None):
+        with self._lock:
+            return self._values.get(name, {}).get(tuple(sorted((labels or {}).items())))
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name, values in sorted(self._values.items()):
+                metric_type, help_text = self._descriptions[name]
+                if help_text:
+                    lines.append('# HELP %s %s' % (name, help_text))
+                lines.append('# TYPE %s %s' % (name, metric_type))
+                for labels, value in sorted(values.items()):
+                    label_str = ','.join('%s="%s"' % (
+                        label, str(label_value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                        for label, label_value in labels)
+                    lines.append('%s%s %s' % (name, '{%s}' % label_str if label_str else '', value))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_metrics_server(port=None):
+    """
+    Serve the metrics from a background thread. Returns the server, or None if no port is configured.
+    """
+    port = settings.METRICS_PORT if port is None else port
+    if not port:
+        return None
+    server = http.server.ThreadingHTTPServer(('', port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logging.info('Serving metrics on port %d.' % server.server_port)
+    return server
@@ -0,0 +1,204 @@
+"""
+A cache of encoded outputs on a local scratch volume (settings.OUTPUT_CACHE_FOLDER), keyed by the master's checksum
+and a hash of the ffmpeg arguments the output was actually encoded with (e.g. after lib/scheduler.py has chosen a
+faster preset), so an output is only served for a profile that would encode it the same way.
+
+A master that is deposited again (under a new name, or after a failed job) is copied from the cache rather than
+encoded again. When the cache is over settings.OUTPUT_CACHE_MAX_SIZE, the least recently used outputs are removed.
+
+Inspect and purge it with:
+
+    python -m lib.output_cache list
+    python -m lib.output_cache purge --checksum 0123456789abcdef0123456789abcdef
+    python -m lib.output_cache purge --unused-days 30
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+import settings
+from lib.fixity import fixity_copy
+
+# options (each taking a value) that don't change what is encoded
+IGNORED_OPTIONS = {'-threads'}
+
+
+def profile_hash(ffmpeg_args):
+    """
+    A hash of an ffmpeg argument list (e.g. settings.ACCESS_FFMPEG_ARGS), without the options that don't change the
+    output.
+    """
+    args = []
+    skip_value = False
+    for arg in ffmpeg_args:
+        if skip_value:
+            skip_value = False
+        elif arg in IGNORED_OPTIONS:
+            skip_value = True
+        else:
+            args.append(arg)
+    return hashlib.sha256(json.dumps(args).encode()).hexdigest()
+
+
+class OutputCache:
+    """
+    Encoded outputs in a folder, indexed in a small SQLite database there with when each was last used.
+    """
+
+    def __init__(self, folder=None, max_size=None):
+        self.folder = folder
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._db = None
+
+    @property
+    def enabled(self):
+        return bool(self.folder)
+
+    def _connect(self):
+        if self._db is None:
+            os.makedirs(self.folder, exist_ok=True)
+            self._db = sqlite3.connect(os.path.join(self.folder, 'index.sqlite'), check_same_thread=False)
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS outputs ('
+                'checksum TEXT, profile_hash TEXT, path TEXT, size INTEGER, source TEXT, profile TEXT, '
+                'created REAL, last_used REAL, PRIMARY KEY (checksum, profile_hash))'
+            )
+            self._db.commit()
+        return self._db
+
+    def get(self, checksum, ffmpeg_args):
+        """
+        The path of the cached output of this master with this profile, or None.
+        """
+        key = (checksum, profile_hash(ffmpeg_args))
+        with self._lock:
+            row = self._connect().execute(
+                'SELECT path FROM outputs WHERE checksum = ? AND profile_hash = ?', key,
+            ).fetchone()
+            if row is None:
+                return None
+            if not os.path.exists(row[0]):
+                self._db.execute('DELETE FROM outputs WHERE checksum = ? AND profile_hash = ?', key)
+                self._db.commit()
+                return None
+            self._db.execute(
+                'UPDATE outputs SET last_used = ? WHERE checksum = ? AND profile_hash = ?', (time.time(),) + key,
+            )
+            self._db.commit()
+            return row[0]
+
+    def put(self, checksum, ffmpeg_args, output_path, source=None):
+        """
+        Fixity copy an output into the cache, then remove the least recently used outputs if the cache is too big.
+
+        :return: the path of the cached copy.
+        """
+        key = (checksum, profile_hash(ffmpeg_args))
+        _, extension = os.path.splitext(output_path)
+        cache_path = os.path.join(self.folder, checksum[:2], '%s-%s%s' % (checksum, key[1][:16], extension))
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        if os.path.exists(cache_path):
+            # e.g. left behind by a put that was interrupted before it was indexed
+            os.remove(cache_path)
+        fixity_copy(output_path, cache_path, store_md5s=False)
+        now = time.time()
+        with self._lock:
+            self._connect().execute(
+                'INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                key + (cache_path, os.path.getsize(cache_path), source, json.dumps(ffmpeg_args), now, now),
+            )
+            self._db.commit()
+        self.evict()
+        return cache_path
+
+    def entries(self, checksum=None):
+        query = 'SELECT checksum, profile_hash, path, size, source, created, last_used FROM outputs'
+        params = ()
+        if checksum:
+            query += ' WHERE checksum = ?'
+            params = (checksum,)
+        columns = ['checksum', 'profile_hash', 'path', 'size', 'source', 'created', 'last_used']
+        with self._lock:
+            rows = self._connect().execute(query + ' ORDER BY last_used DESC', params).fetchall()
+        return [dict(zip(columns, row)) for row in rows]
+
+    def total_size(self):
+        with self._lock:
+            return self._connect().execute('SELECT COALESCE(SUM(size), 0) FROM outputs').fetchone()[0]
+
+    def _remove(self, entries):
+        with self._lock:
+            for entry in entries:
+                if os.path.exists(entry['path']):
+                    os.remove(entry['path'])
+                self._connect().execute(
+                    'DELETE FROM outputs WHERE checksum = ? AND profile_hash = ?',
+                    (entry['checksum'], entry['profile_hash']),
+                )
+            self._db.commit()
+        return len(entries)
+
+    def evict(self, max_size=None):
+        """
+        Remove the least recently used outputs until the cache is no bigger than max_size bytes. Returns how many were
+        removed.
+        """
+        max_size = self.max_size if max_size is None else max_size
+        excess = self.total_size() - max_size
+        evicted = []
+        for entry in reversed(self.entries()):
+            if excess <= 0:
+                break
+            evicted.append(entry)
+            excess -= entry['size']
+        if evicted:
+            logging.info('Removing %d least recently used output(s) from the output cache.' % len(evicted))
+        return self._remove(evicted)
+
+    def purge(self, checksum=None, unused_days=None):
+        """
+        Remove the outputs of one master, or those that haven't been used for unused_days, or else everything.
+        """
+        entries = self.entries(checksum)
+        if unused_days is not None:
+            entries = [entry for entry in entries if entry['last_used'] < time.time() - unused_days * 24 * 3600]
+        return self._remove(entries)
+
+
+output_cache = OutputCache(settings.OUTPUT_CACHE_FOLDER, settings.OUTPUT_CACHE_MAX_SIZE)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Inspect and purge the cache of encoded outputs.')
+    parser.add_argument('--folder', default=settings.OUTPUT_CACHE_FOLDER, help='the output cache folder')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    list_parser = subparsers.add_parser('list', help='print the cached outputs as JSON, most recently used first')
+    list_parser.add_argument('--checksum', help="only this master's outputs")
+    purge_parser = subparsers.add_parser('purge', help='remove cached outputs (all of them, unless filtered)')
+    purge_parser.add_argument('--checksum', help="only this master's outputs")
+    purge_parser.add_argument('--unused-days', type=float, help="only outputs that haven't been used for this long")
+    args = parser.parse_args(argv)
+
+    if not args.folder:
+        parser.error('The output cache is off: set OUTPUT_CACHE_FOLDER, or pass --folder.')
+    cache = OutputCache(args.folder, settings.OUTPUT_CACHE_MAX_SIZE)
+    if args.command == 'list':
+        entries = cache.entries(args.checksum)
+        print(json.dumps(entries, indent=2))
+        print('%d output(s), %.1f GB of %.1f GB' % (
+            len(entries), cache.total_size() / 1e9, settings.OUTPUT_CACHE_MAX_SIZE / 1e9), file=sys.stderr)
+    else:
+        print('Removed %d output(s).' % cache.purge(args.checksum, args.unused_days))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+"""
+Timing spans for the stages of a job, and for the expensive calls inside them (hashing, fixity copies, probing and
+ffmpeg), so a slow day can be put down to hashing, SMB copies, encoding, S3 or XOS.
+
+Each job writes one JSON line to settings.PERF_LOG_PATH when it finishes, listing its spans with their wall time,
+bytes processed and throughput. Summarise them across jobs with:
+
+    python -m lib.perf summary
+    python -m lib.perf summary --since 2020-10-01 --path /var/lib/transcoder/perf.jsonl
+"""
+
+import argparse
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import settings
+from lib.jobs import current_job_name
+
+_records = {}
+_records_lock = threading.Lock()
+
+
+class Span:
+
+    def __init__(self, name, bytes_processed=None):
+        self.name = name
+        self.bytes = bytes_processed
+        self.started = time.monotonic()
+        self.wall_secs = None
+
+    def as_dict(self):
+        span = {'name': self.name, 'wall_secs': round(self.wall_secs, 3)}
+        if self.bytes is not None:
+            span['bytes'] = self.bytes
+            span['mb_per_sec'] = round(self.bytes / 1e6 / self.wall_secs, 2) if self.wall_secs else None
+        return span
+
+
+class JobRecord:
+
+    def __init__(self, job_name, source_file_path):
+        self.job_name = job_name
+        self.source_file_path = source_file_path
+        self.started_at = datetime.now()
+        self.started = time.monotonic()
+        self.spans = []
+        self.lock = threading.Lock()
+        self.result = 'failed'
+
+    def as_dict(self):
+        with self.lock:
+            spans = [span.as_dict() for span in self.spans]
+        return {
+            'job': self.job_name,
+            'source': self.source_file_path,
+            'started_at': self.started_at.isoformat(),
+            'wall_secs': round(time.monotonic() - self.started, 3),
+            'result': self.result,
+            'node': settings.NODE_ID,
+            'spans': spans,
+        }
+
+
+@contextmanager
+def span(name, bytes_processed=None):
+    """
+    Time the enclosed block as part of the current job's record. The yielded Span's `bytes` can be set inside the
+    block, if they aren't known up front. Outside a job, nothing is recorded.
+    """
+    current = Span(name, bytes_processed)
+    try:
+        yield current
+    finally:
+        current.wall_secs = time.monotonic() - current.started
+        with _records_lock:
+            record = _records.get(current_job_name())
+        if record is not None:
+            with record.lock:
+                record.spans.append(current)
+
+
+def timed(name, size_of_arg=None):
+    """
+    Decorate a function to record a span each time it's called in a job.
+
+    :param size_of_arg: index of a file path argument whose size is the number of bytes processed.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            bytes_processed = None
+            if size_of_arg is not None:
+                try:
+                    bytes_processed = os.path.getsize(args[size_of_arg])
+                except (OSError, IndexError, TypeError):
+                    pass
+            with span(name, bytes_processed):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def job_record(source_file_path, path=None):
+    """
+    Collect the spans of the job running in this thread (and the stage threads it starts), and append its record to
+    the performance log when it finishes. Set the yielded record's `result` to 'finished' if the job succeeded.
+    """
+    job_name = current_job_name()
+    record = JobRecord(job_name, source_file_path)
+    with _records_lock:
+        _records[job_name] = record
+    try:
+        yield record
+    finally:
+        with _records_lock:
+            _records.pop(job_name, None)
+        write_record(record.as_dict(), path)
+
+
+def write_record(record, path=None):
+    path = path or settings.PERF_LOG_PATH
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+    except OSError as e:
+        logging.warning('Could not write the performance record to %s: %s' % (path, e))
+
+
+def read_records(path=None, since=None):
+    path = path or settings.PERF_LOG_PATH
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if since and record['started_at'] < since:
+                continue
+            yield record
+
+
+def percentile(values, percent):
+    """
+    The percentile of a sorted list, interpolating between the closest values.
+    """
+    if not values:
+        return None
+    position = (len(values) - 1) * percent / 100.0
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def summarise(records):
+    """
+    {span name: {'count', 'wall_secs': {p50, p90, p99, max}, 'mb_per_sec': {...}}} across records, including a 'job'
+    entry for whole jobs.
+    """
+    samples = {}
+    for record in records:
+        samples.setdefault('job', {'wall_secs': [], 'mb_per_sec': []})['wall_secs'].append(record['wall_secs'])
+        for job_span in record['spans']:
+            span_samples = samples.setdefault(job_span['name'], {'wall_secs': [], 'mb_per_sec': []})
+            span_samples['wall_secs'].append(job_span['wall_secs'])
+            if job_span.get('mb_per_sec') is not None:
+                span_samples['mb_per_sec'].append(job_span['mb_per_sec'])
+
+    summary = {}
+    for name, span_samples in samples.items():
+        summary[name] = {'count': len(span_samples['wall_secs'])}
+        for measure, values in span_samples.items():
+            if values:
+                values = sorted(values)
+                summary[name][measure] = {
+                    'p50': percentile(values, 50),
+                    'p90': percentile(values, 90),
+                    'p99': percentile(values, 99),
+                    'max': values[-1],
+                }
+    return summary
+
+
+def format_summary(summary):
+    lines = ['%-32s %6s %10s %10s %10s %10s %10s' % ('span', 'count', 'p50 s', 'p90 s', 'p99 s', 'max s', 'p50 MB/s')]
+    for name, stats in sorted(summary.items(), key=lambda item: -item[1]['wall_secs']['p50']):
+        wall = stats['wall_secs']
+        throughput = stats.get('mb_per_sec', {}).get('p50')
+        lines.append('%-32s %6d %10.1f %10.1f %10.1f %10.1f %10s' % (
+            name, stats['count'], wall['p50'], wall['p90'], wall['p99'], wall['max'],
+            '%.1f' % throughput if throughput is not None else '-',
+        ))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Summarise job performance records.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    summary_parser = subparsers.add_parser('summary', help='percentiles of each span across jobs')
+    summary_parser.add_argument('--path', default=settings.PERF_LOG_PATH, help='performance log to read')
+    summary_parser.add_argument('--since', help='only jobs started on or after this date, e.g. 2020-10-01')
+    summary_parser.add_argument('--json', action='store_true', help='print the summary as JSON')
+    args = parser.parse_args(argv)
+
+    summary = summarise(read_records(args.path, args.since))
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print(format_summary(summary))
+
+
+if __name__ == '__main__':
+    main()
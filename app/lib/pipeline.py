@@ -0,0 +1,114 @@
+"""
+Run the steps of a job as a graph of stages, so that steps that don't depend on each other run at the same time.
+
+For example, the master can be hashed and the XOS stub created while it is being transcoded, and the access file can be
+uploaded to S3 while the master is moved into the master folder. Stages run in threads: they spend their time waiting
+on I/O, or on an ffmpeg process.
+
+Each stage is checkpointed in the job's journal when it completes, and reports its own failure (to the log and Slack).
+The stages that depend on a failed stage are skipped, but the rest carry on. If the job is aborted (see lib/jobs.py),
+no more stages are started.
+"""
+
+import logging
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from lib.jobs import in_current_job, job_aborted
+from lib.perf import span
+from lib.slack import post_slack_exception
+
+
+class Stage:
+
+    def __init__(self, name, function, requires=(), error_message=None):
+        self.name = name
+        self.function = function
+        self.requires = list(requires)
+        self.error_message = error_message
+
+
+class Pipeline:
+    """
+    :param journal: optional lib.journal.JobJournal. Stages it records as completed aren't run again; their recorded
+        results are used instead.
+    """
+
+    def __init__(self, journal=None):
+        self.journal = journal
+        self.stages = {}
+        self.results = {}
+        self.failed = {}
+        self.skipped = set()
+
+    def add_stage(self, name, function, requires=(), error_message=None):
+        """
+        Add a stage to the pipeline.
+
+        :param function: callable taking the dict of results of completed stages, and returning a dict of this stage's
+            results (which must be serialisable as JSON, to be journalled).
+        :param requires: names of the stages that must complete before this one starts.
+        :param error_message: posted to Slack if the stage fails, formatted with the exception.
+        """
+        for requirement in requires:
+            if requirement not in self.stages:
+                raise ValueError('Stage %s requires unknown stage %s' % (name, requirement))
+        self.stages[name] = Stage(name, function, requires, error_message)
+
+    def _run_stage(self, stage):
+        try:
+            with span('stage:%s' % stage.name):
+                return stage.function(self.results) or {}
+        except Exception as e:
+            if stage.error_message:
+                post_slack_exception(stage.error_message % e)
+            else:
+                logging.exception('Stage %s failed' % stage.name)
+            raise
+
+    def _skip_dependents(self, name, pending):
+        for stage in list(pending):
+            if name in stage.requires and stage in pending:
+                logging.warning('Skipping %s, because %s did not complete.' % (stage.name, name))
+                pending.remove(stage)
+                self.skipped.add(stage.name)
+                self._skip_dependents(stage.name, pending)
+
+    def run(self):
+        """
+        Run every stage once its requirements have completed. Returns whether every stage completed.
+        """
+        pending = []
+        for stage in self.stages.values():
+            if self.journal is not None and self.journal.completed(stage.name):
+                self.results[stage.name] = self.journal.artifacts(stage.name)
+            else:
+                pending.append(stage)
+
+        running = {}
+        with ThreadPoolExecutor(max_workers=max(1, len(pending)), thread_name_prefix='stage') as executor:
+            while pending or running:
+                if job_aborted() and pending:
+                    logging.error('Job aborted. Not running %s.' % ', '.join(stage.name for stage in pending))
+                    self.skipped.update(stage.name for stage in pending)
+                    pending = []
+                for stage in list(pending):
+                    if all(requirement in self.results for requirement in stage.requires):
+                        pending.remove(stage)
+                        running[executor.submit(in_current_job(self._run_stage), stage)] = stage
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        self.failed[stage.name] = e
+                        if self.journal is not None:
+                            self.journal.failed(stage.name, e)
+                        self._skip_dependents(stage.name, pending)
+                        continue
+                    if self.journal is not None:
+                        result = self.journal.complete(stage.name, **result)
+                    self.results[stage.name] = result
+        return not self.failed and not self.skipped
@@ -0,0 +1,185 @@
+"""
+Copy masters that already meet an output profile into the access format, rather than encoding them again.
+
+Born-digital deposits are often already h264/yuv420p with AAC audio. Before encoding, the master's probed streams are
+checked against the constraints in the output's ffmpeg profile (e.g. settings.ACCESS_FFMPEG_ARGS or
+EXHIBITIONS_ACCESS_FFMPEG_ARGS). If they all hold, the streams are copied into a new MP4 with '+faststart', which
+takes minutes rather than hours.
+
+Only access copies are made this way. A web copy is meant to be a smaller proxy, which a copy of the master isn't.
+"""
+
+import logging
+import re
+
+import settings
+from lib.ffmpeg import get_video_probe, split_global_args
+
+# ffmpeg encoder names, and the codec ffprobe reports for what they write
+CODEC_NAMES = {
+    'libx264': 'h264',
+    'libx265': 'hevc',
+    'aac': 'aac',
+    'libfdk_aac': 'aac',
+}
+
+# per-output options that don't constrain the streams (they only affect how they would be encoded), or whose
+# constraints are checked by the bit rate (e.g. CBR's '-minrate' and '-nal-hrd')
+UNCONSTRAINING_OPTIONS = {'-preset', '-crf', '-threads', '-minrate', '-bufsize', '-nal-hrd'}
+
+
+def parse_bit_rate(value):
+    """
+    e.g. '320k' -> 320000
+    """
+    if value is None:
+        return None
+    multipliers = {'k': 1000, 'm': 1000000}
+    if value[-1].lower() in multipliers:
+        return int(float(value[:-1]) * multipliers[value[-1].lower()])
+    return int(value)
+
+
+def parse_frame_rate(value):
+    numerator, _, denominator = value.partition('/')
+    return float(numerator) / float(denominator or 1)
+
+
+def profile_constraints(ffmpeg_args):
+    """
+    What a master's streams must be for a copy of them to meet this ffmpeg profile, or None if the profile does
+    something to the streams that a copy can't (e.g. filters other than scaling and padding to a fixed size).
+    """
+    _, output_args = split_global_args(ffmpeg_args)
+    options = dict(zip(output_args[::2], output_args[1::2]))
+    constraints = {}
+    tolerance = settings.REMUX_BIT_RATE_TOLERANCE
+
+    for option, value in options.items():
+        if option in ('-c:v', '-vcodec'):
+            constraints['video_codec'] = CODEC_NAMES.get(value, value)
+        elif option in ('-c:a', '-acodec'):
+            constraints['audio_codec'] = CODEC_NAMES.get(value, value)
+        elif option == '-pix_fmt':
+            constraints['pix_fmt'] = value
+        elif option == '-ac':
+            constraints['audio_channels'] = int(value)
+        elif option == '-ar':
+            constraints['audio_sample_rate'] = int(value)
+        elif option in ('-ab', '-b:a'):
+            constraints['min_audio_bit_rate'] = parse_bit_rate(value) * (1 - tolerance)
+        elif option == '-r':
+            constraints['video_frame_rate'] = parse_frame_rate(value)
+        elif option == '-b:v':
+            constraints['min_video_bit_rate'] = parse_bit_rate(value) * (1 - tolerance)
+            constraints['max_video_bit_rate'] = parse_bit_rate(value) * (1 + tolerance)
+        elif option == '-maxrate':
+            constraints['max_video_bit_rate'] = parse_bit_rate(value) * (1 + tolerance)
+        elif option == '-vf':
+            # e.g. 'scale=1920:1080:force_original_aspect_ratio=decrease,pad=1920:1080:-1:-1:color=black'
+            size = re.fullmatch(r'scale=(\d+):(\d+)(:force_original_aspect_ratio=\w+)?(,pad=\1:\2[^,]*)?', value)
+            if not size:
+                return None
+            constraints['width'], constraints['height'] = int(size.group(1)), int(size.group(2))
+        elif option not in UNCONSTRAINING_OPTIONS:
+            return None
+
+    if 'video_codec' not in constraints:
+        return None
+    # a quality-based (e.g. '-crf') profile has no bit rate of its own
+    constraints.setdefault('max_video_bit_rate', settings.REMUX_MAX_VIDEO_BIT_RATE)
+    return constraints
+
+
+def conformance_problems(probe, metadata, constraints):
+    """
+    The ways a master (its ffprobe output, and the metadata lib.ffmpeg derives from it) doesn't meet constraints from
+    profile_constraints(). An empty list if it does.
+    """
+    video_streams = [stream for stream in probe['streams'] if stream['codec_type'] == 'video']
+    audio_streams = [stream for stream in probe['streams'] if stream['codec_type'] == 'audio']
+    if len(video_streams) != 1:
+        return ['has %d video streams' % len(video_streams)]
+    video = video_streams[0]
+
+    problems = []
+
+    def check(name, value, expected):
+        if value != expected:
+            problems.append('%s is %s, not %s' % (name, value, expected))
+
+    check('video codec', metadata['video_codec'], constraints['video_codec'])
+    if 'pix_fmt' in constraints:
+        check('pixel format', video.get('pix_fmt'), constraints['pix_fmt'])
+    if video.get('field_order', 'progressive') not in ('progressive', 'unknown'):
+        problems.append('video is interlaced (%s)' % video['field_order'])
+    for name in ('width', 'height'):
+        if name in constraints:
+            check(name, metadata[name], constraints[name])
+    frame_rate = constraints.get('video_frame_rate')
+    if frame_rate and abs(metadata['video_frame_rate'] - frame_rate) > 0.01:
+        problems.append('frame rate is %s, not %s' % (metadata['video_frame_rate'], frame_rate))
+
+    # not every container reports the video's own bit rate
+    video_bit_rate = metadata['video_bit_rate'] or metadata['overall_bit_rate']
+    if video_bit_rate is None:
+        problems.append('video bit rate is unknown')
+    else:
+        if video_bit_rate > constraints['max_video_bit_rate']:
+            problems.append('video bit rate %d is over %d' % (video_bit_rate, constraints['max_video_bit_rate']))
+        if video_bit_rate < constraints.get('min_video_bit_rate', 0):
+            problems.append('video bit rate %d is under %d' % (video_bit_rate, constraints['min_video_bit_rate']))
+
+    if audio_streams:
+        if len(audio_streams) > 1:
+            problems.append('has %d audio streams' % len(audio_streams))
+        if 'audio_codec' in constraints:
+            check('audio codec', metadata['audio_codec'], constraints['audio_codec'])
+        for name in ('audio_channels', 'audio_sample_rate'):
+            if name in constraints:
+                check(name.replace('_', ' '), metadata[name], constraints[name])
+        min_audio_bit_rate = constraints.get('min_audio_bit_rate', 0)
+        if (metadata['audio_bit_rate'] or 0) < min_audio_bit_rate:
+            problems.append('audio bit rate %s is under %d' % (metadata['audio_bit_rate'], min_audio_bit_rate))
+    return problems
+
+
+def access_profile(ffmpeg_args):
+    return ffmpeg_args in (settings.ACCESS_FFMPEG_ARGS, settings.EXHIBITIONS_ACCESS_FFMPEG_ARGS)
+
+
+def master_conforms(source_file_path, ffmpeg_args):
+    """
+    Whether the master can be copied, rather than encoded, to meet this ffmpeg profile (which must be an access one).
+    """
+    if not settings.REMUX_CONFORMING_MASTERS or not access_profile(ffmpeg_args):
+        return False
+    constraints = profile_constraints(ffmpeg_args)
+    if constraints is None:
+        return False
+    try:
+        probe, metadata = get_video_probe(source_file_path)
+    except Exception as e:
+        logging.warning("Couldn't probe %s to see whether it can be copied: %s" % (source_file_path, e))
+        return False
+    problems = conformance_problems(probe, metadata, constraints)
+    if problems:
+        logging.info("Encoding %s, as it doesn't meet the output profile: %s." % (
+            source_file_path, '; '.join(problems)))
+        return False
+    logging.info('%s already meets the output profile, so its streams will be copied.' % source_file_path)
+    return True
+
+
+def remux_command(source_file_path, output_path):
+    """
+    An ffmpeg command copying the master's video and first audio stream into output_path, with the index at the start
+    of the file so it can play while it downloads.
+    """
+    return [
+        'ffmpeg', '-loglevel', 'error', '-hide_banner', '-n',
+        '-i', source_file_path,
+        '-map', '0:v:0', '-map', '0:a:0?',
+        '-c', 'copy', '-movflags', '+faststart',
+        output_path,
+    ]
@@ -1,22 +1,102 @@
 import logging
 import os
+import threading
+import time
 
 import boto3
+from boto3.s3.transfer import TransferConfig
+
+import settings
 
 S3_BUCKET = os.environ['S3_BUCKET']
 S3_ACCESS_KEY = os.environ['S3_ACCESS_KEY']
 S3_SECRET_KEY = os.environ['S3_SECRET_KEY']
 S3_LOCATION = os.environ['S3_LOCATION']
+# e.g. a local MinIO server for development and testing
+S3_ENDPOINT_URL = os.getenv('S3_ENDPOINT_URL') or None
+
+
+class UploadProgress:
+    """
+    Log the progress of an upload every settings.S3_PROGRESS_INTERVAL seconds. boto3 calls this from each of the
+    threads uploading parts of the file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.size = os.path.getsize(path)
+        self.uploaded = 0
+        self.started = time.monotonic()
+        self.last_logged = self.started
+        self._lock = threading.Lock()
+
+    def __call__(self, bytes_transferred):
+        with self._lock:
+            self.uploaded += bytes_transferred
+            now = time.monotonic()
+            if now - self.last_logged < settings.S3_PROGRESS_INTERVAL and self.uploaded < self.size:
+                return
+            self.last_logged = now
+            elapsed = max(now - self.started, 0.001)
+            logging.info('Uploading %s to S3: %.1f%% of %.1f MB (%.1f MB/s)' % (
+                os.path.basename(self.path),
+                100.0 * self.uploaded / self.size if self.size else 100.0,
+                self.size / 1e6,
+                self.uploaded / elapsed / 1e6,
+            ))
+
+
+class S3Uploader:
+    """
+    Uploads files to S3 with one boto3 client, reused for every upload. Large files are uploaded in parts, several at a
+    time (settings.S3_MULTIPART_CHUNK_SIZE, S3_MAX_CONCURRENCY and S3_MAX_BANDWIDTH).
+
+    :param client: a boto3 S3 client, or anything with the same upload_file method. Created on first use if not given.
+    """
+
+    def __init__(self, client=None, bucket=S3_BUCKET, location=S3_LOCATION):
+        self.bucket = bucket
+        self.location = location
+        self._client = client
+        self._client_lock = threading.Lock()
+        self.transfer_config = TransferConfig(
+            multipart_threshold=settings.S3_MULTIPART_CHUNK_SIZE,
+            multipart_chunksize=settings.S3_MULTIPART_CHUNK_SIZE,
+            max_concurrency=settings.S3_MAX_CONCURRENCY,
+            max_bandwidth=settings.S3_MAX_BANDWIDTH or None,
+        )
+
+    @property
+    def client(self):
+        with self._client_lock:
+            if self._client is None:
+                self._client = boto3.client(
+                    's3',
+                    aws_access_key_id=S3_ACCESS_KEY,
+                    aws_secret_access_key=S3_SECRET_KEY,
+                    endpoint_url=S3_ENDPOINT_URL,
+                )
+            return self._client
+
+    def key(self, path):
+        return self.location + '/' + os.path.basename(path)
+
+    def upload(self, path):
+        """
+        Takes a relative or absolute path to a file and uploads it to s3. Returns the key it was uploaded to.
+        """
+        key = self.key(path)
+        self.client.upload_file(
+            path, self.bucket, key, Config=self.transfer_config, Callback=UploadProgress(path),
+        )
+        return key
+
+
+uploader = S3Uploader()
+
 
 def upload_to_s3(path):
     """
     Takes a relative or absolute path to a file and uploads it to s3.
     """
-    client = boto3.client(
-        's3',
-        aws_access_key_id=S3_ACCESS_KEY,
-        aws_secret_access_key=S3_SECRET_KEY
-    )
-
-    basename = os.path.basename(path)
-    client.upload_file(path, S3_BUCKET, S3_LOCATION+'/'+basename)
+    return uploader.upload(path)
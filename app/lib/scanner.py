@@ -0,0 +1,136 @@
+"""
+A persistent index of the watch folder, so finding the next video file doesn't mean re-listing the whole tree.
+
+Creating, removing or renaming a file (including a '.lock' file) updates the modification time of its folder, so a
+folder whose modification time hasn't changed since the last scan can be skipped with a single stat, and its contents
+taken from the index.
+
+That only holds once the folder's modification time has moved on from when it was listed: a file created just after
+the listing, within the same tick of the filesystem's (possibly coarse, e.g. on SMB) timestamps, leaves the
+modification time as it was. So, as with git's "racy" index entries, a folder modified within RACY_MTIME_SECS of being
+listed is listed again by the next scan.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+# how close to being listed a folder can have been modified, and still be listed again by the next scan. Allows for
+# coarse timestamps and some clock skew between an SMB server and us.
+RACY_MTIME_SECS = 5
+
+
+class ScanIndex:
+    """
+    Remembers the relevant files in every folder under root.
+
+    :param file_filter: callable taking a filename, returning whether the index should remember it.
+    :param index_path: optional JSON file the index is persisted to between restarts.
+    """
+
+    def __init__(self, root, file_filter, index_path=None):
+        self.root = os.path.abspath(os.path.expanduser(root))
+        self.file_filter = file_filter
+        self.index_path = index_path
+        # {dirpath: [mtime_ns, [subfolder names], [filenames], when it was listed (ns since the epoch)]}
+        self.folders = {}
+        # the folders listed again by the last scan
+        self.listed_folders = set()
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if not self.index_path:
+            return
+        try:
+            with open(self.index_path) as f:
+                self.folders = json.load(f).get(self.root, {})
+        except (OSError, ValueError):
+            self.folders = {}
+
+    def _save(self):
+        if not self.index_path:
+            return
+        try:
+            try:
+                with open(self.index_path) as f:
+                    indexes = json.load(f)
+            except (OSError, ValueError):
+                indexes = {}
+            indexes[self.root] = self.folders
+            os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+            tmp_path = '%s.%s.tmp' % (self.index_path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump(indexes, f)
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            logging.warning('Could not save the scan index to %s: %s' % (self.index_path, e))
+
+    def _list_folder(self, dirpath):
+        subfolders = []
+        filenames = []
+        with os.scandir(dirpath) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        subfolders.append(entry.name)
+                    elif self.file_filter(entry.name):
+                        filenames.append(entry.name)
+                except OSError:
+                    # moved or deleted while we were looking at it
+                    continue
+        return sorted(subfolders), sorted(filenames)
+
+    @staticmethod
+    def _racy(entry):
+        """
+        Whether a folder may have changed since it was listed without its modification time changing, i.e. it was
+        modified too close to when it was listed (or the entry is from before listing times were kept).
+        """
+        listed_ns = entry[3] if len(entry) > 3 else 0
+        return entry[0] >= listed_ns - RACY_MTIME_SECS * 10 ** 9
+
+    def scan(self):
+        """
+        Bring the index up to date, and return {dirpath: [filenames]} for every folder under root.
+        Only folders whose modification time has changed, or was too close to when they were listed to be trusted,
+        are listed again.
+        """
+        with self._lock:
+            folders = {}
+            listed_folders = set()
+            visited = set()
+            pending = [self.root]
+            while pending:
+                dirpath = pending.pop()
+                try:
+                    stat = os.stat(dirpath)
+                except OSError:
+                    continue
+                # follow symlinks like os.walk(followlinks=True), without going round in loops
+                if (stat.st_dev, stat.st_ino) in visited:
+                    continue
+                visited.add((stat.st_dev, stat.st_ino))
+
+                entry = self.folders.get(dirpath)
+                if entry is None or entry[0] != stat.st_mtime_ns or self._racy(entry):
+                    listed_ns = time.time_ns()
+                    try:
+                        subfolders, filenames = self._list_folder(dirpath)
+                    except OSError:
+                        continue
+                    entry = [stat.st_mtime_ns, subfolders, filenames, listed_ns]
+                    listed_folders.add(dirpath)
+                folders[dirpath] = entry
+                pending.extend(os.path.join(dirpath, subfolder) for subfolder in reversed(entry[1]))
+
+            changed = listed_folders or len(folders) != len(self.folders)
+            self.folders = folders
+            self.listed_folders = listed_folders
+            if changed:
+                logging.info('Scan index: listed %d of %d folders under %s.' % (
+                    len(listed_folders), len(folders), self.root))
+                self._save()
+            return {dirpath: entry[2] for dirpath, entry in folders.items()}
@@ -0,0 +1,162 @@
+"""
+Decide how many encoder threads each job gets, and how slow a preset it can afford.
+
+Left to itself, every libx264 encode starts a thread per core, so jobs running at the same time oversubscribe the CPU.
+Instead, the cores are shared between the jobs that are running or waiting (up to settings.CONCURRENT_JOBS).
+
+If settings.BACKLOG_TARGET_HOURS is set, the preset is also stepped within settings.ENCODE_PRESETS, to the slowest one
+that is predicted to encode this master and the queue behind it in that time. Predictions use the speed of the
+encodes this node has done so far, starting from settings.ENCODE_SPEED_ESTIMATE.
+
+Each decision is recorded in the job's metadata, as 'encode_schedule'.
+"""
+
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import settings
+
+# x264 presets, fastest first
+PRESETS = ['ultrafast', 'superfast', 'veryfast', 'faster', 'fast', 'medium', 'slow', 'slower', 'veryslow', 'placebo']
+
+# rough encoding speed of each preset, relative to veryslow. Only the ratios matter.
+PRESET_SPEEDS = {
+    'ultrafast': 35.0,
+    'superfast': 20.0,
+    'veryfast': 13.0,
+    'faster': 8.0,
+    'fast': 6.0,
+    'medium': 5.0,
+    'slow': 3.5,
+    'slower': 2.0,
+    'veryslow': 1.0,
+    'placebo': 0.3,
+}
+
+# weight of the latest encode in the moving averages of encoding speed and master duration
+SMOOTHING = 0.3
+
+
+def profile_preset(profiles):
+    """
+    The slowest x264 preset any of these ffmpeg profiles use, or None.
+    """
+    presets = [ffmpeg_args[ffmpeg_args.index('-preset') + 1] for ffmpeg_args in profiles if '-preset' in ffmpeg_args]
+    presets = [preset for preset in presets if preset in PRESETS]
+    return max(presets, key=PRESETS.index) if presets else None
+
+
+def allowed_presets(preset_range=None):
+    """
+    The presets in settings.ENCODE_PRESETS ('fastest,slowest'), fastest first.
+    """
+    fastest, _, slowest = (preset_range or settings.ENCODE_PRESETS).partition(',')
+    return PRESETS[PRESETS.index(fastest.strip()):PRESETS.index((slowest or fastest).strip()) + 1]
+
+
+class EncodeScheduler:
+    """
+    :param speed: media seconds encoded per second by the whole node at the veryslow preset, until it has been
+        measured.
+    """
+
+    def __init__(self, cpu_count=None, concurrent_jobs=None, target_hours=None, preset_range=None, speed=None):
+        self.cpu_count = cpu_count or os.cpu_count() or 1
+        self.concurrent_jobs = concurrent_jobs or settings.CONCURRENT_JOBS
+        self.target_hours = settings.BACKLOG_TARGET_HOURS if target_hours is None else target_hours
+        self.presets = allowed_presets(preset_range)
+        self.speed = speed or settings.ENCODE_SPEED_ESTIMATE
+        self.average_duration = None
+        self.active_jobs = 0
+        self._lock = threading.Lock()
+
+    def plan(self, profiles, duration_secs, queue_depth):
+        """
+        Decide the threads and preset for encoding a master of duration_secs with each of profiles (ffmpeg argument
+        lists, e.g. settings.ACCESS_FFMPEG_ARGS) in one ffmpeg run, with queue_depth masters waiting behind it.
+
+        :return: the decision, as a dict.
+        """
+        with self._lock:
+            if duration_secs:
+                if self.average_duration is None:
+                    self.average_duration = duration_secs
+                else:
+                    self.average_duration += SMOOTHING * (duration_secs - self.average_duration)
+            # this job, the others encoding now, and those that will start as soon as a worker is free
+            sharing_jobs = max(1, min(self.concurrent_jobs, self.active_jobs + 1 + queue_depth))
+            decision = {
+                'cpu_count': self.cpu_count,
+                'active_jobs': self.active_jobs + 1,
+                'queue_depth': queue_depth,
+                'threads': settings.ENCODE_THREADS or max(1, self.cpu_count // sharing_jobs),
+                'preset': profile_preset(profiles),
+                'preset_changed': False,
+                'target_drain_hours': self.target_hours or None,
+                'predicted_drain_hours': None,
+            }
+            if decision['preset'] is None or not duration_secs:
+                return decision
+
+            backlog_secs = duration_secs + queue_depth * self.average_duration
+            predicted_hours = {
+                preset: backlog_secs / (self.speed * PRESET_SPEEDS[preset]) / 3600 for preset in self.presets
+            }
+            if self.target_hours:
+                fast_enough = [preset for preset in self.presets if predicted_hours[preset] <= self.target_hours]
+                # the slowest (best) preset that meets the target, or else the fastest allowed
+                preset = fast_enough[-1] if fast_enough else self.presets[0]
+                decision['preset_changed'] = preset != decision['preset']
+                decision['preset'] = preset
+            if decision['preset'] in predicted_hours:
+                decision['predicted_drain_hours'] = round(predicted_hours[decision['preset']], 2)
+            return decision
+
+    @staticmethod
+    def apply(ffmpeg_args, decision, threads=None):
+        """
+        A copy of ffmpeg_args with the decided preset and encoder threads.
+
+        :param threads: encoder threads, if not decision['threads'] (e.g. when they are shared between outputs).
+        """
+        ffmpeg_args = list(ffmpeg_args)
+        if decision['preset_changed'] and '-preset' in ffmpeg_args:
+            ffmpeg_args[ffmpeg_args.index('-preset') + 1] = decision['preset']
+        return ffmpeg_args + ['-threads', str(threads or decision['threads'])]
+
+    def record(self, decision, duration_secs, wall_secs):
+        """
+        Update the measured encoding speed with a finished encode.
+        """
+        if decision['preset'] not in PRESET_SPEEDS or not duration_secs or wall_secs <= 0:
+            return
+        # as if it had used the whole node at veryslow
+        node_speed = (duration_secs / wall_secs) * (self.cpu_count / decision['threads']) / PRESET_SPEEDS[
+            decision['preset']]
+        with self._lock:
+            self.speed += SMOOTHING * (node_speed - self.speed)
+        logging.info('Encoded at %.2fx real time with %d threads at the %s preset.' % (
+            duration_secs / wall_secs, decision['threads'], decision['preset']))
+
+    @contextmanager
+    def encoding(self, profiles, duration_secs, queue_depth):
+        """
+        Plan an encode, and count it as active (and measure it) while the enclosed block runs it.
+        """
+        decision = self.plan(profiles, duration_secs, queue_depth)
+        logging.info('Encode schedule: %s' % decision)
+        with self._lock:
+            self.active_jobs += 1
+        started = time.monotonic()
+        try:
+            yield decision
+        finally:
+            with self._lock:
+                self.active_jobs -= 1
+        self.record(decision, duration_secs, time.monotonic() - started)
+
+
+scheduler = EncodeScheduler()
@@ -0,0 +1,164 @@
+"""
+Stage masters and write outputs on a local scratch volume (settings.SCRATCH_FOLDER), rather than reading masters over
+the watch mount and writing outputs to whatever /tmp is.
+
+A job is only admitted once the volume has room for what it is predicted to write there: a copy of its master, and
+its outputs at the bit rate of their profiles (or settings.SCRATCH_ESTIMATED_BIT_RATE for quality-based profiles)
+for the master's probed duration. Space that running jobs have reserved, but not yet written, is counted as used.
+Jobs wait until there is room, and fail if there could never be.
+
+The master is staged by a fixity copy, which hashes it as it is read, so it is only read over the network once.
+Each job's scratch folder is removed when it finishes or fails.
+"""
+
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+
+import settings
+from lib.ffmpeg import get_video_probe, split_global_args
+from lib.fixity import fixity_copy
+from lib.jobs import current_job_id
+from lib.remux import parse_bit_rate
+
+# for the container, and the bit rates encoders overshoot by
+SIZE_MARGIN = 1.1
+
+# audio bit rate of profiles that don't give one (ffmpeg's aac encoder defaults to 128k per channel)
+DEFAULT_AUDIO_BIT_RATE = 256000
+
+
+class ScratchSpaceError(Exception):
+    pass
+
+
+def folder_size(folder):
+    size = 0
+    for path, _, filenames in os.walk(folder):
+        for filename in filenames:
+            try:
+                size += os.path.getsize(os.path.join(path, filename))
+            except OSError:
+                # e.g. a temporary file removed while we were counting
+                pass
+    return size
+
+
+def profile_bit_rate(ffmpeg_args):
+    """
+    The bit rate an ffmpeg profile (e.g. settings.ACCESS_FFMPEG_ARGS) is expected to write at, in bits/s.
+    """
+    _, output_args = split_global_args(ffmpeg_args)
+    options = dict(zip(output_args[::2], output_args[1::2]))
+    video = options.get('-b:v') or options.get('-maxrate')
+    audio = options.get('-b:a') or options.get('-ab')
+    return (parse_bit_rate(video) if video else settings.SCRATCH_ESTIMATED_BIT_RATE) + \
+        (parse_bit_rate(audio) if audio else DEFAULT_AUDIO_BIT_RATE)
+
+
+class ScratchSpace:
+    """
+    :param min_free: bytes to leave free on the volume.
+    """
+
+    def __init__(self, folder=None, min_free=None, poll_secs=60):
+        self.folder = folder
+        self.min_free = settings.SCRATCH_MIN_FREE if min_free is None else min_free
+        self.poll_secs = poll_secs
+        # {job ID: (its folder, bytes reserved)}
+        self._jobs = {}
+        self._space_freed = threading.Condition()
+
+    @property
+    def enabled(self):
+        return bool(self.folder)
+
+    def predicted_size(self, source_file_path, profiles, segmented=False):
+        """
+        How many bytes a job is predicted to write to scratch: a copy of the master, and an output for each of
+        profiles. A segmented encode (see lib/segmented.py) also writes a copy of the master's video, split into
+        segments, and each output twice.
+        """
+        master_size = os.path.getsize(source_file_path)
+        try:
+            _, metadata = get_video_probe(source_file_path)
+            duration_secs = metadata.get('duration_secs') or 0
+        except Exception as e:
+            logging.warning("Couldn't probe the duration of %s to predict its outputs' size: %s" % (
+                source_file_path, e))
+            duration_secs = 0
+        outputs_size = sum(duration_secs * profile_bit_rate(ffmpeg_args) / 8 for ffmpeg_args in profiles)
+        if segmented:
+            return int((2 * master_size + 2 * outputs_size) * SIZE_MARGIN)
+        return int((master_size + outputs_size) * SIZE_MARGIN)
+
+    def available(self):
+        """
+        Bytes free on the scratch volume, less what running jobs have reserved but not yet written, and min_free.
+        """
+        outstanding = sum(max(0, reserved - folder_size(folder)) for folder, reserved in self._jobs.values())
+        return shutil.disk_usage(self.folder).free - outstanding - self.min_free
+
+    @contextmanager
+    def admit(self, source_file_path, needed_bytes):
+        """
+        Wait until there is room for a job that will write needed_bytes to scratch, and reserve it while the enclosed
+        block runs the job. Yields the job's scratch folder (or None if there is no scratch volume), which is removed
+        afterwards.
+
+        :raises ScratchSpaceError: if the volume could never have room for the job.
+        """
+        if not self.enabled:
+            yield None
+            return
+        os.makedirs(self.folder, exist_ok=True)
+        job_id = current_job_id()
+        with self._space_freed:
+            while needed_bytes > self.available():
+                if not self._jobs:
+                    raise ScratchSpaceError('%s needs %.1f GB of scratch space, but only %.1f GB is free in %s.' % (
+                        source_file_path, needed_bytes / 1e9, max(0, self.available()) / 1e9, self.folder))
+                logging.info('Waiting for %.1f GB of scratch space for %s...' % (needed_bytes / 1e9, source_file_path))
+                # files other than ours may be removed too, so check again every so often
+                self._space_freed.wait(self.poll_secs)
+            folder = tempfile.mkdtemp(prefix='job-', dir=self.folder)
+            self._jobs[job_id] = (folder, needed_bytes)
+        logging.info('Reserved %.1f GB of scratch space in %s.' % (needed_bytes / 1e9, folder))
+        try:
+            yield folder
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+            with self._space_freed:
+                self._jobs.pop(job_id, None)
+                self._space_freed.notify_all()
+
+    def job_folder(self):
+        """
+        The scratch folder of the job running in this thread, or None (e.g. for temporary files to go in the default
+        place instead).
+        """
+        folder, _ = self._jobs.get(current_job_id(), (None, None))
+        return folder
+
+    def stage(self, source_file_path):
+        """
+        Fixity copy the master into the job's scratch folder, hashing it as it is read.
+
+        :return: the path of the staged copy, or the master's own path if there is no scratch folder.
+        """
+        folder = self.job_folder()
+        if folder is None:
+            return source_file_path
+        staged_folder = os.path.join(folder, 'master')
+        os.makedirs(staged_folder, exist_ok=True)
+        staged_path = os.path.join(staged_folder, os.path.basename(source_file_path))
+        if os.path.exists(staged_path):
+            return staged_path
+        logging.info('Staging %s in scratch...' % source_file_path)
+        return fixity_copy(source_file_path, staged_path, store_md5s=False)
+
+
+scratch = ScratchSpace(settings.SCRATCH_FOLDER)
@@ -0,0 +1,218 @@
+"""
+Encode long masters in segments, several at a time.
+
+One libx264 process at a slow preset can't keep every core busy, so a long master is split (without re-encoding) at
+keyframes into segments of about settings.SEGMENT_DURATION seconds. The video of each segment is encoded by its own
+ffmpeg, with settings.SEGMENT_THREADS encoder threads, and as many segments are encoded at once as there are cores to
+spare. The audio is encoded once, from the whole master. The encoded segments are then joined without re-encoding,
+muxed with the audio, and checked against the master's duration and frame count.
+"""
+
+import logging
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import settings
+from lib.ffmpeg import FFMPEGError, build_ffmpeg_command, split_global_args
+from lib.jobs import check_aborted, in_current_job
+
+# per-output ffmpeg options that apply to the audio, all of which take a value
+AUDIO_OPTIONS = {'-c:a', '-acodec', '-ab', '-b:a', '-ac', '-ar', '-af', '-aq', '-q:a', '-filter:a'}
+
+# instead of the profiles' global options, so that ffmpeg's errors are kept for FFMPEGError
+GLOBAL_ARGS = ['-loglevel', 'error', '-nostats', '-hide_banner', '-n']
+
+# a master's duration may differ from its access copy's by up to this many seconds (e.g. the audio ending a little
+# after the video)
+DURATION_TOLERANCE = 0.5
+
+
+class SegmentedEncodeError(Exception):
+    pass
+
+
+def should_segment(duration_secs):
+    return settings.SEGMENTED_ENCODE and duration_secs is not None and duration_secs >= settings.SEGMENT_MIN_DURATION
+
+
+def segment_workers(threads=None):
+    """
+    How many segments to encode at once: enough to use this job's share of the cores.
+    """
+    threads = threads or settings.SEGMENT_THREADS
+    return max(1, (os.cpu_count() or 1) // max(1, settings.CONCURRENT_JOBS) // threads)
+
+
+def split_stream_args(ffmpeg_args):
+    """
+    Split the per-output options of an ffmpeg profile (e.g. settings.ACCESS_FFMPEG_ARGS) into video and audio options.
+
+    :return: (video_args, audio_args)
+    """
+    _, output_args = split_global_args(ffmpeg_args)
+    video_args = []
+    audio_args = []
+    for i in range(0, len(output_args), 2):
+        option = output_args[i:i + 2]
+        if option[0] in AUDIO_OPTIONS:
+            audio_args += option
+        else:
+            video_args += option
+    return video_args, audio_args
+
+
+def _run(ffmpeg_args):
+    logging.info('Running %s' % ' '.join(ffmpeg_args))
+    result = subprocess.run(
+        ffmpeg_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.DEVNULL,
+        universal_newlines=True, errors='replace',
+    )
+    if result.returncode != 0:
+        raise FFMPEGError(result.returncode, ffmpeg_args, stderr=result.stderr)
+    return result.stdout
+
+
+def split_source(source_file_path, folder, segment_secs=None):
+    """
+    Copy the master's video into segments of about segment_secs seconds, each starting at a keyframe.
+
+    :return: the paths of the segments, in order.
+    """
+    _run(['ffmpeg'] + GLOBAL_ARGS + [
+        '-i', source_file_path,
+        '-map', '0:v:0', '-c', 'copy',
+        '-f', 'segment', '-segment_time', str(segment_secs or settings.SEGMENT_DURATION), '-reset_timestamps', '1',
+        os.path.join(folder, 'source_%05d.mkv'),
+    ])
+    return sorted(
+        os.path.join(folder, filename) for filename in os.listdir(folder)
+        if filename.startswith('source_') and filename.endswith('.mkv')
+    )
+
+
+def probe_counts(video_location):
+    """
+    The duration of a video, and the number of frames in its first video stream (by counting them).
+
+    :return: (duration_secs, frame_count)
+    """
+    output = _run([
+        'ffprobe', '-v', 'error', '-count_packets', '-select_streams', 'v:0',
+        '-show_entries', 'format=duration:stream=nb_read_packets', '-of', 'default=noprint_wrappers=1',
+        video_location,
+    ])
+    values = dict(line.split('=', 1) for line in output.splitlines() if '=' in line)
+    return float(values['duration']), int(values['nb_read_packets'])
+
+
+def expected_frame_count(ffmpeg_args, source_duration, source_frames, segment_count):
+    """
+    How many frames a segmented encode of the source with these ffmpeg args should have.
+
+    :return: (frames, tolerance)
+    """
+    if '-r' not in ffmpeg_args:
+        return source_frames, 0
+    numerator, _, denominator = ffmpeg_args[ffmpeg_args.index('-r') + 1].partition('/')
+    frame_rate = float(numerator) / float(denominator or 1)
+    # each segment is converted to the new frame rate on its own, so may gain or lose a frame at its end
+    return round(source_duration * frame_rate), segment_count
+
+
+def verify_output(output_path, ffmpeg_args, source_duration, source_frames, segment_count):
+    duration, frames = probe_counts(output_path)
+    if abs(duration - source_duration) > DURATION_TOLERANCE:
+        raise SegmentedEncodeError('%s is %.3fs long, but its master is %.3fs long.' % (
+            output_path, duration, source_duration))
+    expected_frames, tolerance = expected_frame_count(ffmpeg_args, source_duration, source_frames, segment_count)
+    if abs(frames - expected_frames) > tolerance:
+        raise SegmentedEncodeError('%s has %d frames, but should have %d.' % (output_path, frames, expected_frames))
+
+
+def concat_list(segment_paths, list_path):
+    with open(list_path, 'w') as f:
+        for segment_path in segment_paths:
+            f.write("file '%s'\n" % segment_path.replace("'", "'\\''"))
+    return list_path
+
+
+def encode_segmented(source_file_path, outputs, work_folder, threads=None, workers=None):
+    """
+    Encode source_file_path to every output, in segments.
+
+    :param outputs: list of (ffmpeg_base_args, output_path) tuples, one per output profile, as for
+        lib.ffmpeg.build_ffmpeg_command.
+    :param work_folder: a folder for the segments (created if need be), with room for about twice the size of the
+        master and outputs.
+    :param threads: encoder threads per segment (default settings.SEGMENT_THREADS).
+    :param workers: how many segments to encode at once (default: enough for this job's share of the cores).
+    :raises FFMPEGError: if ffmpeg fails.
+    :raises SegmentedEncodeError: if an output's duration or frame count doesn't match the master's.
+    """
+    threads = threads or settings.SEGMENT_THREADS
+    source_folder = os.path.join(work_folder, 'source')
+    os.makedirs(source_folder)
+    segment_paths = split_source(source_file_path, source_folder)
+    source_duration, source_frames = probe_counts(source_file_path)
+    has_audio = bool(_run([
+        'ffprobe', '-v', 'error', '-select_streams', 'a:0', '-show_entries', 'stream=index', '-of', 'csv=p=0',
+        source_file_path,
+    ]).strip())
+
+    profiles = []
+    for index, (ffmpeg_base_args, output_path) in enumerate(outputs):
+        video_args, audio_args = split_stream_args(ffmpeg_base_args)
+        profile_folder = os.path.join(work_folder, str(index))
+        os.makedirs(profile_folder)
+        profiles.append({
+            'args': ffmpeg_base_args,
+            'video_args': video_args + ['-an'] + ([] if '-threads' in video_args else ['-threads', str(threads)]),
+            'audio_args': audio_args + ['-vn'],
+            'output_path': output_path,
+            'folder': profile_folder,
+            'segments': [os.path.join(profile_folder, os.path.basename(path)) for path in segment_paths],
+            'audio_path': os.path.join(profile_folder, 'audio.mka'),
+        })
+
+    def encode_segment(segment_index):
+        check_aborted()
+        # each segment is decoded once, and encoded for every profile
+        _run(build_ffmpeg_command(segment_paths[segment_index], [
+            (GLOBAL_ARGS + profile['video_args'], profile['segments'][segment_index])
+            for profile in profiles
+        ]))
+        logging.info('Encoded segment %d of %d of %s.' % (segment_index + 1, len(segment_paths), source_file_path))
+
+    def encode_audio():
+        _run(build_ffmpeg_command(source_file_path, [
+            (GLOBAL_ARGS + profile['audio_args'], profile['audio_path']) for profile in profiles
+        ]))
+
+    workers = workers or segment_workers(threads)
+    logging.info('Encoding %s in %d segments, %d at a time with %d threads each.' % (
+        source_file_path, len(segment_paths), workers, threads))
+    with ThreadPoolExecutor(max_workers=workers + int(has_audio), thread_name_prefix='segment') as executor:
+        futures = []
+        if has_audio:
+            futures.append(executor.submit(in_current_job(encode_audio)))
+        futures += [executor.submit(in_current_job(encode_segment), index) for index in range(len(segment_paths))]
+        try:
+            for future in futures:
+                future.result()
+        except Exception:
+            # don't start any more segments
+            for future in futures:
+                future.cancel()
+            raise
+
+    for profile in profiles:
+        inputs = ['-f', 'concat', '-safe', '0', '-i', concat_list(profile['segments'],
+                                                                 os.path.join(profile['folder'], 'segments.txt'))]
+        maps = ['-map', '0:v']
+        if has_audio:
+            inputs += ['-i', profile['audio_path']]
+            maps += ['-map', '1:a']
+        _run(['ffmpeg'] + GLOBAL_ARGS + inputs + maps +
+             ['-c', 'copy', '-movflags', '+faststart', profile['output_path']])
+        verify_output(profile['output_path'], profile['args'], source_duration, source_frames, len(segment_paths))
@@ -1,30 +1,178 @@
+"""
+Slack notifications, posted from a background thread so Slack's latency and rate limits never hold up a job.
+
+Messages are queued by post_slack_message and posted in order, at most one every settings.SLACK_MIN_INTERVAL seconds,
+with a single Slack client. When settings.SLACK_DIGEST_THRESHOLD or more messages for a channel are waiting (e.g.
+during a backfill), they are posted together as one digest message.
+
+settings.SLACK_BACKEND chooses where messages go: 'slack', 'file' (JSON lines in settings.SLACK_FILE_PATH, e.g. for
+development without a network), or 'null'.
+"""
+
+import atexit
+import json
 import logging
+import queue
 import slack
 import settings
 import os
+import threading
+import time
 import traceback
+from datetime import datetime
 
-def post_slack_message(message, channel=None, **kwargs):
-    if channel is None:
-        channel = os.getenv("SLACK_CHANNEL")
+# the most attachments (e.g. file links) kept in a digest message
+DIGEST_MAX_ATTACHMENTS = 20
+
+
+class SlackBackend:
+
+    def __init__(self, token=None):
+        self.token = token
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = slack.WebClient(token=self.token or os.getenv("SLACK_TOKEN"))
+        return self._client
 
-    slack_token = os.getenv("SLACK_TOKEN")
+    def send(self, channel, text, **kwargs):
+        for attempt in range(3):
+            if attempt:
+                # rate limited: wait as long as Slack asks, then try again
+                logging.warning('Slack rate limit reached. Retrying in %ss.' % retry_after)
+                time.sleep(retry_after)
+            try:
+                return self.client.chat_postMessage(
+                    channel=channel,
+                    text=text,
+                    as_user=True,
+                    **kwargs, #e.g. attachments
+                )
+            except slack.errors.SlackApiError as exception:
+                if exception.response.status_code != 429 or attempt == 2:
+                    raise
+                retry_after = int(exception.response.headers.get('Retry-After', 1))
 
-    slack_client = slack.WebClient(token=slack_token)
 
-    response = None
-    try:
-        response = slack_client.chat_postMessage(
-            channel=channel,
-            text=message,
-            as_user=True,
-            **kwargs, #e.g. attachments
-        )
-    except slack.errors.SlackApiError as exception:
-        response = exception
-        logging.error(f'Error posting to Slack channel {channel}: {exception}')
+class FileBackend:
 
-    return response
+    def __init__(self, path=None):
+        self.path = path or settings.SLACK_FILE_PATH
+
+    def send(self, channel, text, **kwargs):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path, 'a') as f:
+            message = {'time': datetime.now().isoformat(), 'channel': channel, 'text': text, **kwargs}
+            f.write(json.dumps(message) + '\n')
+
+
+class NullBackend:
+
+    def send(self, channel, text, **kwargs):
+        pass
+
+
+BACKENDS = {
+    'slack': SlackBackend,
+    'file': FileBackend,
+    'null': NullBackend,
+}
+
+
+class SlackNotifier:
+    """
+    Posts queued messages from a background thread, started when the first message is queued.
+
+    :param backend: object with a send(channel, text, **kwargs) method. Defaults to settings.SLACK_BACKEND.
+    """
+
+    def __init__(self, backend=None, min_interval=None, digest_threshold=None):
+        self.backend = backend or BACKENDS[settings.SLACK_BACKEND]()
+        self.min_interval = settings.SLACK_MIN_INTERVAL if min_interval is None else min_interval
+        self.digest_threshold = digest_threshold or settings.SLACK_DIGEST_THRESHOLD
+        self._queue = queue.Queue()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        self._last_sent = 0
+
+    def post(self, channel, text, **kwargs):
+        """
+        Queue a message. Never blocks.
+        """
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='slack', daemon=True)
+                self._thread.start()
+        self._queue.put((channel, text, kwargs))
+
+    def flush(self, timeout=30):
+        """
+        Wait (up to timeout seconds) until every queued message has been posted.
+        """
+        deadline = time.monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        return True
+
+    def _take_waiting(self, messages):
+        while True:
+            try:
+                messages.append(self._queue.get_nowait())
+            except queue.Empty:
+                return messages
+
+    def _run(self):
+        while True:
+            messages = [self._queue.get()]
+            # rate limit, letting more messages queue up to be coalesced meanwhile
+            time.sleep(max(0, self._last_sent + self.min_interval - time.monotonic()))
+            self._take_waiting(messages)
+            try:
+                for channel in dict.fromkeys(channel for channel, _, _ in messages):
+                    channel_messages = [(text, kwargs) for c, text, kwargs in messages if c == channel]
+                    if len(channel_messages) >= self.digest_threshold:
+                        text, kwargs = self._digest(channel_messages)
+                        self._send(channel, text, **kwargs)
+                    else:
+                        for text, kwargs in channel_messages:
+                            time.sleep(max(0, self._last_sent + self.min_interval - time.monotonic()))
+                            self._send(channel, text, **kwargs)
+            finally:
+                for _ in messages:
+                    self._queue.task_done()
+
+    def _digest(self, messages):
+        text = '%d notifications:\n%s' % (len(messages), '\n'.join('• %s' % text for text, _ in messages))
+        attachments = [attachment for _, kwargs in messages for attachment in kwargs.get('attachments', [])]
+        if attachments:
+            return text, {'attachments': attachments[:DIGEST_MAX_ATTACHMENTS]}
+        return text, {}
+
+    def _send(self, channel, text, **kwargs):
+        self._last_sent = time.monotonic()
+        try:
+            self.backend.send(channel, text, **kwargs)
+        except Exception as exception:
+            logging.error(f'Error posting to Slack channel {channel}: {exception}')
+
+
+notifier = SlackNotifier()
+atexit.register(notifier.flush)
+
+
+def post_slack_message(message, channel=None, **kwargs):
+    """
+    Queue a message to be posted to Slack (see SlackNotifier).
+    """
+    if channel is None:
+        channel = os.getenv("SLACK_CHANNEL")
+    notifier.post(channel, message, **kwargs)
 
 
 def slack_link(url, text=""):
@@ -74,5 +222,6 @@ def new_file_slack_message(message, file_path, duration):
 
 
 def post_slack_exception(message):
-    traceback.print_exc()
+    # logged rather than printed, so it is tagged with (and kept in the log of) the job that raised it
+    logging.error(traceback.format_exc())
     post_slack_message(message)
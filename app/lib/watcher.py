@@ -0,0 +1,329 @@
+"""
+Notice new video files in the watch folder as soon as they arrive, rather than re-walking it every hour.
+
+On local filesystems this uses inotify. Network mounts (CIFS/SMB, NFS) don't report changes made by other hosts through
+inotify, so on those the folder is polled instead, diffing the modification time and size of each file against a
+snapshot from the previous poll. The snapshot is persisted so that a restart doesn't report every file again.
+
+Polls are kept cheap with a lib.scanner.ScanIndex: only folders whose modification time has changed are listed again,
+and only the files in those, and files still being copied in, are stat'ed. The rest cost one stat per folder.
+"""
+
+import ctypes
+import ctypes.util
+import json
+import logging
+import os
+import queue
+import re
+import select
+import struct
+import threading
+import time
+
+import settings
+from lib.ffmpeg import is_video_file
+from lib.scanner import ScanIndex
+
+# filesystems on which inotify doesn't see changes made by other hosts
+NETWORK_FILESYSTEMS = ('cifs', 'smb3', 'smbfs', 'nfs', 'nfs4', 'fuse.sshfs')
+
+# from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+INOTIFY_WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+INOTIFY_EVENT_HEADER = struct.Struct('iIII')
+
+
+def filesystem_type(path):
+    """
+    Return the type of the filesystem that path is on (e.g. 'ext4', 'cifs'), or None if it can't be found.
+    """
+    path = os.path.realpath(path)
+    best_mount_point = ''
+    best_fs_type = None
+    try:
+        with open('/proc/mounts') as mounts:
+            for line in mounts:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                # spaces etc. in mount points are octal-escaped in /proc/mounts
+                mount_point = re.sub(r'\\([0-7]{3})', lambda match: chr(int(match.group(1), 8)), fields[1])
+                if (path == mount_point or path.startswith(mount_point.rstrip('/') + '/')) \
+                        and len(mount_point) > len(best_mount_point):
+                    best_mount_point = mount_point
+                    best_fs_type = fields[2]
+    except OSError:
+        return None
+    return best_fs_type
+
+
+def scan_video_files(folder):
+    """
+    Return {path: (mtime_ns, size)} for every video file under folder, following symlinks like os.walk in
+    lib.ffmpeg.find_video_file.
+    """
+    files = {}
+    folders = [folder]
+    while folders:
+        try:
+            entries = list(os.scandir(folders.pop()))
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                if entry.is_dir():
+                    folders.append(entry.path)
+                elif is_video_file(entry.name):
+                    stat = entry.stat()
+                    files[entry.path] = (stat.st_mtime_ns, stat.st_size)
+            except OSError:
+                # the file was moved or deleted while we were looking at it
+                continue
+    return files
+
+
+class Watcher:
+    """
+    Watch a folder in a background thread, and queue up video files that have appeared or changed.
+
+    `files_available` is set while there are queued files (or a full rescan is due), so idle workers can wait on it.
+    """
+
+    def __init__(self, folder, mode=None, poll_interval=None, snapshot_path=None, rescan_interval=None):
+        self.folder = os.path.abspath(os.path.expanduser(folder))
+        self.mode = mode or settings.WATCH_MODE
+        self.poll_interval = poll_interval if poll_interval is not None else settings.WATCH_POLL_INTERVAL
+        self.snapshot_path = snapshot_path if snapshot_path is not None else settings.WATCH_SNAPSHOT_PATH
+        self.rescan_interval = rescan_interval if rescan_interval is not None else settings.IDLE_WAIT
+
+        self.files_available = threading.Event()
+        self._files = queue.Queue()
+        self._queued = set()
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._inotify_fd = None
+        self._watch_descriptors = {}
+        self._rescan_due = True
+        self._last_rescan = 0
+        self._snapshot = None
+        self._reported = None
+        self._scan_index = None
+        # a full rescan is always due at startup, to find files that arrived while we weren't running
+        self.files_available.set()
+
+    # -- queue --
+
+    def _queue_file(self, path):
+        with self._lock:
+            if path in self._queued:
+                return
+            self._queued.add(path)
+            self._files.put(path)
+            self.files_available.set()
+        logging.info('Watcher: new file %s' % path)
+
+    def next_file(self):
+        """
+        Return the next file the watcher has seen arrive, or None.
+        """
+        with self._lock:
+            try:
+                path = self._files.get_nowait()
+            except queue.Empty:
+                if not self._rescan_due:
+                    self.files_available.clear()
+                return None
+            self._queued.discard(path)
+            return path
+
+    def rescan_due(self):
+        """
+        Whether the whole folder should be searched, e.g. at startup, after an inotify overflow, or every
+        rescan_interval as a safety net.
+        """
+        with self._lock:
+            if time.monotonic() - self._last_rescan >= self.rescan_interval:
+                self._rescan_due = True
+            return self._rescan_due
+
+    def rescan_done(self):
+        with self._lock:
+            self._rescan_due = False
+            self._last_rescan = time.monotonic()
+            if self._files.empty():
+                self.files_available.clear()
+
+    def _request_rescan(self):
+        with self._lock:
+            self._rescan_due = True
+            self.files_available.set()
+
+    # -- lifecycle --
+
+    def resolved_mode(self):
+        if self.mode != 'auto':
+            return self.mode
+        fs_type = filesystem_type(self.folder)
+        if fs_type in NETWORK_FILESYSTEMS:
+            return 'poll'
+        return 'inotify'
+
+    def start(self):
+        mode = self.resolved_mode()
+        if mode == 'inotify':
+            try:
+                self._start_inotify()
+            except (OSError, AttributeError) as e:
+                logging.warning('Watcher: inotify unavailable for %s (%s). Falling back to polling.' % (
+                    self.folder, e))
+                mode = 'poll'
+        if mode == 'inotify':
+            target = self._run_inotify
+        else:
+            target = self._run_poll
+        logging.info('Watcher: watching %s using %s.' % (self.folder, mode))
+        self._thread = threading.Thread(target=target, name='watcher', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join()
+        if self._inotify_fd is not None:
+            os.close(self._inotify_fd)
+            self._inotify_fd = None
+
+    def _run_forever(self, step):
+        while not self._stop_event.is_set():
+            try:
+                step()
+            except Exception:
+                # keep watching; the periodic rescan will pick up anything missed
+                logging.exception('Watcher: error while watching %s' % self.folder)
+                self._stop_event.wait(self.poll_interval)
+            if self.rescan_due():
+                self.files_available.set()
+
+    # -- inotify --
+
+    def _start_inotify(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self._inotify_fd = fd
+        self._add_watches(self.folder)
+
+    def _add_watches(self, folder):
+        for dirpath, dirnames, filenames in os.walk(folder, followlinks=True):
+            wd = self._libc.inotify_add_watch(self._inotify_fd, os.fsencode(dirpath), INOTIFY_WATCH_MASK)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                raise OSError(errno, '%s: %s' % (os.strerror(errno), dirpath))
+            self._watch_descriptors[wd] = dirpath
+
+    def _run_inotify(self):
+        self._run_forever(self._read_inotify_events)
+
+    def _read_inotify_events(self):
+        readable, _, _ = select.select([self._inotify_fd], [], [], 1)
+        if not readable:
+            return
+        data = os.read(self._inotify_fd, 64 * 1024)
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, name_length = INOTIFY_EVENT_HEADER.unpack_from(data, offset)
+            offset += INOTIFY_EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + name_length].rstrip(b'\0'))
+            offset += name_length
+
+            if mask & IN_Q_OVERFLOW:
+                logging.warning('Watcher: inotify queue overflowed. Rescanning %s.' % self.folder)
+                self._request_rescan()
+                continue
+            dirpath = self._watch_descriptors.get(wd)
+            if dirpath is None or not name:
+                continue
+            path = os.path.join(dirpath, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    # watch the new folder, and pick up anything that was written to it before the watch was added
+                    self._add_watches(path)
+                    for video_path in scan_video_files(path):
+                        self._queue_file(video_path)
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO) and is_video_file(name):
+                self._queue_file(path)
+
+    # -- polling --
+
+    def _load_snapshot(self):
+        try:
+            with open(self.snapshot_path) as f:
+                snapshot = json.load(f)
+            if snapshot.get('folder') != self.folder:
+                return {}, {}
+            return (
+                {path: tuple(sig) for path, sig in snapshot['files'].items()},
+                {path: tuple(sig) for path, sig in snapshot['reported'].items()},
+            )
+        except (OSError, ValueError, KeyError):
+            return {}, {}
+
+    def _save_snapshot(self):
+        os.makedirs(os.path.dirname(self.snapshot_path), exist_ok=True)
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'folder': self.folder, 'files': self._snapshot, 'reported': self._reported}, f)
+        os.replace(tmp_path, self.snapshot_path)
+
+    def _run_poll(self):
+        def poll_and_wait():
+            self.poll()
+            self._stop_event.wait(self.poll_interval)
+        self._run_forever(poll_and_wait)
+
+    def poll(self):
+        """
+        Compare the folder against the previous poll. A file is queued once its modification time and size have stayed
+        the same for a whole poll interval, so files that are still being copied in aren't picked up.
+        """
+        if self._snapshot is None:
+            self._snapshot, self._reported = self._load_snapshot()
+            self._scan_index = ScanIndex(self.folder, is_video_file)
+        current = {}
+        listing = self._scan_index.scan()
+        for dirpath, filenames in listing.items():
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                previous = self._snapshot.get(path)
+                # a file that has been reported, in a folder that hasn't changed, is taken as it was
+                if dirpath not in self._scan_index.listed_folders and previous is not None \
+                        and self._reported.get(path) == previous:
+                    current[path] = previous
+                    continue
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    # the file was moved or deleted while we were looking at it
+                    continue
+                current[path] = (stat.st_mtime_ns, stat.st_size)
+        changed = current != self._snapshot
+        for path, signature in current.items():
+            if self._snapshot.get(path) == signature and self._reported.get(path) != signature:
+                self._reported[path] = signature
+                self._queue_file(path)
+                changed = True
+        for path in list(self._reported):
+            if path not in current:
+                del self._reported[path]
+        self._snapshot = current
+        if changed and self.snapshot_path:
+            self._save_snapshot()
@@ -1,33 +1,215 @@
+import json
+import logging
 import os
+import threading
+import time
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import settings
 
 XOS_AUTH_TOKEN = os.environ['XOS_AUTH_TOKEN']
 XOS_API_ENDPOINT = os.environ['XOS_API_ENDPOINT']
 
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def retrying_adapter(retries, backoff_factor, pool_size):
+    """
+    An HTTPAdapter that retries connection errors and 5xx/429 responses with exponential backoff. Only GETs and PATCHes
+    are retried after they have been sent: a POST that timed out may still have created its asset, so
+    XOSClient.get_or_create_stub_video retries by looking the stub up again instead.
+    """
+    retry_options = {
+        'total': retries,
+        'backoff_factor': backoff_factor,
+        'status_forcelist': RETRY_STATUSES,
+        'respect_retry_after_header': True,
+        'raise_on_status': False,
+    }
+    methods = frozenset(['GET', 'PATCH'])
+    try:
+        retry = Retry(allowed_methods=methods, **retry_options)
+    except TypeError:
+        # urllib3 < 1.26
+        retry = Retry(method_whitelist=methods, **retry_options)
+    return HTTPAdapter(max_retries=retry, pool_connections=1, pool_maxsize=pool_size)
+
+
+class XOSClient:
+    """
+    Talks to the XOS assets API over one pooled session, with timeouts and retries.
+
+    Stub lookups are cached by master checksum, and only one job at a time looks up (or creates) the stub of a master.
+    If a final video update still fails after retrying (e.g. XOS is slow
+    or down), it is queued in settings.XOS_UPDATE_QUEUE_PATH and sent, with any others waiting, the next time an
+    update is made or flush_updates() is called.
+    """
+
+    def __init__(self, api_endpoint=XOS_API_ENDPOINT, auth_token=XOS_AUTH_TOKEN, timeout=None, retries=None,
+                 backoff_factor=None, update_queue_path=None):
+        self.api_endpoint = api_endpoint
+        self.timeout = timeout or (settings.XOS_CONNECT_TIMEOUT, settings.XOS_READ_TIMEOUT)
+        self.update_queue_path = update_queue_path or settings.XOS_UPDATE_QUEUE_PATH
+        self.retries = settings.XOS_RETRIES if retries is None else retries
+        self.backoff_factor = settings.XOS_BACKOFF_FACTOR if backoff_factor is None else backoff_factor
+        self.session = requests.Session()
+        self.session.headers.update({
+            'Authorization': 'Token ' + auth_token,
+            'Content-Type': 'application/json',
+        })
+        adapter = retrying_adapter(self.retries, self.backoff_factor, max(2, settings.CONCURRENT_JOBS))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._stub_ids = {}
+        # {checksum: lock held while its stub is looked up or created}
+        self._stub_locks = {}
+        self._lock = threading.Lock()
+
+    def _request(self, method, path, **kwargs):
+        if 'json' in kwargs:
+            # metadata can include datetimes
+            kwargs['data'] = json.dumps(kwargs.pop('json'), default=str)
+        response = self.session.request(method, self.api_endpoint + path, timeout=self.timeout, **kwargs)
+        response.raise_for_status()
+        return response
+
+    def get_or_create_stub_video(self, video_data):
+        """
+        Creates and returns the ID of a stub video with keys and values from video_data.
+        If one already exists due to a previously failed transcoding, just returns its ID.
+        """
+        checksum = video_data['master_metadata']['checksum']
+        with self._lock:
+            stub_lock = self._stub_locks.setdefault(checksum, threading.Lock())
+        # so that two jobs for the same master can't both create a stub
+        with stub_lock:
+            with self._lock:
+                if checksum in self._stub_ids:
+                    return self._stub_ids[checksum]
+            asset_id = self._find_or_create_stub_video(checksum, video_data)
+            with self._lock:
+                self._stub_ids[checksum] = asset_id
+        return asset_id
+
+    def _find_or_create_stub_video(self, checksum, video_data):
+        attempt = 0
+        while True:
+            response_json = self._request(
+                'GET', 'assets/', params={'title_contains': 'NOT UPLOADED', 'checksum': checksum},
+            ).json()
+            if response_json['count'] == 1:
+                return response_json['results'][0]['id']
+            try:
+                return self._request('POST', 'assets/', json=video_data).json()['id']
+            except requests.RequestException as e:
+                attempt += 1
+                if attempt > self.retries or not _should_queue(e):
+                    raise
+                # the stub may have been created even so, so look it up again before retrying
+                delay = self.backoff_factor * 2 ** attempt
+                logging.warning('Could not create XOS stub (%s). Retrying in %ds...' % (e, delay))
+                time.sleep(delay)
+
+    def update_final_video(self, asset_id, video_data):
+        """
+        Update the specified asset with keys and values from video_data. If XOS is unreachable or keeps failing, the
+        update is queued rather than raised. Updates that XOS rejects (4xx errors other than 429) are raised.
+        """
+        try:
+            self._request('PATCH', 'assets/%s/' % asset_id, json=video_data)
+        except requests.RequestException as e:
+            if not _should_queue(e):
+                raise
+            logging.warning('Could not update XOS asset %s (%s). The update is queued and will be retried.' % (
+                asset_id, e))
+            self.queue_update(asset_id, video_data)
+        else:
+            # XOS is answering, so send anything that was queued while it wasn't
+            self.flush_updates()
+        with self._lock:
+            # the stub is no longer 'NOT UPLOADED'
+            for checksum, stub_id in list(self._stub_ids.items()):
+                if stub_id == asset_id:
+                    del self._stub_ids[checksum]
+
+    # -- queued updates --
+
+    def _load_queue(self):
+        try:
+            with open(self.update_queue_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _save_queue(self, updates):
+        os.makedirs(os.path.dirname(os.path.abspath(self.update_queue_path)), exist_ok=True)
+        tmp_path = '%s.%s.tmp' % (self.update_queue_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(updates, f, default=str)
+        os.replace(tmp_path, self.update_queue_path)
+
+    def queue_update(self, asset_id, video_data):
+        with self._lock:
+            updates = self._load_queue()
+            # a later update of the same asset replaces an earlier one
+            updates[str(asset_id)] = json.loads(json.dumps(video_data, default=str))
+            self._save_queue(updates)
+
+    def pending_updates(self):
+        with self._lock:
+            return self._load_queue()
+
+    def flush_updates(self):
+        """
+        Send every queued update, over the one session. Returns the number still queued.
+        """
+        updates = self.pending_updates()
+        if not updates:
+            return 0
+        sent = {}
+        for asset_id, video_data in updates.items():
+            try:
+                self._request('PATCH', 'assets/%s/' % asset_id, json=video_data)
+            except requests.RequestException as e:
+                if _should_queue(e):
+                    continue
+                logging.error('XOS rejected the queued update of asset %s: %s' % (asset_id, e))
+            sent[asset_id] = video_data
+
+        with self._lock:
+            # keep anything queued while we were sending
+            remaining = {asset_id: video_data for asset_id, video_data in self._load_queue().items()
+                         if sent.get(asset_id) != video_data}
+            self._save_queue(remaining)
+        logging.info('Sent %d queued XOS update(s); %d still queued.' % (len(sent), len(remaining)))
+        return len(remaining)
+
+
+def _should_queue(exception):
+    """
+    Whether a failed request is worth trying again later: XOS couldn't be reached, timed out, or had a server error
+    (or rate limited us) on every retry.
+    """
+    response = getattr(exception, 'response', None)
+    return response is None or response.status_code in RETRY_STATUSES
+
+
+xos = XOSClient()
+
+
 def get_or_create_xos_stub_video(video_data):
     """
     Creates and returns the ID of a stub video with keys and values from video_data.
     If one already exists due to a previously failed transcoding, just returns its ID.
     """
-    xos_video_endpoint = f'{XOS_API_ENDPOINT}assets/'
-    headers = {'Authorization': 'Token ' + XOS_AUTH_TOKEN}
-
-    get_response = requests.get(xos_video_endpoint+'?title_contains=NOT%20UPLOADED&checksum='+video_data['master_metadata']['checksum'], headers=headers)
-    get_response.raise_for_status()
-    get_response_json = get_response.json()
-    if get_response_json['count'] == 1:
-        return get_response_json['results'][0]['id']
+    return xos.get_or_create_stub_video(video_data)
 
-    response = requests.post(xos_video_endpoint, json=video_data, headers=headers)
-    response.raise_for_status()
-    return response.json()['id']
 
 def update_xos_with_final_video(asset_id, video_data):
     """
     Update the specified asset with keys and values from video_data
     """
-    xos_video_endpoint = f'{XOS_API_ENDPOINT}assets/{asset_id}/'
-    headers = {'Authorization': 'Token ' + XOS_AUTH_TOKEN}
-    response = requests.patch(xos_video_endpoint, json=video_data, headers=headers)
-    response.raise_for_status()
+    xos.update_final_video(asset_id, video_data)
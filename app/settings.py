@@ -1,4 +1,5 @@
 import os
+import socket
 
 # These paths are mounted into the docker container by docker-entrypoint.sh
 WATCH_FOLDER = "/mount/watch/"
@@ -79,9 +80,116 @@ EXHIBITIONS_WEB_FFMPEG_ARGS = [
 
 TIMEZONE = 'Australia/Victoria'
 
+# number of master files to transcode at the same time
+CONCURRENT_JOBS = int(os.getenv('CONCURRENT_JOBS', '1'))
+# seconds between full searches of the WATCH_FOLDER. New files are normally picked up by lib.watcher well before this.
+IDLE_WAIT = 3600  # one hour
+# how to notice new files in the WATCH_FOLDER: 'inotify', 'poll', or 'auto' (polling on network mounts)
+WATCH_MODE = os.getenv('WATCH_MODE', 'auto')
+WATCH_POLL_INTERVAL = int(os.getenv('WATCH_POLL_INTERVAL', '10'))  # seconds
+
+# local folder where the transcoder keeps its own state between restarts
+STATE_FOLDER = os.getenv('STATE_FOLDER', '/var/lib/transcoder/')
+WATCH_SNAPSHOT_PATH = os.path.join(STATE_FOLDER, 'watch_snapshot.json')
+SCAN_INDEX_PATH = os.path.join(STATE_FOLDER, 'scan_index.json')
+# checksums of files that haven't changed since they were hashed, so they aren't hashed again
+CHECKSUM_CACHE_PATH = os.path.join(STATE_FOLDER, 'checksums.sqlite3')
+CHECKSUM_CACHE_MAX_AGE_DAYS = 90
+# ffprobe output for files that haven't changed since they were probed
+PROBE_CACHE_PATH = os.path.join(STATE_FOLDER, 'probes.sqlite3')
+PROBE_CONCURRENCY = int(os.getenv('PROBE_CONCURRENCY', '4'))
+# metadata of every processed video (see lib/catalogue.py). Export CSVs with `python -m lib.catalogue export`
+CATALOGUE_PATH = os.path.join(STATE_FOLDER, 'catalogue.sqlite3')
+CATALOGUE_BATCH_SIZE = 50
+CATALOGUE_FLUSH_INTERVAL = 300  # seconds
+# how far each unfinished job has got (see lib/journal.py), so it can be resumed after a restart
+JOURNAL_FOLDER = os.path.join(STATE_FOLDER, 'journals')
+# masters are claimed with leases ('.lock' files) that are renewed while a node is running, so several nodes can share
+# the WATCH_FOLDER. NODE_ID must be unique to each node, and stay the same across restarts so a node can resume its
+# own jobs straight away. Other nodes reclaim the leases of a node that has stopped after LEASE_DURATION seconds.
+NODE_ID = os.getenv('NODE_ID', socket.gethostname())
+LEASE_DURATION = int(os.getenv('LEASE_DURATION', '600'))
+# XOS API requests: timeouts in seconds, and retries (with exponential backoff) on connection errors, 5xx and 429.
+# Final video updates that still fail are queued in XOS_UPDATE_QUEUE_PATH, and sent once XOS is answering again.
+XOS_CONNECT_TIMEOUT = 10
+XOS_READ_TIMEOUT = int(os.getenv('XOS_READ_TIMEOUT', '120'))
+XOS_RETRIES = int(os.getenv('XOS_RETRIES', '5'))
+XOS_BACKOFF_FACTOR = 2  # waits 0, 4, 8, 16... seconds between retries
+XOS_UPDATE_QUEUE_PATH = os.path.join(STATE_FOLDER, 'xos_update_queue.json')
+# seconds between ffmpeg progress log messages, and how many lines of ffmpeg's error output to keep for failures
+FFMPEG_PROGRESS_LOG_INTERVAL = 60
+FFMPEG_STDERR_LINES = 50
+# encode masters at least SEGMENT_MIN_DURATION seconds long in segments of about SEGMENT_DURATION seconds, several at
+# a time, with SEGMENT_THREADS encoder threads each (see lib/segmented.py)
+SEGMENTED_ENCODE = os.getenv('SEGMENTED_ENCODE', 'False') == 'True'
+SEGMENT_MIN_DURATION = int(os.getenv('SEGMENT_MIN_DURATION', '1800'))
+SEGMENT_DURATION = int(os.getenv('SEGMENT_DURATION', '120'))
+SEGMENT_THREADS = int(os.getenv('SEGMENT_THREADS', '4'))
+# encoder threads per job. 0 to share the cores between the jobs running and waiting (see lib/scheduler.py)
+ENCODE_THREADS = int(os.getenv('ENCODE_THREADS', '0'))
+# if set, step the x264 preset (within ENCODE_PRESETS: 'fastest,slowest') so that the queue is predicted to be encoded
+# within this many hours. ENCODE_SPEED_ESTIMATE is the media seconds per second this node encodes at veryslow, until
+# it has been measured.
+BACKLOG_TARGET_HOURS = float(os.getenv('BACKLOG_TARGET_HOURS', '0'))
+ENCODE_PRESETS = os.getenv('ENCODE_PRESETS', 'medium,veryslow')
+ENCODE_SPEED_ESTIMATE = float(os.getenv('ENCODE_SPEED_ESTIMATE', '0.4'))
+# copy (rather than encode) masters whose streams already meet the access profile (see lib/remux.py). For profiles
+# without a bit rate of their own (e.g. '-crf'), the master's video must be at most REMUX_MAX_VIDEO_BIT_RATE bits/s.
+REMUX_CONFORMING_MASTERS = os.getenv('REMUX_CONFORMING_MASTERS', 'True') == 'True'
+REMUX_MAX_VIDEO_BIT_RATE = int(os.getenv('REMUX_MAX_VIDEO_BIT_RATE', '12000000'))
+REMUX_BIT_RATE_TOLERANCE = 0.1  # how far a master's bit rates may be from a profile's
+# local folder to keep encoded outputs in, so the same master isn't encoded with the same profile twice (see
+# lib/output_cache.py). Empty to turn off. The least recently used outputs are removed over OUTPUT_CACHE_MAX_SIZE
+# bytes.
+OUTPUT_CACHE_FOLDER = os.getenv('OUTPUT_CACHE_FOLDER', '')
+OUTPUT_CACHE_MAX_SIZE = int(os.getenv('OUTPUT_CACHE_MAX_SIZE', str(500 * 1000 ** 3)))
+# local folder to stage masters and write outputs in (see lib/scratch.py). Empty to read masters from the watch mount
+# and write outputs to the system temporary folder. Jobs wait for room for their outputs, predicted at the bit rate of
+# their profiles or SCRATCH_ESTIMATED_BIT_RATE bits/s, leaving SCRATCH_MIN_FREE bytes free.
+SCRATCH_FOLDER = os.getenv('SCRATCH_FOLDER', '')
+SCRATCH_MIN_FREE = int(os.getenv('SCRATCH_MIN_FREE', str(10 * 1000 ** 3)))
+SCRATCH_ESTIMATED_BIT_RATE = int(os.getenv('SCRATCH_ESTIMATED_BIT_RATE', '20000000'))
+# port to serve metrics (e.g. ffmpeg progress) on in the Prometheus text format, at /metrics. 0 to turn off.
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+# a JSON line per job with the timings of its stages (see lib/perf.py). Summarise with `python -m lib.perf summary`
+PERF_LOG_PATH = os.getenv('PERF_LOG_PATH', os.path.join(STATE_FOLDER, 'perf.jsonl'))
+# where Slack notifications go: 'slack', 'file' (JSON lines in SLACK_FILE_PATH) or 'null'
+SLACK_BACKEND = os.getenv('SLACK_BACKEND', 'slack')
+SLACK_FILE_PATH = os.getenv('SLACK_FILE_PATH', os.path.join(STATE_FOLDER, 'slack.jsonl'))
+SLACK_MIN_INTERVAL = 1  # seconds between posts
+# this many or more waiting messages are posted as one digest
+SLACK_DIGEST_THRESHOLD = 5
+# if set, each job's log is also written to its own file in this folder
+JOB_LOG_FOLDER = os.getenv('JOB_LOG_FOLDER', '')
+
+# S3 uploads: files over the chunk size are uploaded in parts, S3_MAX_CONCURRENCY at a time. S3_MAX_BANDWIDTH is in
+# bytes per second per upload (0 for no limit).
+S3_MULTIPART_CHUNK_SIZE = int(os.getenv('S3_MULTIPART_CHUNK_SIZE', str(64 * 1024 * 1024)))
+S3_MAX_CONCURRENCY = int(os.getenv('S3_MAX_CONCURRENCY', '8'))
+S3_MAX_BANDWIDTH = int(os.getenv('S3_MAX_BANDWIDTH', '0'))
+S3_PROGRESS_INTERVAL = 30  # seconds between progress log messages
+
+# checksums computed (in one pass) for fixity, and written next to files as sidecars e.g. '.md5', '.sha256'.
+# md5 is always included. Any hashlib algorithm can be used, e.g. FIXITY_ALGORITHMS=md5,sha256,blake2b
+FIXITY_ALGORITHMS = [algorithm.strip() for algorithm in os.getenv('FIXITY_ALGORITHMS', 'md5').split(',')
+                     if algorithm.strip()]
+# files are read in FIXITY_BLOCK_SIZE blocks, up to FIXITY_QUEUE_DEPTH blocks ahead of the hashing and writing
+FIXITY_BLOCK_SIZE = int(os.getenv('FIXITY_BLOCK_SIZE', str(8 * 2 ** 20)))  # 8 MiB
+FIXITY_QUEUE_DEPTH = int(os.getenv('FIXITY_QUEUE_DEPTH', '8'))
+# read files through mmap rather than read-ahead buffers when hashing
+FIXITY_USE_MMAP = os.getenv('FIXITY_USE_MMAP', 'False') == 'True'
+# drop files from the page cache once they've been hashed or copied, so huge masters don't evict everything else
+FIXITY_DROP_CACHE = os.getenv('FIXITY_DROP_CACHE', 'True') == 'True'
+# re-read the destination of a fixity copy to check its md5, rather than trusting the write
+FIXITY_VERIFY_DESTINATION = os.getenv('FIXITY_VERIFY_DESTINATION', 'True') == 'True'
+
+# fixity copies are checkpointed every FIXITY_CHECKPOINT_SIZE bytes, so a failed copy can carry on from there
+FIXITY_CHECKPOINT_SIZE = int(os.getenv('FIXITY_CHECKPOINT_SIZE', str(256 * 2 ** 20)))  # 256 MiB
+
 # for retries when copying files between volumes fail
 MOVE_RETRIES = 5
-RETRY_WAIT = 300  # five minutes
+RETRY_BASE_WAIT = 5  # seconds before the first retry, doubling (with jitter) for each retry after that...
+RETRY_WAIT = 300  # ...up to five minutes
 
 MASTER_URL = "smb:" + os.getenv('SMB_MASTER', "//fsqcollnas.corp.acmi.net.au/Preservation%20Masters/")
 ACCESS_URL = "smb:" + os.getenv('SMB_ACCESS', "//fsqcollnas.corp.acmi.net.au/Access%20Copies/")
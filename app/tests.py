@@ -1,14 +1,53 @@
+import contextlib
+import csv
+import errno
+import hashlib
+import http.server
+import io
+import json
+import logging
+import os
 import shutil
+import sys
+import sqlite3
 import tempfile
+import threading
+import time
 import unittest
+from datetime import datetime
 from unittest import mock
 from unittest.mock import MagicMock
 
+import requests
+
 import settings
+import easyaccess
 from easyaccess import convert_and_get_metadata
 import lib.fixity as fixity
-from lib.ffmpeg import find_video_file, restricted_file
+import lib.ffmpeg as ffmpeg
+from lib.ffmpeg import (FFMPEGError, FFMPEGProgress, build_ffmpeg_command, find_video_file, find_video_files,
+                        is_locked, restricted_file, run_ffmpeg, split_global_args, with_progress_args)
+from lib.catalogue import METADATA_CSV_HEADERS, Catalogue
+from lib.catalogue import main as catalogue_main
 from lib.formatting import seconds_to_hms
+from lib.jobs import JobAborted, current_job_name, job_logging, run_worker_pool, set_abort_event
+from lib.journal import JobJournal, unfinished_jobs
+from lib.metrics import MetricsHandler, metrics
+from lib.output_cache import OutputCache, profile_hash
+from lib.output_cache import main as output_cache_main
+from lib.perf import job_record, read_records, span, summarise, timed
+from lib.perf import main as perf_main
+from lib.lease import LeaseManager, read_lease
+from lib.pipeline import Pipeline
+from lib.s3 import S3Uploader
+from lib.slack import FileBackend, SlackNotifier
+from lib.xos import XOSClient
+from lib.remux import conformance_problems, master_conforms, profile_constraints, remux_command
+from lib.scanner import ScanIndex
+from lib.scheduler import EncodeScheduler
+from lib.scratch import ScratchSpace, ScratchSpaceError, profile_bit_rate
+from lib.segmented import expected_frame_count, should_segment, split_stream_args
+from lib.watcher import Watcher
 
 
 class TestFormatting(unittest.TestCase):
@@ -60,6 +99,1484 @@ class TestFileHandling(unittest.TestCase):
         self.assertFalse(find_video_file('/code/app/test_data/restricted'))
 
 
+class TestScanIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.watch_folder = tempfile.mkdtemp()
+        self.state_folder = tempfile.mkdtemp()
+        self.index_path = os.path.join(self.state_folder, 'scan_index.json')
+        os.mkdir(os.path.join(self.watch_folder, 'a'))
+        os.mkdir(os.path.join(self.watch_folder, 'b'))
+        for name in ['a/B1_mo01_One.mov', 'a/notes.txt', 'b/B2_mo01_Two.mp4', 'b/B3_mo01_RESTRICTED_Three.mp4']:
+            open(os.path.join(self.watch_folder, name), 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.watch_folder)
+        shutil.rmtree(self.state_folder)
+
+    def age_folders(self):
+        """
+        Make the folders look as though they were last modified well before they are scanned.
+        """
+        an_hour_ago = time.time() - 3600
+        for folder in ['', 'a', 'b']:
+            os.utime(os.path.join(self.watch_folder, folder), (an_hour_ago, an_hour_ago))
+
+    def test_find_video_files(self):
+        with mock.patch.object(settings, 'SCAN_INDEX_PATH', self.index_path):
+            candidates = find_video_files(self.watch_folder)
+            self.assertEqual(candidates, [
+                os.path.join(self.watch_folder, 'a/B1_mo01_One.mov'),
+                os.path.join(self.watch_folder, 'b/B2_mo01_Two.mp4'),
+            ])
+            # restricted files are locked so they are skipped from then on
+            self.assertTrue(is_locked(os.path.join(self.watch_folder, 'b/B3_mo01_RESTRICTED_Three.mp4')))
+
+            self.assertEqual(find_video_file(self.watch_folder), candidates[0])
+            self.assertEqual(find_video_files(self.watch_folder), candidates[1:])
+
+    def test_unchanged_folders_are_not_listed(self):
+        self.age_folders()
+        index = ScanIndex(self.watch_folder, lambda name: name.endswith('.mov'), self.index_path)
+        index.scan()
+        with mock.patch('os.scandir', wraps=os.scandir) as scandir:
+            ScanIndex(self.watch_folder, lambda name: name.endswith('.mov'), self.index_path).scan()
+            self.assertEqual(scandir.call_count, 0)
+
+            open(os.path.join(self.watch_folder, 'b', 'B4_mo01_Four.mov'), 'w').close()
+            folders = index.scan()
+            self.assertEqual(scandir.call_count, 1)
+        self.assertEqual(folders[os.path.join(self.watch_folder, 'b')], ['B4_mo01_Four.mov'])
+
+    def test_racy_folders_are_listed_again(self):
+        folder = os.path.join(self.watch_folder, 'a')
+        index = ScanIndex(self.watch_folder, lambda name: name.endswith('.mov'))
+        index.scan()
+        # a file created in the same tick of the folder's modification time as it was listed
+        mtime_ns = os.stat(folder).st_mtime_ns
+        open(os.path.join(folder, 'B4_mo01_Four.mov'), 'w').close()
+        os.utime(folder, ns=(mtime_ns, mtime_ns))
+        self.assertEqual(index.scan()[folder], ['B1_mo01_One.mov', 'B4_mo01_Four.mov'])
+
+
+class TestFixity(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.source_path = os.path.join(self.folder, 'master.mov')
+        self.contents = os.urandom(3 * 2 ** 20 + 123)
+        with open(self.source_path, 'wb') as f:
+            f.write(self.contents)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    @mock.patch.object(settings, 'FIXITY_BLOCK_SIZE', 2 ** 20)
+    def test_fixity_copy(self):
+        destination_folder = os.path.join(self.folder, 'destination')
+        os.mkdir(destination_folder)
+        destination_path = fixity.fixity_copy(self.source_path, destination_folder)
+        self.assertEqual(destination_path, os.path.join(destination_folder, 'master.mov'))
+        self.assertEqual(self.read(destination_path), self.contents)
+        digest = hashlib.md5(self.contents).hexdigest()
+        self.assertEqual(self.read(self.source_path + '.md5').decode(), digest)
+        self.assertEqual(self.read(destination_path + '.md5').decode(), digest)
+
+    def test_fixity_copy_verifies_destination(self):
+        with mock.patch('lib.fixity.hash_file', return_value={'md5': 'corrupted'}):
+            with self.assertRaises(IOError):
+                fixity.fixity_copy(self.source_path, os.path.join(self.folder, 'copy.mov'))
+
+    def test_fixity_move(self):
+        destination_path = fixity.fixity_move(self.source_path, os.path.join(self.folder, 'moved.mov'))
+        self.assertFalse(os.path.exists(self.source_path))
+        self.assertFalse(os.path.exists(self.source_path + '.md5'))
+        self.assertEqual(self.read(destination_path), self.contents)
+
+    def test_checksum_cache(self):
+        db_path = os.path.join(self.folder, 'checksums.sqlite3')
+        with mock.patch.object(fixity, 'checksum_cache', fixity.ChecksumCache(db_path)):
+            digest = fixity.generate_file_md5(self.source_path)
+            with mock.patch('hashlib.md5') as md5:
+                self.assertEqual(fixity.generate_file_md5(self.source_path), digest)
+                md5.assert_not_called()
+
+            # the same unchanged file is still known after a restart
+            fixity.checksum_cache = fixity.ChecksumCache(db_path)
+            with mock.patch('hashlib.md5') as md5:
+                self.assertEqual(fixity.generate_file_md5(self.source_path), digest)
+                md5.assert_not_called()
+
+            # but a changed file is hashed again
+            with open(self.source_path, 'ab') as f:
+                f.write(b'more')
+            changed_digest = hashlib.md5(self.contents + b'more').hexdigest()
+            self.assertEqual(fixity.generate_file_md5(self.source_path), changed_digest)
+
+    def test_fixity_copy_checks_source_against_cached_md5(self):
+        with mock.patch.object(fixity, 'checksum_cache', fixity.ChecksumCache()):
+            fixity.checksum_cache.put(fixity.file_identity(self.source_path), 'stale')
+            with self.assertRaises(IOError):
+                fixity.fixity_copy(self.source_path, os.path.join(self.folder, 'copy.mov'))
+
+    def test_hash_file_algorithms(self):
+        expected = {
+            'md5': hashlib.md5(self.contents).hexdigest(),
+            'sha256': hashlib.sha256(self.contents).hexdigest(),
+            'blake2b': hashlib.blake2b(self.contents).hexdigest(),
+        }
+        for use_mmap in [False, True]:
+            digests = fixity.hash_file(
+                self.source_path, ['sha256', 'blake2b'], blocksize=2 ** 20, store=True, use_cache=False,
+                use_mmap=use_mmap,
+            )
+            self.assertEqual(digests, expected)
+        for algorithm, digest in expected.items():
+            self.assertEqual(self.read('%s.%s' % (self.source_path, algorithm)).decode(), digest)
+
+    @mock.patch.object(settings, 'FIXITY_ALGORITHMS', ['md5', 'sha256'])
+    def test_fixity_move_algorithms(self):
+        destination_path = fixity.fixity_move(self.source_path, os.path.join(self.folder, 'moved.mov'))
+        self.assertEqual(self.read(destination_path + '.sha256').decode(), hashlib.sha256(self.contents).hexdigest())
+        self.assertFalse(os.path.exists(self.source_path + '.sha256'))
+
+    def test_fixity_move_renames_within_filesystem(self):
+        source_inode = os.stat(self.source_path).st_ino
+        with mock.patch('lib.fixity.fixity_copy') as fixity_copy:
+            destination_path = fixity.fixity_move(self.source_path, os.path.join(self.folder, 'renamed.mov'))
+            fixity_copy.assert_not_called()
+        self.assertEqual(os.stat(destination_path).st_ino, source_inode)
+        self.assertEqual(self.read(destination_path + '.md5').decode(), hashlib.md5(self.contents).hexdigest())
+
+    def test_fixity_move_with_failsafe_renames_within_filesystem(self):
+        failsafe_folder = os.path.join(self.folder, 'failsafe')
+        os.mkdir(failsafe_folder)
+        fixity.generate_file_md5(self.source_path, store=True)
+        with mock.patch('lib.fixity.fixity_copy') as fixity_copy:
+            destination_path = fixity.fixity_move(self.source_path, os.path.join(self.folder, 'renamed.mov'),
+                                                  failsafe_folder=failsafe_folder)
+            fixity_copy.assert_not_called()
+        self.assertFalse(os.path.exists(self.source_path))
+        failsafe_path = os.path.join(failsafe_folder, 'master.mov')
+        self.assertTrue(os.path.samefile(failsafe_path, destination_path))
+        self.assertEqual(self.read(failsafe_path + '.md5').decode(), hashlib.md5(self.contents).hexdigest())
+
+    def test_fixity_move_with_failsafe_falls_back_to_copying(self):
+        failsafe_folder = os.path.join(self.folder, 'failsafe')
+        os.mkdir(failsafe_folder)
+        cross_device = OSError(errno.EXDEV, 'Invalid cross-device link')
+        with mock.patch('lib.fixity.rename_move', side_effect=cross_device):
+            destination_path = fixity.fixity_move(self.source_path, os.path.join(self.folder, 'moved.mov'),
+                                                  failsafe_folder=failsafe_folder)
+        # the master has left the watch folder, rather than being "moved" onto its own failsafe link
+        self.assertFalse(os.path.exists(self.source_path))
+        self.assertEqual(self.read(destination_path), self.contents)
+        self.assertEqual(self.read(os.path.join(failsafe_folder, 'master.mov')), self.contents)
+
+    def test_rename_does_not_overwrite_destination(self):
+        destination_path = os.path.join(self.folder, 'renamed.mov')
+        with open(destination_path, 'wb') as f:
+            f.write(b'another file')
+        with self.assertRaises(IOError):
+            fixity.rename_move(self.source_path, destination_path)
+        self.assertEqual(self.read(destination_path), b'another file')
+        self.assertTrue(os.path.exists(self.source_path))
+
+    def test_rename_checks_recorded_md5(self):
+        fixity.store_md5(self.source_path, 'recorded before the file was changed')
+        with self.assertRaises(IOError):
+            fixity.fixity_move(self.source_path, os.path.join(self.folder, 'renamed.mov'))
+        self.assertTrue(os.path.exists(self.source_path))
+
+    def test_fixity_copy_of_hashed_file_uses_kernel_copy(self):
+        fixity.generate_file_md5(self.source_path)
+        with mock.patch.object(fixity.ResumableCopy, '_stream_copy') as stream_copy:
+            destination_path = fixity.fixity_copy(self.source_path, os.path.join(self.folder, 'copy.mov'))
+            stream_copy.assert_not_called()
+        self.assertEqual(self.read(destination_path), self.contents)
+
+    def test_kernel_copy_falls_back(self):
+        unsupported = OSError(errno.EXDEV, 'Invalid cross-device link')
+        known_digests = {'md5': hashlib.md5(self.contents).hexdigest()}
+        for patches in [['copy_file_range'], ['copy_file_range', 'sendfile']]:
+            destination_path = os.path.join(self.folder, 'copy_%d.mov' % len(patches))
+            with contextlib.ExitStack() as stack:
+                for name in patches:
+                    stack.enter_context(mock.patch('os.%s' % name, side_effect=unsupported, create=True))
+                copier = fixity.ResumableCopy(self.source_path, destination_path, known_digests=known_digests)
+                self.assertEqual(copier.copy(), known_digests)
+                copier.finish()
+            self.assertEqual(self.read(destination_path), self.contents)
+
+    def flaky_read_blocks(self, fail_after_blocks):
+        """
+        Return a read_blocks that fails part way through the first time it's called, and the offsets it was asked to
+        start reading from.
+        """
+        real_read_blocks = fixity.read_blocks
+        starts = []
+
+        def read_blocks(path, *args, **kwargs):
+            starts.append(kwargs.get('start', 0))
+            for i, buf in enumerate(real_read_blocks(path, *args, **kwargs)):
+                if len(starts) == 1 and i == fail_after_blocks:
+                    raise OSError(errno.EIO, 'Input/output error')
+                yield buf
+        return read_blocks, starts
+
+    @mock.patch.object(settings, 'FIXITY_BLOCK_SIZE', 2 ** 19)
+    @mock.patch.object(settings, 'FIXITY_CHECKPOINT_SIZE', 2 ** 20)
+    @mock.patch('time.sleep', MagicMock())
+    def test_fixity_copy_resumes_after_error(self):
+        read_blocks, starts = self.flaky_read_blocks(fail_after_blocks=5)
+        with mock.patch('lib.fixity.read_blocks', side_effect=read_blocks):
+            destination_path = fixity.fixity_copy(self.source_path, os.path.join(self.folder, 'copy.mov'))
+        # the second attempt carries on from the last checkpoint, not byte zero
+        self.assertEqual(starts[:2], [0, 2 * 2 ** 20])
+        self.assertEqual(self.read(destination_path), self.contents)
+        self.assertEqual(self.read(destination_path + '.md5').decode(), hashlib.md5(self.contents).hexdigest())
+        self.assertFalse(os.path.exists(destination_path + '.part'))
+        self.assertFalse(os.path.exists(destination_path + '.part.json'))
+
+    @mock.patch.object(settings, 'FIXITY_BLOCK_SIZE', 2 ** 19)
+    @mock.patch.object(settings, 'FIXITY_CHECKPOINT_SIZE', 2 ** 20)
+    def test_resumable_copy_after_restart(self):
+        destination_path = os.path.join(self.folder, 'copy.mov')
+        read_blocks, _ = self.flaky_read_blocks(fail_after_blocks=5)
+        with mock.patch('lib.fixity.read_blocks', side_effect=read_blocks):
+            with self.assertRaises(OSError):
+                fixity.ResumableCopy(self.source_path, destination_path).copy()
+
+        # a new process picks up the checkpoints, but only trusts chunks of the '.part' file that still verify
+        self.assertEqual(fixity.ResumableCopy(self.source_path, destination_path).offset, 2 * 2 ** 20)
+        with open(destination_path + '.part', 'r+b') as part:
+            part.seek(2 ** 20 + 10)
+            part.write(b'damaged')
+        copier = fixity.ResumableCopy(self.source_path, destination_path)
+        self.assertEqual(copier.offset, 2 ** 20)
+        self.assertEqual(copier.copy(), {'md5': hashlib.md5(self.contents).hexdigest()})
+        copier.finish()
+        self.assertEqual(self.read(destination_path), self.contents)
+
+    @mock.patch.object(settings, 'RETRY_BASE_WAIT', 5)
+    @mock.patch.object(settings, 'RETRY_WAIT', 300)
+    def test_retry_delay(self):
+        for retries, maximum in [(1, 5), (2, 10), (3, 20), (10, 300)]:
+            delay = fixity.retry_delay(retries)
+            self.assertGreaterEqual(delay, maximum / 2)
+            self.assertLessEqual(delay, maximum)
+
+    def test_read_blocks_raises_read_errors(self):
+        with self.assertRaises(OSError):
+            list(fixity.read_blocks(os.path.join(self.folder, 'missing.mov')))
+
+
+FFPROBE_OUTPUT = {
+    'streams': [
+        {'codec_type': 'video', 'codec_name': 'h264', 'avg_frame_rate': '25/1', 'width': 1920, 'height': 1080,
+         'bit_rate': '5000000'},
+        {'codec_type': 'audio', 'codec_name': 'aac', 'channels': 2, 'sample_rate': '48000', 'bit_rate': '320000'},
+    ],
+    'format': {'duration': '72.5', 'bit_rate': '5320000'},
+}
+
+
+class TestProbeCache(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.video_paths = []
+        for i in range(3):
+            path = os.path.join(self.folder, 'video_%d.mp4' % i)
+            with open(path, 'w') as f:
+                f.write('video %d' % i)
+            fixity.generate_file_md5(path, store=True)
+            self.video_paths.append(path)
+        self.db_path = os.path.join(self.folder, 'probes.sqlite3')
+        patcher = mock.patch.object(ffmpeg, 'probe_cache', ffmpeg.ProbeCache(self.db_path))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def mock_ffprobe(self):
+        result = MagicMock(stdout=json.dumps(FFPROBE_OUTPUT).encode('utf-8'))
+        return mock.patch('subprocess.run', return_value=result)
+
+    def test_get_video_metadata_is_cached(self):
+        with self.mock_ffprobe() as run:
+            metadata = ffmpeg.get_video_metadata(self.video_paths[0])
+            self.assertEqual(ffmpeg.get_video_metadata(self.video_paths[0]), metadata)
+            self.assertEqual(run.call_count, 1)
+        self.assertEqual(metadata['video_codec'], 'h264')
+        self.assertEqual(metadata['duration_hms'], '00:01:12:12')
+        self.assertEqual(metadata['checksum'], hashlib.md5(b'video 0').hexdigest())
+
+        # still cached after a restart, along with the raw ffprobe output
+        ffmpeg.probe_cache = ffmpeg.ProbeCache(self.db_path)
+        with self.mock_ffprobe() as run:
+            probe, cached_metadata = ffmpeg.get_video_probe(self.video_paths[0])
+            run.assert_not_called()
+        self.assertEqual(probe, FFPROBE_OUTPUT)
+        self.assertEqual(cached_metadata['width'], 1920)
+
+    def test_get_videos_metadata(self):
+        with self.mock_ffprobe() as run:
+            ffmpeg.get_video_metadata(self.video_paths[0])
+            all_metadata = ffmpeg.get_videos_metadata(self.video_paths)
+            self.assertEqual(run.call_count, 3)
+        self.assertEqual(list(all_metadata), self.video_paths)
+        self.assertEqual(all_metadata[self.video_paths[2]]['checksum'], hashlib.md5(b'video 2').hexdigest())
+
+
+class TestCatalogue(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.folder, 'catalogue.sqlite3')
+        self.catalogue = Catalogue(self.db_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def metadata(self, vernon_id, checksum):
+        return {'vernon_id': vernon_id, 'title': 'Title', 'filetype': 'mo01', 'checksum': checksum,
+                'duration_secs': 72.5, 'width': 1920, 'encoder': 'libx264'}
+
+    def count_written(self):
+        with sqlite3.connect(self.db_path) as db:
+            return db.execute('SELECT COUNT(*) FROM metadata').fetchone()[0]
+
+    def test_writes_are_batched(self):
+        with mock.patch.object(settings, 'CATALOGUE_BATCH_SIZE', 3):
+            self.catalogue.add(self.metadata('B1', 'aaa'))
+            self.catalogue.add(self.metadata('B2', 'bbb'))
+            self.assertFalse(os.path.exists(self.db_path))
+            self.catalogue.add(self.metadata('B3', 'ccc'))
+            self.assertEqual(self.count_written(), 3)
+            self.catalogue.add(self.metadata('B4', 'ddd'))
+            self.assertEqual(self.count_written(), 3)
+            self.catalogue.flush()
+            self.assertEqual(self.count_written(), 4)
+
+    def test_entries(self):
+        self.catalogue.add(self.metadata('B1', 'aaa'), recorded_at=datetime(2020, 10, 16))
+        self.catalogue.add(self.metadata('B2', 'bbb'), recorded_at=datetime(2020, 10, 17))
+        entries = self.catalogue.entries(checksum='bbb')
+        self.assertEqual([entry['vernon_id'] for entry in entries], ['B2'])
+        self.assertEqual(json.loads(entries[0]['extra']), {'encoder': 'libx264'})
+        self.assertEqual(len(self.catalogue.entries(date_from='20201017')), 1)
+        self.assertEqual(len(self.catalogue.entries(vernon_id='B1', date_to='20201016')), 1)
+
+    def test_export_and_import_csv(self):
+        self.catalogue.add(self.metadata('B1', 'aaa'), recorded_at=datetime(2020, 10, 17))
+        self.catalogue.add(self.metadata('B2', 'bbb'), recorded_at=datetime(2020, 10, 18))
+        self.catalogue.flush()
+        csv_path = os.path.join(self.folder, '20201017_metadata.csv')
+        catalogue_main(['--catalogue', self.db_path, 'export', '--date', '20201017', '--output', csv_path])
+        with open(csv_path) as f:
+            rows = list(csv.reader(f))
+        self.assertEqual(rows[0], METADATA_CSV_HEADERS)
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[1][METADATA_CSV_HEADERS.index('checksum')], 'aaa')
+
+        imported = Catalogue(os.path.join(self.folder, 'imported.sqlite3'))
+        self.assertEqual(imported.import_csv(csv_path), 1)
+        entry = imported.entries(checksum='aaa')[0]
+        self.assertEqual(entry['recorded_date'], '20201017')
+        self.assertEqual(entry['vernon_id'], 'B1')
+
+
+class LocalS3Client:
+    """
+    Stands in for a boto3 S3 client, storing uploads in a local folder.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def upload_file(self, Filename, Bucket, Key, Config=None, Callback=None):
+        destination = os.path.join(self.folder, Bucket, Key)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        with open(Filename, 'rb') as source, open(destination, 'wb') as f:
+            for buf in iter(lambda: source.read(Config.multipart_chunksize), b''):
+                f.write(buf)
+                if Callback:
+                    Callback(len(buf))
+
+
+class TestS3Uploader(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'B1_ao01_Title.mp4')
+        with open(self.path, 'wb') as f:
+            f.write(os.urandom(3 * 1024 * 1024 + 5))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def uploaded_path(self, key):
+        return os.path.join(self.folder, 's3', 'bucket', key)
+
+    @mock.patch.object(settings, 'S3_MULTIPART_CHUNK_SIZE', 1024 * 1024)
+    @mock.patch.object(settings, 'S3_MAX_CONCURRENCY', 4)
+    @mock.patch.object(settings, 'S3_PROGRESS_INTERVAL', 0)
+    def test_upload(self):
+        uploader = S3Uploader(LocalS3Client(os.path.join(self.folder, 's3')), 'bucket', 'location')
+        self.assertEqual(uploader.transfer_config.multipart_chunksize, 1024 * 1024)
+        self.assertEqual(uploader.transfer_config.max_request_concurrency, 4)
+        with self.assertLogs(level='INFO') as logs:
+            key = uploader.upload(self.path)
+        self.assertEqual(key, 'location/B1_ao01_Title.mp4')
+        with open(self.path, 'rb') as source, open(self.uploaded_path(key), 'rb') as uploaded:
+            self.assertEqual(source.read(), uploaded.read())
+        self.assertEqual(len(logs.records), 4)
+        self.assertIn('100.0%', logs.records[-1].getMessage())
+
+    def test_client_is_reused(self):
+        with mock.patch('lib.s3.boto3.client', return_value=LocalS3Client(os.path.join(self.folder, 's3'))) as client:
+            uploader = S3Uploader(bucket='bucket', location='location')
+            uploader.upload(self.path)
+            uploader.upload(self.path)
+        client.assert_called_once()
+
+
+class RecordingSlackBackend:
+
+    def __init__(self):
+        self.sent = []
+        self.sending = threading.Event()
+        self.release = threading.Event()
+
+    def send(self, channel, text, **kwargs):
+        # hold up the first message, like a slow Slack API
+        self.sending.set()
+        self.release.wait(5)
+        self.sent.append((channel, text, kwargs))
+
+
+class TestSlackNotifier(unittest.TestCase):
+
+    def test_post_never_blocks(self):
+        backend = RecordingSlackBackend()
+        notifier = SlackNotifier(backend, min_interval=0)
+        started = time.monotonic()
+        notifier.post('#channel', 'New file')
+        self.assertLess(time.monotonic() - started, 1)
+        backend.release.set()
+        self.assertTrue(notifier.flush())
+        self.assertEqual(backend.sent, [('#channel', 'New file', {})])
+
+    def test_bursts_are_coalesced(self):
+        backend = RecordingSlackBackend()
+        notifier = SlackNotifier(backend, min_interval=0, digest_threshold=3)
+        notifier.post('#channel', 'first')
+        backend.sending.wait(5)
+        for i in range(5):
+            notifier.post('#channel', 'New file %d' % i, attachments=[{'fallback': str(i)}])
+        notifier.post('#other', 'elsewhere')
+        backend.release.set()
+        self.assertTrue(notifier.flush())
+
+        self.assertEqual(len(backend.sent), 3)
+        self.assertEqual(backend.sent[0], ('#channel', 'first', {}))
+        channel, digest, kwargs = backend.sent[1]
+        self.assertEqual(channel, '#channel')
+        self.assertTrue(digest.startswith('5 notifications:'))
+        self.assertIn('New file 4', digest)
+        self.assertEqual(len(kwargs['attachments']), 5)
+        self.assertEqual(backend.sent[2], ('#other', 'elsewhere', {}))
+
+    def test_file_backend(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        path = os.path.join(folder, 'slack.jsonl')
+        notifier = SlackNotifier(FileBackend(path), min_interval=0)
+        notifier.post('#channel', 'one')
+        notifier.post('#channel', 'two', attachments=[])
+        self.assertTrue(notifier.flush())
+        with open(path) as f:
+            messages = [json.loads(line) for line in f]
+        self.assertEqual([message['text'] for message in messages], ['one', 'two'])
+
+
+class StubXOSHandler(http.server.BaseHTTPRequestHandler):
+    """
+    A stand-in for the XOS assets API. server.responses holds a list of (status, json) responses to give, in order,
+    after which it answers 200 {}.
+    """
+
+    def respond(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self.server.requests.append((self.command, self.path, json.loads(body) if body else None))
+        status, response = self.server.responses.pop(0) if self.server.responses else (200, {})
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(json.dumps(response).encode())
+
+    do_GET = do_POST = do_PATCH = respond
+
+    def log_message(self, *args):
+        pass
+
+
+class TestXOSClient(unittest.TestCase):
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StubXOSHandler)
+        self.server.requests = []
+        self.server.responses = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.folder = tempfile.mkdtemp()
+        self.client = XOSClient(
+            'http://127.0.0.1:%d/api/' % self.server.server_port, 'token',
+            retries=2, backoff_factor=0, update_queue_path=os.path.join(self.folder, 'queue.json'),
+        )
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.folder)
+
+    def test_stub_lookups_are_retried_and_cached(self):
+        self.server.responses = [(503, {}), (200, {'count': 0, 'results': []}), (201, {'id': 42})]
+        video_data = {'title': 'B1_mo01_Title.mov NOT UPLOADED',
+                      'master_metadata': {'checksum': 'abc', 'creation_datetime': datetime(2020, 10, 17)}}
+        self.assertEqual(self.client.get_or_create_stub_video(video_data), 42)
+        self.assertEqual(self.client.get_or_create_stub_video(video_data), 42)
+        self.assertEqual([(method, path) for method, path, _ in self.server.requests], [
+            ('GET', '/api/assets/?title_contains=NOT+UPLOADED&checksum=abc'),
+            ('GET', '/api/assets/?title_contains=NOT+UPLOADED&checksum=abc'),
+            ('POST', '/api/assets/'),
+        ])
+        self.assertEqual(self.server.requests[2][2]['master_metadata']['creation_datetime'], '2020-10-17 00:00:00')
+
+    def test_stub_creation_is_retried_by_looking_it_up_again(self):
+        # the POST failed, but created the stub anyway
+        self.server.responses = [
+            (200, {'count': 0, 'results': []}), (503, {}), (200, {'count': 1, 'results': [{'id': 7}]}),
+        ]
+        video_data = {'title': 'B1_mo01_Title.mov NOT UPLOADED', 'master_metadata': {'checksum': 'abc'}}
+        self.assertEqual(self.client.get_or_create_stub_video(video_data), 7)
+        self.assertEqual([method for method, _, _ in self.server.requests], ['GET', 'POST', 'GET'])
+
+    def test_one_stub_per_master(self):
+        self.server.responses = [(200, {'count': 0, 'results': []}), (201, {'id': 42})]
+        video_data = {'title': 'B1_mo01_Title.mov NOT UPLOADED', 'master_metadata': {'checksum': 'abc'}}
+        asset_ids = []
+        threads = [threading.Thread(target=lambda: asset_ids.append(self.client.get_or_create_stub_video(video_data)))
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(asset_ids, [42] * 4)
+        self.assertEqual([method for method, _, _ in self.server.requests], ['GET', 'POST'])
+
+    def test_failed_updates_are_queued(self):
+        self.server.responses = [(503, {})] * 3
+        self.client.update_final_video(42, {'title': 'B1_mo01_Title.mov'})
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(self.client.pending_updates(), {'42': {'title': 'B1_mo01_Title.mov'}})
+
+        # the next update flushes the queue once XOS is answering again
+        self.client.update_final_video(43, {'title': 'B2_mo01_Title.mov'})
+        self.assertEqual([(method, path) for method, path, _ in self.server.requests[3:]], [
+            ('PATCH', '/api/assets/43/'),
+            ('PATCH', '/api/assets/42/'),
+        ])
+        self.assertEqual(self.client.pending_updates(), {})
+
+    def test_rejected_updates_are_raised(self):
+        self.server.responses = [(400, {'title': ['This field is required.']})]
+        with self.assertRaises(requests.HTTPError):
+            self.client.update_final_video(42, {})
+        self.assertEqual(self.client.pending_updates(), {})
+
+
+class TestFFMPEGCommand(unittest.TestCase):
+
+    def test_split_global_args(self):
+        global_args, output_args = split_global_args(settings.ACCESS_FFMPEG_ARGS)
+        self.assertEqual(global_args, ['-loglevel', 'panic', '-stats', '-hide_banner', '-n'])
+        self.assertNotIn('-n', output_args)
+        self.assertEqual(output_args[:2], ['-pix_fmt', 'yuv420p'])
+
+    def test_single_decode_multiple_outputs(self):
+        args = build_ffmpeg_command(
+            'master.mov',
+            [(settings.ACCESS_FFMPEG_ARGS, 'access.mp4'), (settings.WEB_FFMPEG_ARGS, 'web.mp4')],
+        )
+        self.assertEqual(args.count('-i'), 1)
+        self.assertEqual(args.count('-loglevel'), 1)
+        self.assertEqual(args[-1], 'web.mp4')
+        self.assertLess(args.index('-i'), args.index('-c:v'))
+        # each output keeps its own encoder arguments
+        access_args = args[args.index('master.mov') + 1:args.index('access.mp4')]
+        web_args = args[args.index('access.mp4') + 1:args.index('web.mp4')]
+        self.assertEqual(access_args[access_args.index('-crf') + 1], '23')
+        self.assertEqual(web_args[web_args.index('-crf') + 1], '28')
+
+
+class TestSegmentedEncode(unittest.TestCase):
+
+    def test_split_stream_args(self):
+        video_args, audio_args = split_stream_args(settings.EXHIBITIONS_ACCESS_FFMPEG_ARGS)
+        self.assertEqual(audio_args, ['-c:a', 'aac', '-ab', '320k', '-ac', '2', '-ar', '48000'])
+        self.assertIn('-vf', video_args)
+        self.assertNotIn('-n', video_args)
+
+    def test_expected_frame_count(self):
+        self.assertEqual(expected_frame_count(settings.ACCESS_FFMPEG_ARGS, 7200.0, 172800, 60), (172800, 0))
+        # converting 24 fps to 25 fps
+        self.assertEqual(expected_frame_count(['-r', '25'], 7200.0, 172800, 60), (180000, 60))
+        self.assertEqual(expected_frame_count(['-r', '30000/1001'], 10.01, 240, 1), (300, 1))
+
+    def test_only_long_masters_are_segmented(self):
+        with mock.patch.object(settings, 'SEGMENTED_ENCODE', True):
+            self.assertTrue(should_segment(settings.SEGMENT_MIN_DURATION))
+            self.assertFalse(should_segment(settings.SEGMENT_MIN_DURATION - 1))
+            self.assertFalse(should_segment(None))
+        self.assertFalse(should_segment(settings.SEGMENT_MIN_DURATION))
+
+
+class TestEncodeScheduler(unittest.TestCase):
+
+    def scheduler(self, **kwargs):
+        options = {'cpu_count': 16, 'concurrent_jobs': 2, 'target_hours': 0, 'preset_range': 'medium,veryslow',
+                   'speed': 1.0}
+        options.update(kwargs)
+        return EncodeScheduler(**options)
+
+    def test_threads_are_shared_between_jobs(self):
+        scheduler = self.scheduler()
+        self.assertEqual(scheduler.plan([settings.ACCESS_FFMPEG_ARGS], 3600, queue_depth=0)['threads'], 16)
+        self.assertEqual(scheduler.plan([settings.ACCESS_FFMPEG_ARGS], 3600, queue_depth=5)['threads'], 8)
+        with scheduler.encoding([settings.ACCESS_FFMPEG_ARGS], 3600, queue_depth=0) as decision:
+            self.assertEqual(decision['threads'], 16)
+            self.assertEqual(scheduler.plan([settings.ACCESS_FFMPEG_ARGS], 3600, queue_depth=0)['threads'], 8)
+
+    def test_preset_is_stepped_to_meet_the_target(self):
+        scheduler = self.scheduler(target_hours=1)
+        decision = scheduler.plan([settings.ACCESS_FFMPEG_ARGS], 3600, queue_depth=0)
+        self.assertEqual(decision['preset'], 'veryslow')
+        self.assertFalse(decision['preset_changed'])
+        self.assertEqual(decision['predicted_drain_hours'], 1)
+
+        # five hours of masters, at 5x the speed of veryslow
+        decision = scheduler.plan([settings.ACCESS_FFMPEG_ARGS], 3600, queue_depth=4)
+        self.assertEqual(decision['preset'], 'medium')
+        self.assertTrue(decision['preset_changed'])
+        args = scheduler.apply(settings.ACCESS_FFMPEG_ARGS, decision, threads=4)
+        self.assertEqual(args[args.index('-preset') + 1], 'medium')
+        self.assertEqual(args[-2:], ['-threads', '4'])
+        self.assertEqual(settings.ACCESS_FFMPEG_ARGS[settings.ACCESS_FFMPEG_ARGS.index('-preset') + 1], 'veryslow')
+
+        # no allowed preset is fast enough
+        self.assertEqual(scheduler.plan([settings.ACCESS_FFMPEG_ARGS], 3600, queue_depth=20)['preset'], 'medium')
+
+    def test_profiles_without_a_preset_are_left_alone(self):
+        decision = self.scheduler(target_hours=1).plan([settings.EXHIBITIONS_ACCESS_FFMPEG_ARGS], 3600, queue_depth=9)
+        self.assertIsNone(decision['preset'])
+        self.assertEqual(EncodeScheduler.apply(settings.EXHIBITIONS_ACCESS_FFMPEG_ARGS, decision),
+                         settings.EXHIBITIONS_ACCESS_FFMPEG_ARGS + ['-threads', '8'])
+
+    def test_speed_is_measured(self):
+        scheduler = self.scheduler()
+        decision = scheduler.plan([settings.ACCESS_FFMPEG_ARGS], 3600, queue_depth=0)
+        # 1800s at veryslow on all 16 cores
+        scheduler.record(decision, 3600, 1800)
+        self.assertAlmostEqual(scheduler.speed, 1.3)
+
+
+def born_digital_probe(video=None, audio=None):
+    """
+    ffprobe's output for an h264/AAC master, with some of its streams' fields replaced.
+    """
+    video_stream = {'codec_type': 'video', 'codec_name': 'h264', 'pix_fmt': 'yuv420p', 'field_order': 'progressive',
+                    'width': 1920, 'height': 1080, 'avg_frame_rate': '25/1', 'bit_rate': '8000000'}
+    audio_stream = {'codec_type': 'audio', 'codec_name': 'aac', 'channels': 2, 'sample_rate': '48000',
+                    'bit_rate': '320000'}
+    video_stream.update(video or {})
+    audio_stream.update(audio or {})
+    return {'streams': [video_stream, audio_stream], 'format': {'duration': '60.0', 'bit_rate': '8320000'}}
+
+
+class TestRemux(unittest.TestCase):
+
+    def problems(self, ffmpeg_args, probe):
+        metadata = ffmpeg.metadata_from_probe('/code/app/test_data/watch/B2004203_mo01_AmazingVideo.mp4', probe)
+        return conformance_problems(probe, metadata, profile_constraints(ffmpeg_args))
+
+    def test_profile_constraints(self):
+        constraints = profile_constraints(settings.EXHIBITIONS_ACCESS_FFMPEG_ARGS)
+        self.assertEqual(constraints['video_codec'], 'h264')
+        self.assertEqual(constraints['audio_codec'], 'aac')
+        self.assertEqual((constraints['width'], constraints['height']), (1920, 1080))
+        self.assertEqual(constraints['video_frame_rate'], 25)
+        self.assertEqual(constraints['min_video_bit_rate'], 18000000)
+        self.assertEqual(profile_constraints(settings.ACCESS_FFMPEG_ARGS)['max_video_bit_rate'],
+                         settings.REMUX_MAX_VIDEO_BIT_RATE)
+        # a copy can't be filtered
+        self.assertIsNone(profile_constraints(['-c:v', 'libx264', '-vf', 'yadif']))
+
+    def test_conforming_master(self):
+        self.assertEqual(self.problems(settings.ACCESS_FFMPEG_ARGS, born_digital_probe()), [])
+        self.assertEqual(self.problems(settings.EXHIBITIONS_ACCESS_FFMPEG_ARGS, born_digital_probe(
+            video={'bit_rate': '20000000'})), [])
+
+    def test_non_conforming_masters(self):
+        prores = born_digital_probe(video={'codec_name': 'prores'})
+        self.assertEqual(self.problems(settings.ACCESS_FFMPEG_ARGS, prores), ['video codec is prores, not h264'])
+        self.assertEqual(len(self.problems(settings.ACCESS_FFMPEG_ARGS, born_digital_probe(
+            video={'pix_fmt': 'yuv422p10le', 'field_order': 'tt'}))), 2)
+        # under the exhibitions bit rate, and the wrong size
+        self.assertEqual(len(self.problems(settings.EXHIBITIONS_ACCESS_FFMPEG_ARGS, born_digital_probe(
+            video={'width': 1280, 'height': 720}))), 3)
+        pcm_audio = born_digital_probe(audio={'codec_name': 'pcm_s24le'})
+        self.assertEqual(self.problems(settings.ACCESS_FFMPEG_ARGS, pcm_audio), ['audio codec is pcm_s24le, not aac'])
+
+    @mock.patch('lib.remux.get_video_probe')
+    def test_master_conforms(self, get_video_probe):
+        source_path = '/code/app/test_data/watch/B2004203_mo01_AmazingVideo.mp4'
+        probe = born_digital_probe()
+        get_video_probe.return_value = (probe, ffmpeg.metadata_from_probe(source_path, probe))
+        self.assertTrue(master_conforms(source_path, settings.ACCESS_FFMPEG_ARGS))
+        # the web copy is always encoded, as a smaller proxy
+        self.assertFalse(master_conforms(source_path, settings.WEB_FFMPEG_ARGS))
+        with mock.patch.object(settings, 'REMUX_CONFORMING_MASTERS', False):
+            self.assertFalse(master_conforms(source_path, settings.ACCESS_FFMPEG_ARGS))
+        command = remux_command(source_path, 'access.mp4')
+        self.assertIn('+faststart', command)
+        self.assertEqual(command[command.index('-c') + 1], 'copy')
+
+
+FFMPEG_PROGRESS_OUTPUT = """frame=250
+fps=50.00
+bitrate=1000.0kbits/s
+out_time_us=10000000
+out_time=00:00:10.000000
+speed=2.00x
+progress=continue
+frame=500
+fps=50.00
+out_time_us=20000000
+out_time=00:00:20.000000
+speed=2.5x
+progress=end
+"""
+
+
+class TestFFMPEGProgress(unittest.TestCase):
+
+    def fake_ffmpeg(self, stdout='', stderr='', exit_status=0):
+        """
+        A command that writes like ffmpeg, without needing ffmpeg.
+        """
+        script = 'import sys, time\nsys.stdout.write(%r)\nsys.stderr.write(%r)\nsys.exit(%d)' % (
+            stdout, stderr, exit_status)
+        return [sys.executable, '-c', script]
+
+    def test_with_progress_args(self):
+        args = with_progress_args(build_ffmpeg_command('in.mov', [(settings.ACCESS_FFMPEG_ARGS, 'out.mp4')]))
+        self.assertEqual(args[:8], [
+            'ffmpeg', '-progress', 'pipe:1', '-nostats', '-loglevel', 'error', '-hide_banner', '-n',
+        ])
+        self.assertNotIn('-stats', args)
+        self.assertNotIn('panic', args)
+        self.assertEqual(with_progress_args(['ffmpeg', '-loglevel', 'info', '-i', 'in.mov', 'out.mp4'])[4:6],
+                         ['-loglevel', 'info'])
+
+    def test_parse_progress(self):
+        parser = FFMPEGProgress(duration_secs=60)
+        blocks = [parser.feed(line) for line in FFMPEG_PROGRESS_OUTPUT.splitlines()]
+        blocks = [block for block in blocks if block]
+        self.assertEqual(len(blocks), 2)
+        self.assertEqual(blocks[0]['frame'], 250)
+        self.assertEqual(blocks[0]['fps'], 50.0)
+        self.assertEqual(blocks[0]['out_time_secs'], 10.0)
+        self.assertEqual(blocks[0]['speed'], 2.0)
+        self.assertEqual(blocks[0]['eta_secs'], 25.0)
+        self.assertAlmostEqual(blocks[0]['percent'], 16.667, places=3)
+        self.assertTrue(blocks[1]['finished'])
+        self.assertEqual(blocks[1]['eta_secs'], 16.0)
+
+    def test_run_ffmpeg(self):
+        runs = metrics.get('transcoder_ffmpeg_runs_total', {'result': 'success'}) or 0
+        recorded = []
+        with mock.patch('lib.ffmpeg._record_progress', side_effect=lambda progress, job: recorded.append(progress)):
+            progress = run_ffmpeg(self.fake_ffmpeg(FFMPEG_PROGRESS_OUTPUT), duration_secs=20)
+        self.assertEqual(progress['percent'], 100.0)
+        self.assertEqual([p['frame'] for p in recorded], [250, 500])
+        self.assertEqual(metrics.get('transcoder_ffmpeg_runs_total', {'result': 'success'}), runs + 1)
+
+    def test_run_ffmpeg_failure_keeps_stderr(self):
+        stderr = ''.join('line %d\n' % i for i in range(100)) + 'in.mov: Invalid data found when processing input\n'
+        with self.assertRaises(FFMPEGError) as context, self.assertLogs(level='ERROR'):
+            run_ffmpeg(self.fake_ffmpeg(stderr=stderr, exit_status=1))
+        self.assertEqual(len(context.exception.stderr.splitlines()), settings.FFMPEG_STDERR_LINES)
+        self.assertIn('Invalid data found when processing input', str(context.exception))
+
+    def test_metrics_endpoint(self):
+        metrics.set_gauge('transcoder_ffmpeg_fps', 24.5, {'job': 'B1_mo01_"Title".mov'}, 'Frames encoded per second')
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            body = requests.get('http://127.0.0.1:%d/metrics' % server.server_port).text
+        finally:
+            server.shutdown()
+            server.server_close()
+            metrics.remove({'job': 'B1_mo01_"Title".mov'})
+        self.assertIn('# TYPE transcoder_ffmpeg_fps gauge', body)
+        self.assertIn('transcoder_ffmpeg_fps{job="B1_mo01_\\"Title\\".mov"} 24.5', body)
+
+
+class TestWorkerPool(unittest.TestCase):
+
+    def test_run_worker_pool(self):
+        queue = ['/watch/video_%d.mov' % i for i in range(6)]
+        processed = {}
+        running = []
+        max_running = []
+        stop_event = threading.Event()
+        state_lock = threading.Lock()
+
+        def claim_job():
+            with state_lock:
+                if queue:
+                    return queue.pop(0)
+            stop_event.set()
+            return None
+
+        def run_job(path):
+            with state_lock:
+                running.append(path)
+                max_running.append(len(running))
+            time.sleep(0.05)
+            with state_lock:
+                running.remove(path)
+                processed[path] = current_job_name()
+
+        run_worker_pool(claim_job, run_job, concurrency=3, idle_wait=0, stop_event=stop_event)
+        self.assertEqual(len(processed), 6)
+        self.assertGreater(max(max_running), 1)
+        # each job logs under the name of its own master file
+        for path, job_name in processed.items():
+            self.assertEqual(job_name, os.path.basename(path))
+
+    def test_claim_error_does_not_end_worker(self):
+        claims = ['/watch/a.mov', OSError('Host is down'), '/watch/b.mov']
+        processed = []
+        stop_event = threading.Event()
+
+        def claim_job():
+            if not claims:
+                stop_event.set()
+                return None
+            claim = claims.pop(0)
+            if isinstance(claim, Exception):
+                raise claim
+            return claim
+
+        with self.assertLogs(level='ERROR'):
+            run_worker_pool(claim_job, processed.append, concurrency=1, idle_wait=0, stop_event=stop_event)
+        self.assertEqual(processed, ['/watch/a.mov', '/watch/b.mov'])
+
+    def test_job_log_files(self):
+        log_folder = tempfile.mkdtemp()
+        stop_event = threading.Event()
+        queue = ['/watch/a.mov', '/watch/b.mov']
+
+        def claim_job():
+            if queue:
+                return queue.pop(0)
+            stop_event.set()
+            return None
+
+        def run_job(path):
+            logging.warning('processing %s' % path)
+
+        with mock.patch.object(settings, 'JOB_LOG_FOLDER', log_folder):
+            run_worker_pool(claim_job, run_job, concurrency=2, idle_wait=0, stop_event=stop_event)
+
+        log_files = sorted(os.listdir(log_folder))
+        self.assertEqual(len(log_files), 2)
+        for log_file, name in zip(log_files, ['a.mov', 'b.mov']):
+            with open(os.path.join(log_folder, log_file)) as f:
+                contents = f.read()
+            self.assertIn('processing /watch/%s' % name, contents)
+            self.assertEqual(contents.count('processing'), 1)
+        shutil.rmtree(log_folder)
+
+
+class TestLeases(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.lockfile = os.path.join(self.folder, 'B1_mo01_Title.mov.lock')
+        self.managers = []
+
+    def tearDown(self):
+        for manager in self.managers:
+            manager.stop()
+        shutil.rmtree(self.folder)
+
+    def manager(self, owner, duration=60):
+        manager = LeaseManager(owner, duration)
+        self.managers.append(manager)
+        return manager
+
+    def test_only_one_node_claims_each_file(self):
+        lockfiles = [os.path.join(self.folder, 'video%d.mov.lock' % i) for i in range(20)]
+        nodes = [self.manager('node-%d' % i) for i in range(8)]
+        start = threading.Barrier(len(nodes))
+        claims = []
+
+        def claim_all(node):
+            start.wait()
+            for lockfile in lockfiles:
+                if node.acquire(lockfile):
+                    claims.append((lockfile, node.owner))
+
+        threads = [threading.Thread(target=claim_all, args=(node,)) for node in nodes]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(lockfile for lockfile, _ in claims), sorted(lockfiles))
+        for lockfile, owner in claims:
+            self.assertEqual(read_lease(lockfile)['owner'], owner)
+
+    def test_expired_lease_is_reclaimed(self):
+        crashed, other = self.manager('crashed', duration=0.1), self.manager('other')
+        self.assertTrue(crashed.acquire(self.lockfile))
+        self.assertFalse(other.acquire(self.lockfile))
+        # the crashed node stops renewing
+        crashed.stop()
+        time.sleep(0.2)
+        self.assertFalse(other.is_locked(self.lockfile))
+        self.assertTrue(other.acquire(self.lockfile))
+        self.assertEqual(read_lease(self.lockfile)['owner'], 'other')
+        self.assertFalse(other.lost_event(self.lockfile).is_set())
+        self.assertFalse(crashed.renew(self.lockfile))
+        self.assertTrue(crashed.lost_event(self.lockfile).is_set())
+        crashed.release(self.lockfile)
+        self.assertTrue(os.path.exists(self.lockfile))
+
+    def test_heartbeat_renews_lease(self):
+        owner, other = self.manager('owner', duration=0.3), self.manager('other')
+        self.assertTrue(owner.acquire(self.lockfile))
+        expires_at = read_lease(self.lockfile)['expires_at']
+        time.sleep(0.5)
+        self.assertGreater(read_lease(self.lockfile)['expires_at'], expires_at)
+        self.assertFalse(other.acquire(self.lockfile))
+        owner.release(self.lockfile)
+        self.assertFalse(os.path.exists(self.lockfile))
+
+    def test_node_takes_over_its_previous_process_leases(self):
+        with open(self.lockfile, 'w') as f:
+            # only the owner ID and nonce are compared: a restarted container may have the same host and PID
+            json.dump({'owner': 'node', 'host': 'host', 'pid': os.getpid(), 'nonce': 'previous',
+                       'expires_at': time.time() + 60}, f)
+        self.assertFalse(self.manager('other').acquire(self.lockfile, resume=True))
+        node = self.manager('node')
+        # e.g. another container with the same hostname may hold it, so it is only taken over when resuming a job
+        self.assertFalse(node.acquire(self.lockfile))
+        self.assertTrue(node.acquire(self.lockfile, resume=True))
+        self.assertEqual(read_lease(self.lockfile)['nonce'], node.nonce)
+        self.assertTrue(node.renew(self.lockfile))
+
+    def test_job_stops_when_its_lease_is_lost(self):
+        node, other = self.manager('node'), self.manager('other')
+        self.assertTrue(node.acquire(self.lockfile))
+        with open(self.lockfile, 'w') as f:
+            json.dump(other._lease(), f)
+        ran = []
+        with job_logging(self.lockfile):
+            set_abort_event(node.lost_event(self.lockfile))
+            pipeline = Pipeline()
+            pipeline.add_stage('transcode', lambda results: node.renew(self.lockfile) and {})
+            pipeline.add_stage('master_move', lambda results: ran.append('master_move'), requires=['transcode'])
+            self.assertFalse(pipeline.run())
+            with self.assertRaises(JobAborted):
+                ffmpeg.run_ffmpeg(['sh', '-c', 'echo progress=continue'])
+        self.assertEqual(ran, [])
+        self.assertEqual(pipeline.skipped, {'master_move'})
+
+    def test_permanent_locks_are_never_reclaimed(self):
+        open(self.lockfile, 'w').close()  # from an older version
+        self.assertTrue(self.manager('node').is_locked(self.lockfile))
+        self.assertFalse(self.manager('node').acquire(self.lockfile))
+        restricted_lockfile = os.path.join(self.folder, 'B1_mo01_RESTRICTED_Title.mov.lock')
+        self.assertTrue(self.manager('node').acquire(restricted_lockfile, permanent=True))
+        self.assertIsNone(read_lease(restricted_lockfile)['expires_at'])
+        self.assertFalse(self.manager('other', duration=0.01).acquire(restricted_lockfile))
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        for name in ['watch', 'master', 'access', 'web', 'output', 'journal']:
+            os.mkdir(os.path.join(self.folder, name))
+        self.source = os.path.join(self.folder, 'watch', 'B1_mo01_Title.mov')
+        with open(self.source, 'wb') as f:
+            f.write(b'master')
+        ffmpeg.lock(self.source)
+        self.journal_folder = os.path.join(self.folder, 'journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_journal_is_persisted(self):
+        journal = JobJournal(self.source, self.journal_folder)
+        self.assertFalse(journal.resumed)
+        journal.complete('hash', checksum='abc', master_metadata={'created': datetime(2020, 10, 17)})
+        journal.failed('xos_stub', ValueError('XOS is down'))
+
+        journal = JobJournal(self.source, self.journal_folder)
+        self.assertTrue(journal.resumed)
+        self.assertEqual(journal.artifacts('hash')['checksum'], 'abc')
+        self.assertEqual(journal.artifacts('hash')['master_metadata'], {'created': '2020-10-17 00:00:00'})
+        self.assertEqual(journal.next_step(), 'xos_stub')
+        self.assertEqual(journal.data['failure']['error'], 'XOS is down')
+        self.assertEqual(unfinished_jobs(self.journal_folder), [self.source])
+
+        journal.finish()
+        self.assertEqual(unfinished_jobs(self.journal_folder), [])
+
+    def test_process_video_file_resumes(self):
+        folders = {
+            name: os.path.join(self.folder, name.split('_')[0].lower()) + '/'
+            for name in ['MASTER_FOLDER', 'ACCESS_FOLDER', 'WEB_FOLDER', 'OUTPUT_FOLDER', 'JOURNAL_FOLDER']
+        }
+
+        def convert(source, access_path, access_type, web_path, web_type, vernon_id, title):
+            for path in [access_path, web_path]:
+                with open(path, 'wb') as f:
+                    f.write(b'converted')
+            return {'checksum': 'access'}, {'checksum': 'web'}
+
+        def move(source, destination, failsafe_folder=None):
+            shutil.move(source, destination)
+
+        pipeline = {
+            'generate_file_md5': MagicMock(return_value='abc'),
+            'get_video_metadata': MagicMock(return_value={'checksum': 'abc', 'duration_secs': 10}),
+            'write_metadata_summary_entry': MagicMock(),
+            'get_or_create_xos_stub_video': MagicMock(return_value=42),
+            'convert_to_collection_formats': MagicMock(side_effect=convert),
+            'fixity_move': MagicMock(side_effect=move),
+            'uploader': MagicMock(),
+            'update_xos_with_final_video': MagicMock(),
+            'new_file_slack_message': MagicMock(),
+            'post_slack_exception': MagicMock(),
+        }
+        uploaded = []
+
+        def upload(path):
+            uploaded.append(os.path.basename(path))
+            if '_ao01_' in path and uploaded.count(os.path.basename(path)) == 1:
+                raise OSError('S3 is down')
+            return 'l/' + os.path.basename(path)
+        pipeline['uploader'].upload.side_effect = upload
+
+        with contextlib.ExitStack() as stack:
+            for name, value in folders.items():
+                stack.enter_context(mock.patch.object(settings, name, value))
+            stack.enter_context(mock.patch.object(settings, 'EXHIBITIONS_TRANSCODER', False))
+            stack.enter_context(mock.patch.object(settings, 'TRANSCODE_WEB_COPY', True))
+            for name, value in pipeline.items():
+                stack.enter_context(mock.patch.object(easyaccess, name, value))
+            stack.enter_context(mock.patch('lib.pipeline.post_slack_exception', pipeline['post_slack_exception']))
+
+            easyaccess.process_video_file(self.source)
+            pipeline['post_slack_exception'].assert_called_once()
+            self.assertTrue(is_locked(self.source))
+            journal = JobJournal(self.source)
+            self.assertEqual(journal.next_step(), 'access_upload')
+            self.assertEqual(journal.artifacts('transcode')['access_metadata'], {'checksum': 'access'})
+
+            # after a restart, the job carries on from the failed upload
+            self.assertEqual(unfinished_jobs(), [self.source])
+            easyaccess.process_video_file(self.source)
+            pipeline['convert_to_collection_formats'].assert_called_once()
+            pipeline['get_or_create_xos_stub_video'].assert_called_once()
+            self.assertEqual(pipeline['fixity_move'].call_count, 1)
+            # the web file was uploaded the first time round
+            self.assertEqual(sorted(uploaded), ['B1_ao01_Title.mp4', 'B1_ao01_Title.mp4', 'B1_wo01_Title.mp4'])
+            pipeline['update_xos_with_final_video'].assert_called_once()
+            self.assertEqual(pipeline['update_xos_with_final_video'].call_args[0][0], 42)
+            self.assertFalse(is_locked(self.source))
+            self.assertEqual(unfinished_jobs(), [])
+            self.assertTrue(os.path.exists(os.path.join(folders['MASTER_FOLDER'], 'B1_Title', 'B1_mo01_Title.mov')))
+
+
+class TestPipeline(unittest.TestCase):
+
+    def test_independent_stages_overlap(self):
+        both_running = threading.Barrier(2, timeout=5)
+
+        def overlapping_stage(name):
+            def run(results):
+                both_running.wait()
+                return {'value': name}
+            return run
+
+        pipeline = Pipeline()
+        pipeline.add_stage('hash', overlapping_stage('hash'))
+        pipeline.add_stage('transcode', overlapping_stage('transcode'))
+        pipeline.add_stage('move', lambda results: {
+            'moved': [results['hash']['value'], results['transcode']['value']],
+        }, requires=['hash', 'transcode'])
+        self.assertTrue(pipeline.run())
+        self.assertEqual(pipeline.results['move'], {'moved': ['hash', 'transcode']})
+
+    @mock.patch('lib.pipeline.post_slack_exception')
+    def test_failed_stage_skips_dependents(self, post_slack_exception):
+        def fail(results):
+            raise OSError('XOS is down')
+
+        ran = []
+        pipeline = Pipeline()
+        pipeline.add_stage('xos_stub', fail, error_message="Couldn't update XOS: %s")
+        pipeline.add_stage('transcode', lambda results: ran.append('transcode'))
+        pipeline.add_stage('xos_update', lambda results: ran.append('xos_update'), requires=['xos_stub', 'transcode'])
+        pipeline.add_stage('notify', lambda results: ran.append('notify'), requires=['xos_update'])
+        self.assertFalse(pipeline.run())
+        self.assertEqual(ran, ['transcode'])
+        self.assertEqual(list(pipeline.failed), ['xos_stub'])
+        self.assertEqual(pipeline.skipped, {'xos_update', 'notify'})
+        post_slack_exception.assert_called_once_with("Couldn't update XOS: XOS is down")
+
+    def test_journalled_stages_are_not_run_again(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        journal = JobJournal(os.path.join(folder, 'B1_mo01_Title.mov'), folder)
+        journal.complete('transcode', access_metadata={'checksum': 'abc'})
+
+        transcode = MagicMock()
+        pipeline = Pipeline(journal)
+        pipeline.add_stage('transcode', transcode)
+        pipeline.add_stage('access_upload', lambda results: {'uploaded': results['transcode']['access_metadata']},
+                           requires=['transcode'])
+        self.assertTrue(pipeline.run())
+        transcode.assert_not_called()
+        self.assertEqual(journal.artifacts('access_upload')['uploaded'], {'checksum': 'abc'})
+
+
+class TestPerf(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.log_path = os.path.join(self.folder, 'perf.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_job_record_collects_spans_from_stage_threads(self):
+        master_path = os.path.join(self.folder, 'B1_mo01_Title.mov')
+        with open(master_path, 'wb') as f:
+            f.write(b'x' * 1000)
+
+        @timed('hash', size_of_arg=0)
+        def hash_master(path):
+            return 'abc'
+
+        with job_record(master_path, self.log_path) as record:
+            pipeline = Pipeline()
+            pipeline.add_stage('hash', lambda results: {'checksum': hash_master(master_path)})
+            self.assertTrue(pipeline.run())
+            record.result = 'finished'
+        # outside a job, nothing is recorded
+        with span('ignored'):
+            pass
+
+        records = list(read_records(self.log_path))
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]['result'], 'finished')
+        spans = {job_span['name']: job_span for job_span in records[0]['spans']}
+        self.assertEqual(set(spans), {'hash', 'stage:hash'})
+        self.assertEqual(spans['hash']['bytes'], 1000)
+        self.assertIn('mb_per_sec', spans['hash'])
+
+    def test_failed_job_is_recorded(self):
+        with self.assertRaises(ValueError):
+            with job_record('B1_mo01_Title.mov', self.log_path):
+                raise ValueError
+        self.assertEqual(next(read_records(self.log_path))['result'], 'failed')
+
+    def test_summary(self):
+        with open(self.log_path, 'w') as f:
+            for day, wall_secs in enumerate([10, 20, 30, 40, 50], 1):
+                f.write(json.dumps({
+                    'started_at': '2020-10-%02dT12:00:00' % day,
+                    'wall_secs': wall_secs,
+                    'spans': [{'name': 'stage:transcode', 'wall_secs': wall_secs - 5, 'bytes': 1, 'mb_per_sec': 2}],
+                }) + '\n')
+
+        summary = summarise(read_records(self.log_path, since='2020-10-02'))
+        self.assertEqual(summary['job']['count'], 4)
+        self.assertEqual(summary['job']['wall_secs']['p50'], 35)
+        self.assertEqual(summary['job']['wall_secs']['max'], 50)
+        self.assertEqual(summary['stage:transcode']['mb_per_sec']['p90'], 2)
+
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            perf_main(['summary', '--path', self.log_path, '--json'])
+        self.assertEqual(json.loads(output.getvalue())['job']['count'], 5)
+
+
+class TestOutputCache(unittest.TestCase):
+    checksum = '0123456789abcdef0123456789abcdef'
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.cache = OutputCache(os.path.join(self.folder, 'cache'), max_size=250)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def output(self, name, size=100):
+        path = os.path.join(self.folder, name)
+        with open(path, 'wb') as f:
+            f.write(os.urandom(size))
+        return path
+
+    def test_profile_hash_ignores_threads(self):
+        self.assertEqual(profile_hash(settings.ACCESS_FFMPEG_ARGS),
+                         profile_hash(settings.ACCESS_FFMPEG_ARGS + ['-threads', '4']))
+        self.assertNotEqual(profile_hash(settings.ACCESS_FFMPEG_ARGS),
+                            profile_hash(settings.EXHIBITIONS_ACCESS_FFMPEG_ARGS))
+        # e.g. after the encode scheduler has chosen a faster preset
+        self.assertNotEqual(profile_hash(settings.ACCESS_FFMPEG_ARGS),
+                            profile_hash(EncodeScheduler.apply(settings.ACCESS_FFMPEG_ARGS, {
+                                'preset': 'medium', 'preset_changed': True, 'threads': 4})))
+
+    def test_put_and_get(self):
+        self.assertIsNone(self.cache.get(self.checksum, settings.ACCESS_FFMPEG_ARGS))
+        output_path = self.output('access.mp4')
+        self.cache.put(self.checksum, settings.ACCESS_FFMPEG_ARGS, output_path, source='B1_mo01_Title.mov')
+
+        cached_path = self.cache.get(self.checksum, settings.ACCESS_FFMPEG_ARGS + ['-threads', '2'])
+        self.assertTrue(cached_path.endswith('.mp4'))
+        with open(cached_path, 'rb') as cached, open(output_path, 'rb') as original:
+            self.assertEqual(cached.read(), original.read())
+        self.assertIsNone(self.cache.get(self.checksum, settings.EXHIBITIONS_ACCESS_FFMPEG_ARGS))
+        # an output removed from the folder is no longer in the cache
+        os.remove(cached_path)
+        self.assertIsNone(self.cache.get(self.checksum, settings.ACCESS_FFMPEG_ARGS))
+        self.assertEqual(self.cache.entries(), [])
+
+    def test_least_recently_used_are_evicted(self):
+        self.cache.put(self.checksum, settings.ACCESS_FFMPEG_ARGS, self.output('a.mp4'))
+        self.cache.put(self.checksum, settings.EXHIBITIONS_ACCESS_FFMPEG_ARGS, self.output('b.mp4'))
+        time.sleep(0.01)
+        self.assertIsNotNone(self.cache.get(self.checksum, settings.ACCESS_FFMPEG_ARGS))
+        self.cache.put('f' * 32, settings.ACCESS_FFMPEG_ARGS, self.output('c.mp4'))
+
+        self.assertEqual(self.cache.total_size(), 200)
+        self.assertIsNone(self.cache.get(self.checksum, settings.EXHIBITIONS_ACCESS_FFMPEG_ARGS))
+        self.assertIsNotNone(self.cache.get(self.checksum, settings.ACCESS_FFMPEG_ARGS))
+
+    def test_cli(self):
+        self.cache.put(self.checksum, settings.ACCESS_FFMPEG_ARGS, self.output('a.mp4'))
+        self.cache.put('f' * 32, settings.ACCESS_FFMPEG_ARGS, self.output('b.mp4'))
+
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output), contextlib.redirect_stderr(io.StringIO()):
+            output_cache_main(['--folder', self.cache.folder, 'list', '--checksum', self.checksum])
+        self.assertEqual([entry['checksum'] for entry in json.loads(output.getvalue())], [self.checksum])
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            output_cache_main(['--folder', self.cache.folder, 'purge', '--unused-days', '1'])
+        self.assertEqual(len(self.cache.entries()), 2)
+        with contextlib.redirect_stdout(io.StringIO()):
+            output_cache_main(['--folder', self.cache.folder, 'purge', '--checksum', self.checksum])
+        self.assertEqual([entry['checksum'] for entry in self.cache.entries()], ['f' * 32])
+
+
+class TestScratchSpace(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.master_path = os.path.join(self.folder, 'B1_mo01_Title.mov')
+        with open(self.master_path, 'wb') as f:
+            f.write(os.urandom(1000))
+        self.scratch = ScratchSpace(os.path.join(self.folder, 'scratch'), min_free=0, poll_secs=0.01)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_predicted_size(self):
+        self.assertEqual(profile_bit_rate(settings.EXHIBITIONS_ACCESS_FFMPEG_ARGS), 20320000)
+        with mock.patch('lib.scratch.get_video_probe', return_value=({}, {'duration_secs': 80})):
+            self.assertEqual(self.scratch.predicted_size(self.master_path, [settings.EXHIBITIONS_ACCESS_FFMPEG_ARGS]),
+                             int((1000 + 80 * 20320000 / 8) * 1.1))
+        with mock.patch('lib.scratch.get_video_probe', side_effect=FFMPEGError(1, ['ffprobe'])):
+            self.assertEqual(self.scratch.predicted_size(self.master_path, [settings.ACCESS_FFMPEG_ARGS]), 1100)
+
+    def test_master_is_hashed_while_it_is_staged(self):
+        with job_logging(self.master_path):
+            with self.assertRaises(ValueError):
+                with self.scratch.admit(self.master_path, 5000) as job_folder:
+                    staged_path = self.scratch.stage(self.master_path)
+                    self.assertEqual(os.path.dirname(os.path.dirname(staged_path)), job_folder)
+                    with open(self.master_path, 'rb') as f:
+                        md5 = hashlib.md5(f.read()).hexdigest()
+                    for path in (self.master_path, staged_path):
+                        self.assertEqual(fixity.checksum_cache.get(fixity.file_identity(path), 'md5'), md5)
+                    raise ValueError
+        # removed even though the job failed
+        self.assertEqual(os.listdir(self.scratch.folder), [])
+        self.assertIsNone(self.scratch.job_folder())
+
+    def test_masters_with_the_same_name_have_their_own_reservations(self):
+        folders = []
+        both_admitted = threading.Barrier(2, timeout=5)
+
+        def job(subfolder):
+            with job_logging(os.path.join(self.folder, subfolder, 'B1_mo01_Title.mov')):
+                with self.scratch.admit('B1_mo01_Title.mov', 100) as job_folder:
+                    both_admitted.wait()
+                    self.assertEqual(self.scratch.job_folder(), job_folder)
+                    self.assertEqual(len(self.scratch._jobs), 2)
+                    folders.append(job_folder)
+                    both_admitted.wait()
+
+        threads = [threading.Thread(target=job, args=(subfolder,)) for subfolder in ('a', 'b')]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(folders)), 2)
+        self.assertEqual(self.scratch._jobs, {})
+
+    def test_jobs_wait_for_space(self):
+        admitted = []
+        first_admitted = threading.Event()
+        release_first = threading.Event()
+
+        def job(name, needed_bytes, release=None):
+            with job_logging(name), self.scratch.admit(name, needed_bytes):
+                admitted.append(name)
+                first_admitted.set()
+                if release:
+                    release.wait(5)
+
+        with mock.patch('shutil.disk_usage', return_value=shutil._ntuple_diskusage(2000, 1000, 1000)):
+            with self.assertRaises(ScratchSpaceError):
+                job('too_big', 1500)
+            first = threading.Thread(target=job, args=('first', 800, release_first))
+            first.start()
+            first_admitted.wait(5)
+            second = threading.Thread(target=job, args=('second', 500))
+            second.start()
+            time.sleep(0.1)
+            # the first job's reservation hasn't been written yet, but is counted as used
+            self.assertEqual(admitted, ['first'])
+            release_first.set()
+            first.join(5)
+            second.join(5)
+        self.assertEqual(admitted, ['first', 'second'])
+
+
+class TestWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.watch_folder = tempfile.mkdtemp()
+        self.state_folder = tempfile.mkdtemp()
+        self.snapshot_path = os.path.join(self.state_folder, 'snapshot.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.watch_folder)
+        shutil.rmtree(self.state_folder)
+
+    def make_watcher(self, mode='poll'):
+        return Watcher(self.watch_folder, mode=mode, poll_interval=0.1, snapshot_path=self.snapshot_path)
+
+    def write_file(self, name, contents=b'video'):
+        path = os.path.join(self.watch_folder, name)
+        with open(path, 'wb') as f:
+            f.write(contents)
+        return path
+
+    def test_poll_waits_for_file_to_settle(self):
+        watcher = self.make_watcher()
+        watcher.poll()
+        path = self.write_file('B2004203_mo01_New.mov')
+        self.write_file('notes.txt')
+        watcher.poll()
+        self.assertIsNone(watcher.next_file())  # still might be being copied in
+        watcher.poll()
+        self.assertEqual(watcher.next_file(), path)
+        watcher.poll()
+        self.assertIsNone(watcher.next_file())  # only reported once
+
+    def test_poll_only_stats_files_that_may_have_changed(self):
+        watcher = self.make_watcher()
+        reported = self.write_file('B2004203_mo01_Old.mov')
+        watcher.poll()
+        watcher.poll()
+        self.assertEqual(watcher.next_file(), reported)
+        # growing doesn't change the folder's modification time, but is still noticed
+        growing = self.write_file('B2004203_mo01_New.mov')
+        # as though the file had been created a while before the poll, so the folder's listing can be trusted
+        an_hour_ago = time.time() - 3600
+        os.utime(self.watch_folder, (an_hour_ago, an_hour_ago))
+        watcher.poll()
+        with open(growing, 'ab') as f:
+            f.write(b'more')
+        with mock.patch('os.stat', wraps=os.stat) as stat:
+            watcher.poll()
+        stat_paths = [call[0][0] for call in stat.call_args_list]
+        self.assertIn(growing, stat_paths)
+        self.assertNotIn(reported, stat_paths)
+        self.assertIsNone(watcher.next_file())
+        watcher.poll()
+        self.assertEqual(watcher.next_file(), growing)
+
+    def test_poll_snapshot_is_persisted(self):
+        watcher = self.make_watcher()
+        self.write_file('B2004203_mo01_New.mov')
+        watcher.poll()
+        watcher.poll()
+        self.assertTrue(watcher.next_file())
+
+        restarted_watcher = self.make_watcher()
+        restarted_watcher.poll()
+        restarted_watcher.poll()
+        self.assertIsNone(restarted_watcher.next_file())
+
+    def test_rescan_due_at_startup(self):
+        watcher = self.make_watcher()
+        self.assertTrue(watcher.rescan_due())
+        self.assertTrue(watcher.files_available.is_set())
+        watcher.rescan_done()
+        self.assertFalse(watcher.rescan_due())
+        self.assertFalse(watcher.files_available.is_set())
+
+    def test_inotify(self):
+        watcher = self.make_watcher(mode='inotify').start()
+        try:
+            watcher.rescan_done()
+            os.mkdir(os.path.join(self.watch_folder, 'subfolder'))
+            time.sleep(0.2)
+            path = self.write_file('subfolder/B2004203_mo01_New.mov')
+            self.assertTrue(watcher.files_available.wait(5))
+            self.assertEqual(watcher.next_file(), path)
+        finally:
+            watcher.stop()
+
+
 class TestEncoding(unittest.TestCase):
 
     @mock.patch('easyaccess.new_file_slack_message', MagicMock())